@@ -0,0 +1,302 @@
+# Benchmarks for the alignment pipeline on synthetic scenes.
+# run with: 'python bench_alignment.py [--only solver uv rays avatars] [--history bench_history.jsonl]'
+#
+# The scalar path is what get_affine_matrix() did: one 4x4 matrix per avatar
+# that is inverted on its own. Inside Blender it is timed with mathutils,
+# outside of Blender with the np.matrix(...).I of test_transform.py.
+#
+# Every run can be appended to a history file (JSON lines: time, commit, results).
+# Result that is slower than the median of the last runs by more than --threshold
+# is reported as regression (--fail-on-regression makes it an error).
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import timeit
+
+import numpy as np
+
+from uv_alignment_core import get_affine_matrices, transform_uvs, align_landmarks, get_point_rays
+from uv_alignment_core import intersect_rays_plane, project_points, get_camera_rays
+
+try:
+    from mathutils import Matrix, Vector
+except ImportError:
+    Matrix = Vector = None
+
+
+# random eye landmarks for N avatars in UV-space (right eye is to the left of left eye)
+def make_landmarks(n, seed=0):
+    rng = np.random.RandomState(seed)
+    eyeR_plane = rng.uniform(0.3, 0.45, (n, 2))
+    eyeL_plane = eyeR_plane + rng.uniform([0.2, -0.05], [0.35, 0.05], (n, 2))
+    eyeR_photo = rng.uniform(0.2, 0.5, (n, 2))
+    eyeL_photo = eyeR_photo + rng.uniform([0.1, -0.1], [0.4, 0.1], (n, 2))
+    plane_AR = np.full(n, 1.44)
+    photo_AR = rng.uniform(0.5, 2.0, n)
+    return eyeL_plane, eyeR_plane, eyeL_photo, eyeR_photo, plane_AR, photo_AR
+
+
+# one avatar at a time, the way get_affine_matrix() solves it
+def solve_scalar(eyeL_plane, eyeR_plane, eyeL_photo, eyeR_photo, plane_AR, photo_AR):
+    t_mats = []
+    for lp, rp, lf, rf, pAR, fAR in zip(eyeL_plane, eyeR_plane, eyeL_photo, eyeR_photo, plane_AR, photo_AR):
+        rows = ([rp[0], -rp[1]*pAR, 1, 0],
+                [rp[1]*pAR,  rp[0], 0, 1],
+                [lp[0], -lp[1]*pAR, 1, 0],
+                [lp[1]*pAR,  lp[0], 0, 1])
+        photo = (rf[0], rf[1]*fAR, lf[0], lf[1]*fAR)
+        if Matrix is not None:
+            t_vec = Matrix(rows).inverted() * Vector(photo)
+        else:
+            t_vec = np.asarray(np.matrix(rows).I * np.matrix(photo).T).ravel()
+        t_mats.append(((t_vec[0], -t_vec[1], t_vec[2]),
+                       (t_vec[1],  t_vec[0], t_vec[3]),
+                       (0,         0,        1)))
+    return t_mats
+
+
+# random similarity transformations (N, 3, 3): rotation, uniform scale, translation
+def random_similarities(n, seed=0, max_angle=np.pi/6):
+    rng = np.random.RandomState(seed)
+    angle = rng.uniform(-max_angle, max_angle, n)
+    scale = rng.uniform(0.5, 2, n)
+    t_mats = np.zeros((n, 3, 3))
+    t_mats[:, 0, 0] = t_mats[:, 1, 1] = scale * np.cos(angle)
+    t_mats[:, 1, 0] = scale * np.sin(angle)
+    t_mats[:, 0, 1] = -t_mats[:, 1, 0]
+    t_mats[:, :2, 2] = rng.uniform(-0.1, 0.1, (n, 2))
+    t_mats[:, 2, 2] = 1
+    return t_mats
+
+
+# camera of the scenes: at (0, -10, 0) looking along world +Y (see CAMERA PROJECTION in uv_alignment_core.py)
+def make_camera(**params):
+    camera = {'matrix_world': np.array([[1, 0, 0, 0], [0, 0, -1, -10], [0, 1, 0, 0], [0, 0, 0, 1]], dtype=np.float64),
+              'type': 'PERSP', 'lens': 50, 'ortho_scale': 7, 'sensor_width': 36, 'sensor_height': 24,
+              'sensor_fit': 'AUTO', 'shift_x': 0, 'shift_y': 0, 'resolution_x': 1920, 'resolution_y': 1080,
+              'pixel_aspect_x': 1, 'pixel_aspect_y': 1}
+    camera.update(params)
+    return camera
+
+
+# Synthetic scene of N avatars: eyeL, eyeR, mouth of 3D mesh (N, 3, 3) behind FotoPlane
+# (square, PLANE_SIZE units, at y = 2 facing the camera) and eR, eL, mR, mL on photos (N, 4, 2)
+# that are the projections moved by random similarity transformations
+PLANE_SIZE = 4.71391 * 2
+PHOTO_SIZE = (764, 1110)
+
+def make_scene(n, seed=0):
+    rng = np.random.RandomState(seed)
+    mesh_points = np.array([[0.3, 5, 0.2], [-0.3, 5, 0.2], [0, 5, -0.4]]) + rng.uniform(-0.05, 0.05, (n, 3, 3))
+    # where rays from the camera hit the plane (local X right, Z down, origin in the center)
+    camera_location = np.array([0, -10, 0])
+    hits = camera_location + (mesh_points - camera_location) * ((2 - camera_location[1]) / (mesh_points[..., 1:2] - camera_location[1]))
+    plane_points = np.stack((hits[..., 0], -hits[..., 2]), axis=2)
+
+    # photo: the same layout in pixels moved by random similarity, mouth corners around the middle of mouth
+    pixels = (plane_points / PLANE_SIZE + 0.5) * PHOTO_SIZE
+    t_mats = random_similarities(n, seed)
+    pixels = np.einsum('nij,nkj->nki', t_mats[:, :2, :2], pixels - np.array(PHOTO_SIZE) / 2) + t_mats[:, None, :2, 2] * PHOTO_SIZE + np.array(PHOTO_SIZE) / 2
+    eyeL, eyeR, mouth = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+    corner = np.stack((np.full(n, 40.0), np.zeros(n)), axis=1)
+    photo_points = np.stack((eyeR, eyeL, mouth - corner, mouth + corner), axis=1)
+    return mesh_points, photo_points
+
+
+def best_of(func, args, repeat):
+    return min(timeit.repeat(lambda: func(*args), number=1, repeat=repeat))
+
+
+def bench_solver(sizes, repeat):
+    print("solver: scalar ({}) vs batched".format("mathutils" if Matrix is not None else "numpy"))
+    results = []
+    for n in sizes:
+        args = make_landmarks(n)
+        assert np.allclose(np.asarray(solve_scalar(*args)), get_affine_matrices(*args))
+        t_scalar = best_of(solve_scalar, args, repeat)
+        t_batch = best_of(get_affine_matrices, args, repeat)
+        print("  N={:>8}  scalar {:9.4f}s  batched {:9.4f}s  speedup {:8.1f}x".format(
+            n, t_scalar, t_batch, t_scalar / t_batch))
+        results += [result('solver', 'scalar', n, t_scalar), result('solver', 'batched', n, t_batch)]
+    return results
+
+
+# one UV-coordinate at a time, the way the loop over obj.data.loops did it
+def transform_uvs_scalar(uvs, t_mat, plane_AR, photo_AR):
+    if Matrix is not None:
+        affineMatrix = Matrix(t_mat.tolist())
+        for uv_coord in uvs:
+            uv_tr = affineMatrix * Vector((uv_coord[0], uv_coord[1]*plane_AR, 1))
+            uv_coord[0] = uv_tr[0]
+            uv_coord[1] = uv_tr[1] / photo_AR
+    else:
+        (a, b, c), (d, e, f) = t_mat[:2].tolist()
+        for uv_coord in uvs:
+            u, v = uv_coord[0], uv_coord[1]*plane_AR
+            uv_coord[0] = a*u + b*v + c
+            uv_coord[1] = (d*u + e*v + f) / photo_AR
+    return uvs
+
+
+def bench_uv_transform(loops, repeat):
+    print("UV transform: per loop ({}) vs foreach_get/foreach_set buffer".format(
+        "mathutils" if Matrix is not None else "python"))
+    t_mat = get_affine_matrices([0.6, 0.5], [0.4, 0.52], [0.7, 0.4], [0.3, 0.45], 1.44, 0.7)[0]
+    results = []
+    for n in loops:
+        buffer = np.random.RandomState(0).uniform(0, 1, n * 2).astype(np.float32)
+        # the UV layer as list of [u, v] (what uv_map.data[i].uv gives one by one)
+        uv_list = buffer.reshape(-1, 2).tolist()
+        t_scalar = best_of(transform_uvs_scalar, (uv_list, t_mat, 1.44, 0.7), 1)
+        t_batch = best_of(lambda: transform_uvs(buffer.reshape(-1, 2), t_mat, 1.44, 0.7).ravel(), (), repeat)
+        print("  loops={:>8}  per loop {:9.4f}s  buffer {:9.4f}s  speedup {:8.1f}x".format(
+            n, t_scalar, t_batch, t_scalar / t_batch))
+        results += [result('uv', 'per loop', n, t_scalar), result('uv', 'buffer', n, t_batch)]
+    return results
+
+
+# rays from T cameras through K points and their intersections with T planes
+def bench_ray_cast(sizes, repeat, cameras=4):
+    print("ray casting: camera by camera (project, unproject, intersect) vs all cameras at once")
+    camera_list = [make_camera(matrix_world=np.array([[1, 0, 0, dx], [0, 0, -1, -10], [0, 1, 0, 0], [0, 0, 0, 1]],
+                                                     dtype=np.float64)) for dx in np.linspace(-1, 1, cameras)]
+    plane_co = np.tile([0, 2, 0], (cameras, 1))
+    plane_no = np.tile([0, 1, 0], (cameras, 1))
+
+    def by_camera(points):
+        return [intersect_rays_plane(*(get_camera_rays(project_points(points, camera), camera) + (co, no)))[0]
+                for camera, co, no in zip(camera_list, plane_co, plane_no)]
+
+    def batched(points):
+        return intersect_rays_plane(*(get_point_rays(points, camera_list) + (plane_co, plane_no)))[0]
+
+    results = []
+    for n in sizes:
+        points = np.random.RandomState(1).uniform([-1, 4, -1], [1, 6, 1], (n, 3))
+        assert np.allclose(by_camera(points), batched(points))
+        t_camera = best_of(by_camera, (points,), repeat)
+        t_batch = best_of(batched, (points,), repeat)
+        print("  points={:>8} x {} cameras  by camera {:9.4f}s  batched {:9.4f}s  speedup {:8.1f}x".format(
+            n, cameras, t_camera, t_batch, t_camera / t_batch))
+        results += [result('rays', 'by camera', n, t_camera), result('rays', 'batched', n, t_batch)]
+    return results
+
+
+# everything match_foto_with_3D does with NumPy for N avatars: rays from the camera through
+# landmarks of 3D mesh, their intersections with FotoPlane, solve and transform of UV layer (4 loops)
+def bench_avatars(sizes, repeat, solver='EYES'):
+    print("avatars end-to-end ({}): one by one vs batched".format(solver))
+    camera = make_camera()
+    uvs = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32)
+
+    def plane_points_of(hits):
+        return np.stack((hits[..., 0], -hits[..., 2]), axis=-1)
+
+    def one_by_one(mesh_points, photo_points):
+        aligned = []
+        for points, photo in zip(mesh_points, photo_points):
+            origins, directions = get_camera_rays(project_points(points, camera), camera)
+            hits, _ = intersect_rays_plane(origins, directions, [0, 2, 0], [0, 1, 0])
+            t_mats, _, AR, _ = align_landmarks(plane_points_of(hits), (PLANE_SIZE, PLANE_SIZE), photo, PHOTO_SIZE,
+                                               1.44, solver)
+            aligned.append(transform_uvs(uvs, t_mats[0], 1.44, AR[0]))
+        return aligned
+
+    def batched(mesh_points, photo_points):
+        origins, directions = get_point_rays(mesh_points.reshape(-1, 3), [camera])
+        hits, _ = intersect_rays_plane(origins[0], directions[0], [0, 2, 0], [0, 1, 0])
+        t_mats, _, AR, _ = align_landmarks(plane_points_of(hits).reshape(-1, 3, 2), (PLANE_SIZE, PLANE_SIZE),
+                                           photo_points, PHOTO_SIZE, 1.44, solver)
+        return [transform_uvs(uvs, t_mat, 1.44, ar) for t_mat, ar in zip(t_mats, AR)]
+
+    results = []
+    for n in sizes:
+        args = make_scene(n)
+        assert np.allclose(one_by_one(*args), batched(*args), atol=1e-5)
+        t_single = best_of(one_by_one, args, repeat)
+        t_batch = best_of(batched, args, repeat)
+        print("  N={:>8}  one by one {:9.4f}s ({:9.0f}/s)  batched {:9.4f}s ({:9.0f}/s)".format(
+            n, t_single, n / t_single, t_batch, n / t_batch))
+        results += [result('avatars', 'one by one', n, t_single), result('avatars', 'batched', n, t_batch)]
+    return results
+
+
+#######################################################################################
+### HISTORY OF RESULTS
+def result(bench, variant, size, seconds):
+    return {'bench': bench, 'variant': variant, 'size': size, 'time': seconds}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path):
+    runs = []
+    if os.path.exists(path):
+        with open(path) as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    return runs
+
+
+def append_history(path, results):
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'machine': platform.node(),
+           'numpy': np.__version__, 'results': results}
+    with open(path, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+# results slower than median of the same benchmark in the last 'window' runs on this machine
+# by more than 'threshold' (0.2 = 20%): list of (result, median)
+def find_regressions(results, runs, threshold=0.2, window=5, machine=None):
+    machine = machine or platform.node()
+    runs = [run for run in runs if run.get('machine') == machine][-window:]
+    regressions = []
+    for r in results:
+        previous = [p['time'] for run in runs for p in run['results']
+                    if (p['bench'], p['variant'], p['size']) == (r['bench'], r['variant'], r['size'])]
+        if previous and r['time'] > np.median(previous) * (1 + threshold):
+            regressions.append((r, float(np.median(previous))))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the alignment math")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--loops", type=int, nargs="+", default=[4, 10000, 1000000])
+    parser.add_argument("--points", type=int, nargs="+", default=[3, 1000, 100000])
+    parser.add_argument("--avatars", type=int, nargs="+", default=[1, 100, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=["solver", "uv", "rays", "avatars"],
+                        default=["solver", "uv", "rays", "avatars"])
+    parser.add_argument("--history", help="append results to this JSON lines file and compare with previous runs")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    if "solver" in args.only:
+        results += bench_solver(args.sizes, args.repeat)
+    if "uv" in args.only:
+        results += bench_uv_transform(args.loops, args.repeat)
+    if "rays" in args.only:
+        results += bench_ray_cast(args.points, args.repeat)
+    if "avatars" in args.only:
+        results += bench_avatars(args.avatars, args.repeat)
+
+    if args.history:
+        regressions = find_regressions(results, read_history(args.history), args.threshold)
+        for r, median in regressions:
+            print("REGRESSION {} {} size={}: {:.4f}s, median of previous runs {:.4f}s".format(
+                r['bench'], r['variant'], r['size'], r['time'], median))
+        append_history(args.history, results)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
@@ -0,0 +1,441 @@
+# PyTest script for uv_alignment_core.py
+# run with: 'py.test -s -v test_alignment_core.py'
+
+import numpy as np
+import pytest
+
+from uv_alignment_core import get_affine_matrices, get_scale_Y, apply_transforms, fit_transforms
+from uv_alignment_core import to_uv, align_landmarks, get_point_rays
+from uv_alignment_core import intersect_rays_plane, project_points, get_camera_rays, transform_uvs
+from uv_alignment_core import transform_points, compose_matrix, skin_points
+from uv_alignment_core import smooth_tracks, find_reused_frames, align_sequence
+from uv_alignment_core import fit_transforms_robust, align_landmarks_robust, get_confidence, flag_alignments
+from uv_alignment_core import nearest_neighbors, match_nearest, fit_thin_plate, apply_thin_plate, fit_dense_warp
+from uv_alignment_core import warp_uvs
+
+
+# random landmarks in UV-space for N avatars
+@pytest.fixture(scope="function")
+def landmarks():
+  rng = np.random.RandomState(42)
+  n = 50
+  eyeR_plane = rng.uniform(0.3, 0.45, (n, 2))
+  eyeL_plane = eyeR_plane + rng.uniform([0.2, -0.05], [0.35, 0.05], (n, 2))
+  mouth_plane = (eyeL_plane + eyeR_plane)/2 - [0, 0.2]
+  eyeR_photo = rng.uniform(0.2, 0.5, (n, 2))
+  eyeL_photo = eyeR_photo + rng.uniform([0.1, -0.1], [0.4, 0.1], (n, 2))
+  mouth_photo = (eyeL_photo + eyeR_photo)/2 - rng.uniform([-0.02, 0.1], [0.02, 0.3], (n, 2))
+  plane_AR = np.full(n, 1.44)
+  photo_AR = rng.uniform(0.5, 2.0, n)
+  return eyeL_plane, eyeR_plane, mouth_plane, eyeL_photo, eyeR_photo, mouth_photo, plane_AR, photo_AR
+
+
+def test_batch_matches_4x4_solve(landmarks):
+  eyeL_plane, eyeR_plane, _, eyeL_photo, eyeR_photo, _, plane_AR, photo_AR = landmarks
+  t_mats = get_affine_matrices(eyeL_plane, eyeR_plane, eyeL_photo, eyeR_photo, plane_AR, photo_AR)
+  assert t_mats.shape == (len(plane_AR), 3, 3)
+
+  for i, t_mat in enumerate(t_mats):
+    lp, rp, lf, rf = eyeL_plane[i], eyeR_plane[i], eyeL_photo[i], eyeR_photo[i]
+    plane_mat = np.array([[rp[0], -rp[1]*plane_AR[i], 1, 0],
+                          [rp[1]*plane_AR[i],  rp[0], 0, 1],
+                          [lp[0], -lp[1]*plane_AR[i], 1, 0],
+                          [lp[1]*plane_AR[i],  lp[0], 0, 1]])
+    photo_vec = np.array([rf[0], rf[1]*photo_AR[i], lf[0], lf[1]*photo_AR[i]])
+    t_vec = np.linalg.solve(plane_mat, photo_vec)
+    assert np.allclose(t_mat, [[t_vec[0], -t_vec[1], t_vec[2]],
+                               [t_vec[1],  t_vec[0], t_vec[3]],
+                               [0,         0,        1]])
+
+
+def test_single_avatar_gives_stack_of_one():
+  t_mats = get_affine_matrices([0.6, 0.5], [0.4, 0.5], [0.6, 0.5], [0.4, 0.5], 1.44, 1.44)
+  assert t_mats.shape == (1, 3, 3)
+  assert np.allclose(t_mats[0], np.eye(3))
+
+
+def test_same_landmarks_need_no_alignment(landmarks):
+  eyeL_plane, eyeR_plane, mouth_plane, _, _, _, plane_AR, _ = landmarks
+  scale_Y = get_scale_Y(eyeL_plane, eyeR_plane, mouth_plane, eyeL_plane, eyeR_plane, mouth_plane, plane_AR, plane_AR)
+  t_mats = get_affine_matrices(eyeL_plane, eyeR_plane, eyeL_plane, eyeR_plane, plane_AR, plane_AR * scale_Y)
+  assert np.allclose(scale_Y, 1)
+  assert np.allclose(t_mats, np.eye(3))
+
+
+def test_scale_Y_compensates_stretched_mouth(landmarks):
+  eyeL_plane, eyeR_plane, mouth_plane, _, _, _, plane_AR, _ = landmarks
+  # mouth on the photo is twice as far from the eyes as on the plane
+  eyes_mid = (eyeL_plane + eyeR_plane)/2
+  mouth_photo = eyes_mid + 2*(mouth_plane - eyes_mid)
+  scale_Y = get_scale_Y(eyeL_plane, eyeR_plane, mouth_plane,
+                        eyeL_plane, eyeR_plane, mouth_photo, plane_AR, plane_AR)
+  assert np.allclose(scale_Y, 0.5)
+
+
+def test_uv_of_plane_and_photo_points():
+  # plane: origin in the center, Y looking down
+  assert np.allclose(to_uv([[0, 0], [-5, -5], [5, 2.5]], 10, 10, 'CENTER', 'DOWN'), [[0.5, 0.5], [0, 1], [1, 0.25]])
+  # photo: origin in the top left corner, Y looking down
+  assert np.allclose(to_uv([540, 851], 2127, 1477, 'TOPLEFT', 'DOWN'), [540/2127, 1 - 851/1477])
+  assert np.allclose(to_uv([540, 851], 2127, 1477, 'TOPLEFT', 'UP'), [540/2127, 851/1477])
+  with pytest.raises(ValueError):
+    to_uv([0, 0], 1, 1, 'BOTTOMLEFT', 'DOWN')
+
+
+@pytest.mark.parametrize("solver", ['EYES', 'SIMILARITY', 'AFFINE'])
+def test_align_landmarks_from_plane_and_photo_points(landmarks, solver):
+  eyeL_plane, eyeR_plane, mouth_plane, eyeL_photo, eyeR_photo, mouth_photo, _, photo_AR = landmarks
+  plane_size, photo_width = 4.71391*2, 1000
+  photo_size = np.stack((np.full(len(photo_AR), photo_width), photo_width*photo_AR), 1)
+  # back from UV-space to plane units and photo pixels (mouth corners around the middle of mouth)
+  plane_points = (np.stack((eyeL_plane, eyeR_plane, mouth_plane), 1)*[1, -1] + [-0.5, 0.5])*plane_size
+  photo_uv = np.stack((eyeR_photo, eyeL_photo, mouth_photo - [0.05, 0], mouth_photo + [0.05, 0]), 1)
+  photo_points = (photo_uv*[1, -1] + [0, 1])*photo_size[:, None]
+
+  t_mats, scale_Y, AR, residuals = align_landmarks(plane_points, (plane_size, plane_size),
+                                                   photo_points, photo_size, 1.44, solver)
+  expected_scale_Y = get_scale_Y(eyeL_plane, eyeR_plane, mouth_plane, eyeL_photo, eyeR_photo, mouth_photo, 1.44, photo_AR)
+  expected_AR = photo_AR * expected_scale_Y
+  expected_t = get_affine_matrices(eyeL_plane, eyeR_plane, eyeL_photo, eyeR_photo, 1.44, expected_AR)
+  assert np.allclose(scale_Y, expected_scale_Y)
+  assert residuals.shape == (len(photo_AR), 3)
+  if solver == 'EYES':
+    assert np.allclose(AR, expected_AR)
+    assert np.allclose(t_mats, expected_t)
+    assert np.allclose(residuals[:, :2], 0)
+  if solver == 'AFFINE':
+    assert np.allclose(AR, photo_AR)
+    # 3 landmarks fix all 6 parameters
+    assert np.allclose(residuals, 0)
+
+  # single avatar gives stack of one
+  single = align_landmarks(plane_points[3], (plane_size, plane_size), photo_points[3], photo_size[3], 1.44, solver)
+  assert np.allclose(single[0], t_mats[3:4])
+
+
+def test_fit_on_eyes_equals_exact_solve(landmarks):
+  eyeL_plane, eyeR_plane, _, eyeL_photo, eyeR_photo, _, plane_AR, photo_AR = landmarks
+  t_exact = get_affine_matrices(eyeL_plane, eyeR_plane, eyeL_photo, eyeR_photo, plane_AR, photo_AR)
+  t_fit, residuals = fit_transforms(np.stack((eyeL_plane, eyeR_plane), 1),
+                                    np.stack((eyeL_photo, eyeR_photo), 1),
+                                    plane_AR, photo_AR, 'SIMILARITY')
+  assert np.allclose(t_fit, t_exact)
+  assert np.allclose(residuals, 0)
+
+
+@pytest.mark.parametrize("mode", ['SIMILARITY', 'AFFINE'])
+def test_fit_recovers_transform_over_many_landmarks(mode):
+  rng = np.random.RandomState(7)
+  n, k = 20, 12
+  plane_points = rng.uniform(0, 1, (n, k, 2))
+  angle = rng.uniform(-np.pi, np.pi, n)
+  scale = rng.uniform(0.5, 2, n)
+  t_true = np.zeros((n, 3, 3))
+  t_true[:, 0, 0] = t_true[:, 1, 1] = scale*np.cos(angle)
+  t_true[:, 1, 0] = scale*np.sin(angle)
+  t_true[:, 0, 1] = -t_true[:, 1, 0]
+  t_true[:, :2, 2] = rng.uniform(-1, 1, (n, 2))
+  t_true[:, 2, 2] = 1
+  if mode == 'AFFINE':
+    t_true[:, :2, :2] += rng.uniform(-0.2, 0.2, (n, 2, 2))
+  photo_points = apply_transforms(t_true, plane_points)
+
+  t_fit, residuals = fit_transforms(plane_points, photo_points, mode=mode)
+  assert np.allclose(t_fit, t_true)
+  assert residuals.shape == (n, k)
+  assert np.allclose(residuals, 0)
+
+
+def test_fit_residuals_point_at_bad_landmark():
+  plane_points = np.array([[0.4, 0.5], [0.6, 0.5], [0.5, 0.3], [0.5, 0.4]])
+  photo_points = plane_points.copy()
+  photo_points[2] += [0.1, 0]
+  weights = [1, 1, 0, 1]
+  t_fit, residuals = fit_transforms(plane_points, photo_points, weights=weights)
+  assert np.allclose(t_fit[0], np.eye(3))
+  assert np.argmax(residuals[0]) == 2
+  assert np.isclose(residuals[0, 2], 0.1)
+
+
+@pytest.mark.parametrize("mode", ['SIMILARITY', 'AFFINE'])
+def test_robust_fit_leaves_out_bad_landmarks(mode):
+  rng = np.random.RandomState(11)
+  n, k = 20, 10
+  src = rng.uniform(0.2, 0.8, (n, k, 2))
+  t_true = np.tile(np.eye(3), (n, 1, 1))
+  t_true[:, :2, :2] = get_affine_matrices([0.6, 0.5], [0.4, 0.5], [0.62, 0.47], [0.37, 0.5], 1, 1)[0][:2, :2]
+  if mode == 'AFFINE':
+    t_true[:, :2, :2] += rng.uniform(-0.1, 0.1, (n, 2, 2))
+  t_true[:, :2, 2] = rng.uniform(-0.05, 0.05, (n, 2))
+  dst = apply_transforms(t_true, src) + rng.normal(0, 0.002, (n, k, 2))
+  # two landmarks of every avatar are far from where they should be
+  dst[:, :2] += rng.uniform(0.2, 0.3, (n, 2, 2))
+
+  t_mats, residuals, inliers, confidence = fit_transforms_robust(src, dst, mode=mode, threshold=0.02)
+  assert not inliers[:, :2].any() and inliers[:, 2:].all()
+  # the same as least squares over good landmarks only
+  assert np.allclose(t_mats, fit_transforms(src[:, 2:], dst[:, 2:], mode=mode)[0])
+  assert np.allclose(t_mats, t_true, atol=0.02)
+  assert ((confidence > 0.7) & (confidence <= 0.8)).all()
+  # least squares over all landmarks is pulled away by them
+  t_fit, _ = fit_transforms(src, dst, mode=mode)
+  assert not np.allclose(t_fit, t_true, atol=0.02)
+
+
+# eyeL, eyeR, mouth on plane (units) and eR, eL, mR, mL on photo (pixels) related by similarity
+def make_aligned_avatar(plane_size=9.4, photo_size=(764, 1110), plane_AR=1.44):
+  plane_uv = np.array([[0.6, 0.55], [0.4, 0.55], [0.5, 0.35]])
+  t_mat = get_affine_matrices([0.6, 0.5], [0.4, 0.5], [0.64, 0.47], [0.4, 0.52], 1, 1)[0]
+  photo_AR = photo_size[1] / float(photo_size[0])
+  photo_uv = apply_transforms(t_mat, plane_uv * [1, plane_AR]) / [1, photo_AR]
+  plane_points = (plane_uv - 0.5) * [1, -1] * plane_size
+  eyeL, eyeR, mouth = (photo_uv * [1, -1] + [0, 1]) * photo_size
+  photo_points = np.array([eyeR, eyeL, mouth - [20, 0], mouth + [20, 0]])
+  return plane_points, (plane_size, plane_size), photo_points, photo_size, plane_AR
+
+
+@pytest.mark.parametrize("solver", ['EYES', 'SIMILARITY', 'AFFINE'])
+def test_robust_alignment_of_good_and_bad_landmarks(solver):
+  plane_points, plane_size, photo_points, photo_size, plane_AR = make_aligned_avatar()
+  t_mats, scale_Y, AR, residuals, inliers, confidence = align_landmarks_robust(
+    plane_points, plane_size, photo_points, photo_size, plane_AR, solver)
+  expected = align_landmarks(plane_points, plane_size, photo_points, photo_size, plane_AR, solver)
+  assert inliers.all() and confidence[0] > 0.99
+  assert np.allclose(t_mats, expected[0]) and np.allclose(scale_Y, expected[1]) and np.allclose(AR, expected[2])
+
+  # mouth corners (mR, mL) of the photo landmarks are far off: mouth is left out, eyes still fit
+  bad_mouth = photo_points + [[0, 0], [0, 0], [0, 150], [0, 150]]
+  t_mats, scale_Y, AR, residuals, inliers, confidence = align_landmarks_robust(
+    plane_points, plane_size, bad_mouth, photo_size, plane_AR, solver)
+  assert list(inliers[0]) == [True, True, False]
+  assert np.allclose(scale_Y, 1)
+  assert np.allclose(t_mats, expected[0]) and np.allclose(residuals[0, :2], 0)
+  assert confidence[0] <= 2 / 3.
+  assert flag_alignments(inliers, confidence)[0]
+  # without rejection scale_Y takes the bad mouth in
+  assert not np.allclose(align_landmarks(plane_points, plane_size, bad_mouth, photo_size, plane_AR, solver)[1], 1,
+                         atol=0.1)
+
+  # with three landmarks a bad eye can't be told from the others (the good mouth may be left out),
+  # confidence stays at 2/3, but the alignment is flagged with default settings
+  bad_eye = photo_points + [[0, 150], [0, 0], [0, 0], [0, 0]]
+  inliers, confidence = align_landmarks_robust(plane_points, plane_size, bad_eye, photo_size, plane_AR, solver)[4:]
+  assert confidence[0] <= 2 / 3.
+  assert flag_alignments(inliers, confidence)[0]
+  assert not flag_alignments([[True, True, True]], [0.9])[0]
+  assert flag_alignments([[True, True, True]], [0.4])[0]
+
+
+def test_confidence():
+  assert np.allclose(get_confidence([[0, 0, 0], [0, 0.05, 1], [0.025, 0.025, 0.025]], 0.05), [1, 1/3., 0.75])
+
+
+def test_nearest_neighbors_in_chunks():
+  rng = np.random.RandomState(12)
+  points, queries = rng.uniform(0, 1, (300, 2)), rng.uniform(0, 1, (1000, 2))
+  distances, indices = nearest_neighbors(points, queries, chunk_size=64)
+  all_distances = np.linalg.norm(queries[:, None] - points[None], axis=2)
+  assert np.array_equal(indices, np.argmin(all_distances, axis=1))
+  assert np.allclose(distances, all_distances.min(axis=1))
+
+
+def test_match_nearest_both_ways():
+  src = np.array([[0, 0], [1, 0], [1.1, 0], [5, 5]])
+  dst = np.array([[0.05, 0], [1.08, 0], [9, 9]])
+  src_matched, dst_matched = match_nearest(src, dst, max_distance=1)
+  # [1, 0] and [1.1, 0] both see dst 1, only the nearer one gets it; [5, 5] and [9, 9] are too far
+  assert list(src_matched) == [0, 2] and list(dst_matched) == [0, 1]
+
+
+def test_thin_plate_goes_through_control_points():
+  rng = np.random.RandomState(13)
+  src = rng.uniform(0, 1, (40, 2))
+  dst = src + 0.05 * np.sin(src * 6)
+  tps = fit_thin_plate(src, dst)
+  assert np.allclose(apply_thin_plate(tps, src, chunk_size=7), dst)
+  # affine transformation is reproduced everywhere
+  matrix = np.array([[1.1, 0.2], [-0.1, 0.9]])
+  tps = fit_thin_plate(src, np.dot(src, matrix.T) + [0.3, -0.2], smoothing=0.1)
+  points = rng.uniform(-1, 2, (100, 2))
+  assert np.allclose(apply_thin_plate(tps, points), np.dot(points, matrix.T) + [0.3, -0.2])
+
+
+def test_dense_warp_follows_photo_landmarks():
+  rng = np.random.RandomState(14)
+  t_mat = get_affine_matrices([0.6, 0.5], [0.4, 0.5], [0.62, 0.48], [0.38, 0.5], 1.44, 1.3)[0]
+  # vertices of the mesh are apart from each other like the landmarks of a face
+  grid = np.stack(np.meshgrid(np.linspace(0.2, 0.8, 15), np.linspace(0.2, 0.8, 20)), axis=2).reshape(-1, 2)
+  plane_uv = grid + rng.uniform(-0.005, 0.005, grid.shape)
+  plane_uv[:5] = np.nan # rays that missed the plane
+
+  # photo landmarks: plane landmarks moved by t_mat and a smooth bend, in shuffled order, plus some strays
+  def bend(uv):
+    photo = apply_transforms(t_mat, uv * [1, 1.44]) + 0.003 * np.sin(uv * 9)
+    return photo / [1, 1.3]
+  order = rng.permutation(np.arange(5, 300))
+  photo_uv = np.concatenate((bend(plane_uv[order]), rng.uniform(0, 1, (20, 2))))
+
+  tps, plane_matched, photo_matched = fit_dense_warp(plane_uv, photo_uv, t_mat, 1.44, 1.3, max_distance=0.01)
+  assert len(plane_matched) > 250
+  # matched to its own photo landmark (a few may take strays that happen to be next to them)
+  own = photo_matched < len(order)
+  assert (order[photo_matched[own]] == plane_matched[own]).all() and own.mean() > 0.95
+  uvs = rng.uniform(0.3, 0.7, (50, 2)).astype(np.float32)
+  warped = warp_uvs(uvs, tps, 1.44, 1.3)
+  assert warped.dtype == np.float32
+  assert np.allclose(warped, bend(uvs), atol=2e-4)
+  # single transformation can't follow the bend
+  assert not np.allclose(transform_uvs(uvs, t_mat, 1.44, 1.3), bend(uvs), atol=1e-3)
+
+  # nothing to match
+  assert fit_dense_warp(plane_uv, photo_uv + 1, t_mat, 1.44, 1.3)[0] is None
+
+
+def test_rays_hit_plane_in_front_only():
+  origins = [[0, -10, 0], [0, -10, 0], [0, -10, 0], [1, 5, 2]]
+  directions = [[0, 1, 0], [0.1, 1, -0.2], [0, -1, 0], [1, 0, 0]]
+  points, lam = intersect_rays_plane(origins, directions, [0, 2, 0], [0, 1, 0])
+  assert np.allclose(points[0], [0, 2, 0])
+  assert np.allclose(points[1], [1.2, 2, -2.4])
+  assert np.allclose(lam[:2], [12, 12])
+  # pointing away from the plane and parallel to it
+  assert np.isnan(lam[2:]).all()
+  assert np.isnan(points[2:]).all()
+
+
+# camera at (0, -10, 0) looking along world +Y (rotated 90deg around X), like 'cam' of the scenes
+def make_camera(**params):
+  camera = {'matrix_world': [[1, 0, 0, 0], [0, 0, -1, -10], [0, 1, 0, 0], [0, 0, 0, 1]],
+            'type': 'PERSP', 'lens': 50, 'ortho_scale': 7, 'sensor_width': 36, 'sensor_height': 24,
+            'sensor_fit': 'AUTO', 'shift_x': 0, 'shift_y': 0, 'resolution_x': 1920, 'resolution_y': 1080,
+            'pixel_aspect_x': 1, 'pixel_aspect_y': 1}
+  camera.update(params)
+  return camera
+
+
+def test_projection_matches_field_of_view():
+  camera = make_camera()
+  # half of the sensor width (18mm) at 50mm lens -> right edge of the frame
+  pixels = project_points([[0, 0, 0], [18/50.*10, 0, 0], [0, 0, 18/50.*10]], camera)
+  assert np.allclose(pixels, [[960, 540], [1920, 540], [960, 540 - 960]])
+
+
+@pytest.mark.parametrize("params", [{}, {'type': 'ORTHO'}, {'sensor_fit': 'VERTICAL', 'shift_x': 0.1},
+                                    {'resolution_y': 2500, 'shift_y': -0.2, 'pixel_aspect_y': 1.2}])
+def test_rays_pass_through_projected_points(params):
+  camera = make_camera(**params)
+  points = np.random.RandomState(3).uniform(-2, 2, (10, 3))
+  origins, directions = get_camera_rays(project_points(points, camera), camera)
+  assert np.allclose(np.linalg.norm(directions, axis=1), 1)
+  # points lie on the rays
+  to_points = points - origins
+  assert np.allclose(np.cross(to_points, directions), 0)
+  assert (np.sum(to_points*directions, axis=1) > 0).all()
+
+
+def test_rays_of_many_cameras_at_once():
+  cameras = [make_camera(), make_camera(type='ORTHO', shift_x=0.2),
+             make_camera(matrix_world=[[0, 0, 1, 8], [1, 0, 0, 0], [0, 1, 0, 0.5], [0, 0, 0, 1]], lens=35)]
+  points = np.random.RandomState(4).uniform(-2, 2, (6, 3))
+  origins, directions = get_point_rays(points, cameras)
+  assert origins.shape == directions.shape == (3, 6, 3)
+  for camera, camera_origins, camera_directions in zip(cameras, origins, directions):
+    expected_origins, expected_directions = get_camera_rays(project_points(points, camera), camera)
+    assert np.allclose(camera_origins, expected_origins)
+    assert np.allclose(camera_directions, expected_directions)
+
+  # every camera with its own plane
+  plane_co = [[0, 3, 0], [0, 2.5, 0], [4, 0, 0]]
+  plane_no = [[0, 1, 0], [0, 1, 0], [1, 0, 0]]
+  hits, lam = intersect_rays_plane(origins, directions, plane_co, plane_no)
+  assert hits.shape == (3, 6, 3)
+  for t in range(3):
+    expected, _ = intersect_rays_plane(origins[t], directions[t], plane_co[t], plane_no[t])
+    assert np.allclose(hits[t], expected)
+
+
+def test_uv_transform_matches_per_loop_transform():
+  rng = np.random.RandomState(5)
+  uvs = rng.uniform(0, 1, (100, 2)).astype(np.float32)
+  t_mat = get_affine_matrices([0.6, 0.5], [0.4, 0.52], [0.7, 0.4], [0.3, 0.45], 1.44, 0.7)[0]
+  uvs_tr = transform_uvs(uvs, t_mat, 1.44, 0.7)
+  assert uvs_tr.dtype == np.float32
+  for uv, uv_tr in zip(uvs, uvs_tr):
+    expected = np.dot(t_mat, [uv[0], uv[1]*1.44, 1])
+    assert np.allclose(uv_tr, [expected[0], expected[1]/0.7], atol=1e-6)
+
+
+def test_uv_transform_of_frames_matches_frame_by_frame():
+  uvs = np.random.RandomState(6).uniform(0, 1, (20, 2)).astype(np.float32)
+  t_mats = get_affine_matrices([[0.6, 0.5], [0.62, 0.5]], [[0.4, 0.52], [0.41, 0.5]], [0.7, 0.4], [0.3, 0.45], 1.44, 0.7)
+  AR = np.array([0.7, 0.75])
+  uv_frames = transform_uvs(uvs, t_mats, 1.44, AR)
+  assert uv_frames.shape == (2, 20, 2) and uv_frames.dtype == np.float32
+  for t_mat, ar, frame_uvs in zip(t_mats, AR, uv_frames):
+    assert np.allclose(frame_uvs, transform_uvs(uvs, t_mat, 1.44, ar), atol=1e-6)
+
+
+# eR, eL, mR, mL of F frames of a head that slowly moves right, still in frames 3..5
+def make_tracks(frames=8):
+  start = np.array([[300, 400], [460, 405], [330, 640], [430, 642]], dtype=np.float64)
+  shift = np.array([0, 4, 8, 12, 12.1, 12.2, 20, 28][:frames])
+  return start + np.stack((shift, np.zeros(frames)), axis=1)[:, None]
+
+
+def test_smooth_tracks():
+  tracks = make_tracks()
+  assert np.allclose(smooth_tracks(tracks), tracks)
+  smooth = smooth_tracks(tracks, 1)
+  assert np.allclose(smooth[1], tracks[:3].mean(axis=0))
+  # window is cut at the ends
+  assert np.allclose(smooth[0], tracks[:2].mean(axis=0))
+  assert np.allclose(smooth[-1], tracks[-2:].mean(axis=0))
+
+
+def test_frames_that_barely_moved_reuse_solution():
+  tracks = make_tracks()
+  assert list(find_reused_frames(tracks)) == list(range(8))
+  assert list(find_reused_frames(tracks, 0.5)) == [0, 1, 2, 3, 3, 3, 6, 7]
+  # distance is from the last solved frame, not from the previous one
+  assert list(find_reused_frames(tracks, 4.15)) == [0, 0, 2, 2, 2, 5, 6, 7]
+
+
+@pytest.mark.parametrize("solver", ['EYES', 'SIMILARITY', 'AFFINE'])
+def test_sequence_matches_frame_by_frame(solver):
+  plane_points = np.array([[0.8, -0.5], [-0.8, -0.5], [0, 1.5]])
+  tracks = make_tracks()
+  t_mats, scale_Y, AR, residuals, sources = align_sequence(plane_points, (4.7, 4.7), tracks, (764, 1110), 1.44,
+                                                           solver, tolerance=0.5)
+  assert t_mats.shape == (8, 3, 3) and residuals.shape == (8, 3)
+  for frame, source in enumerate(sources):
+    expected = align_landmarks(plane_points, (4.7, 4.7), tracks[source], (764, 1110), 1.44, solver)
+    assert np.allclose(t_mats[frame], expected[0][0])
+    assert np.allclose(AR[frame], expected[2][0])
+  assert np.allclose(t_mats[3], t_mats[5])
+  assert not np.allclose(t_mats[5], t_mats[6])
+
+
+def test_compose_matrix_of_boy_transformation():
+  # location, rotation, scale of Boy's baked mesh
+  matrix = compose_matrix((1, 2, 3), (np.pi/2, 0, 0), (0.01, 0.01, 0.01))
+  points = transform_points(matrix, [[0, 0, 0], [100, 0, 0], [0, 100, 0], [0, 0, 100]])
+  # rotation around X by 90deg: Y goes to Z, Z goes to -Y
+  assert np.allclose(points, [[1, 2, 3], [2, 2, 3], [1, 2, 4], [1, 1, 3]])
+
+
+def test_compose_matrix_rotates_x_then_y_then_z():
+  matrix = compose_matrix((0, 0, 0), (np.pi/2, np.pi/2, 0), (1, 1, 1))
+  # X rotation leaves X axis alone, Y rotation turns it into -Z
+  assert np.allclose(transform_points(matrix, [1, 0, 0]), [[0, 0, -1]])
+  # X rotation turns Y axis into Z, Y rotation turns Z into X
+  assert np.allclose(transform_points(matrix, [0, 1, 0]), [[1, 0, 0]])
+
+
+def test_skinning_blends_normalized_bone_weights():
+  move_up = np.eye(4)
+  move_up[2, 3] = 1
+  bone_matrices = [np.eye(4), move_up]
+  points = [[1, 0, 0], [2, 0, 0], [3, 0, 0], [4, 0, 0]]
+  weights = [[1, 0], [0, 0.5], [0.3, 0.3], [0, 0]]
+  skinned = skin_points(points, weights, bone_matrices)
+  assert np.allclose(skinned, [[1, 0, 0], [2, 0, 1], [3, 0, 0.5], [4, 0, 0]])
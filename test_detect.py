@@ -0,0 +1,61 @@
+# PyTest script for uv_alignment_detect.py
+# run with: 'py.test -s -v test_detect.py'
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from uv_alignment_detect import shape_to_landmarks, detected_landmark_table, find_photos
+from uv_alignment_landmarks import lookup_landmarks, table_landmark_points
+
+
+# 68 points of a face: every point is at (index, 2 * index)
+SHAPE = np.array([(i, 2 * i) for i in range(68)], dtype=np.float64)
+
+
+def test_shape_to_landmarks():
+  eR, eL, mR, mL = shape_to_landmarks(SHAPE)
+  assert np.allclose(eR, (38.5, 77))
+  assert np.allclose(eL, (44.5, 89))
+  assert np.allclose(mR, (48, 96))
+  assert np.allclose(mL, (54, 108))
+
+
+def test_shape_to_landmarks_of_downscaled_photos():
+  # photo decoded at 1/4: pixel 0 covers pixels 0..3 of the photo, its center is at 1.5
+  shapes = np.stack((SHAPE, SHAPE + 10))
+  landmarks = shape_to_landmarks(shapes, 0.25)
+  assert landmarks.shape == (2, 4, 2)
+  assert np.allclose(landmarks[0, 2], (48 * 4 + 1.5, 96 * 4 + 1.5))
+  assert np.allclose(landmarks[1] - landmarks[0], 40)
+  # different scale of X and Y
+  assert np.allclose(shape_to_landmarks(SHAPE, (0.5, 0.25))[3], (54 * 2 + 0.5, 108 * 4 + 1.5))
+  with pytest.raises(ValueError):
+    shape_to_landmarks(SHAPE[:5])
+
+
+def test_detected_landmark_table():
+  detected = OrderedDict((('/photos/103/photo.jpg', shape_to_landmarks(SHAPE)), ('/photos/Girl.png', None)))
+  table = detected_landmark_table(detected)
+  assert list(table['avatar']) == ['103', 'Girl']
+  assert np.allclose(lookup_landmarks(table, 103)['mR'], (48, 96))
+  assert np.isnan(lookup_landmarks(table, 'Girl')['eL']).all()
+  # photo without face gives no landmarks for alignment
+  assert table_landmark_points(table, 'Girl') is None
+  assert table_landmark_points(table, 103).shape == (4, 2)
+
+
+def test_photos_of_avatars(tmpdir):
+  for avatar, names in (('103', ('photo.jpg', 'Head1.jpg')), ('104', ('photo.png', 'Head1.jpg', 'photo.bpt.xml'))):
+    for name in names:
+      tmpdir.join(avatar, name).ensure()
+  tmpdir.join('Girl.png').ensure()
+
+  photos = list(find_photos(str(tmpdir)))
+  # textures of avatars are not photos
+  assert [os.path.relpath(path, str(tmpdir)) for path in photos] == [
+    'Girl.png', os.path.join('103', 'photo.jpg'), os.path.join('104', 'photo.png')]
+  table = detected_landmark_table(OrderedDict((path, shape_to_landmarks(SHAPE)) for path in photos))
+  assert list(table['avatar']) == ['103', '104', 'Girl']
@@ -0,0 +1,72 @@
+# PyTest script for uv_alignment_export.py
+# run with: 'py.test -s -v test_export.py'
+
+import json
+
+import numpy as np
+
+from uv_alignment_core import get_affine_matrices, transform_uvs
+from uv_alignment_export import export_fingerprint, export_if_changed, is_up_to_date, save_uvs, save_uv_matrix
+
+
+UVS = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32)
+
+
+def test_fingerprint_of_content():
+  settings = {'version': 'BIN7400', 'bake_anim': True}
+  fingerprint = export_fingerprint(UVS, settings)
+  assert fingerprint == export_fingerprint(UVS.copy(), dict(settings))
+  assert fingerprint != export_fingerprint(UVS + 1e-3, settings)
+  assert fingerprint != export_fingerprint(UVS, dict(settings, bake_anim=False))
+  # same bytes of another type are another content
+  assert export_fingerprint(UVS) != export_fingerprint(UVS.view(np.int32))
+
+
+def test_unchanged_output_is_not_written_again(tmpdir):
+  path = str(tmpdir.join("103.uv.npy"))
+  writes = []
+  def write(path):
+    writes.append(path)
+    save_uvs(path, UVS)
+
+  assert export_if_changed(path, export_fingerprint(UVS), write)
+  assert not export_if_changed(path, export_fingerprint(UVS), write)
+  assert is_up_to_date(path, export_fingerprint(UVS))
+  # changed content or not incremental export
+  assert export_if_changed(path, export_fingerprint(UVS * 2), write)
+  assert export_if_changed(path, export_fingerprint(UVS * 2), write, incremental=False)
+  assert len(writes) == 3
+
+  # output removed by somebody else
+  tmpdir.join("103.uv.npy").remove()
+  assert not is_up_to_date(path, export_fingerprint(UVS * 2))
+  assert export_if_changed(path, export_fingerprint(UVS * 2), write)
+  assert np.load(path).dtype == np.float32
+  assert np.allclose(np.load(path), UVS)
+
+
+def test_uv_matrix_sidecar_transforms_uvs(tmpdir):
+  t_mat = get_affine_matrices([0.6, 0.5], [0.4, 0.52], [0.7, 0.4], [0.3, 0.45], 1.44, 0.7)[0]
+  path = str(tmpdir.join("103.uv.json"))
+  save_uv_matrix(path, t_mat, 1.44, 0.7)
+  sidecar = json.load(open(path))
+
+  uvs = np.random.RandomState(3).uniform(0, 1, (50, 2))
+  uv_matrix = np.array(sidecar['uv_matrix'])
+  aligned = np.dot(np.hstack((uvs, np.ones((50, 1)))), uv_matrix.T)
+  assert np.allclose(aligned[:, 2], 1)
+  assert np.allclose(aligned[:, :2], transform_uvs(uvs, t_mat, 1.44, 0.7))
+  assert np.allclose(sidecar['t_mat'], t_mat)
+
+
+def test_uv_matrix_sidecar_of_frames(tmpdir):
+  t_mats = get_affine_matrices([[0.6, 0.5], [0.62, 0.5]], [[0.4, 0.52], [0.41, 0.5]], [0.7, 0.4], [0.3, 0.45], 1.44, 0.7)
+  path = str(tmpdir.join("103.uv.json"))
+  save_uv_matrix(path, t_mats, 1.44, [0.7, 0.75], frames=[1, 5])
+  sidecar = json.load(open(path))
+  assert sidecar['frames'] == [1, 5]
+  assert np.array(sidecar['uv_matrix']).shape == (2, 3, 3)
+  assert np.allclose(np.array(sidecar['uv_matrix'])[1, :2, 2], transform_uvs(np.zeros((1, 2)), t_mats[1], 1.44, 0.75))
+
+  save_uvs(str(tmpdir.join("103.uv.npy")), transform_uvs(UVS, t_mats, 1.44, [0.7, 0.75]))
+  assert np.load(str(tmpdir.join("103.uv.npy"))).shape == (2, 4, 2)
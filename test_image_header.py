@@ -0,0 +1,53 @@
+# PyTest script for uv_alignment_images.py
+# run with: 'py.test -s -v test_image_header.py'
+
+import struct
+import zlib
+
+import pytest
+
+from uv_alignment_images import read_image_size, file_signature
+
+
+def make_png(width, height):
+  def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+  ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+  return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IEND', b'')
+
+
+def make_jpeg(width, height, sof=0xC0):
+  app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+  # Huffman table comes before the frame, its marker looks like SOF4
+  dht = b'\xff\xc4' + struct.pack('>H', 5) + b'\x00\x00\x00'
+  sof = b'\xff' + bytes([sof]) + struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\x00'
+  return b'\xff\xd8' + app0 + dht + b'\xff' + sof + b'\xff\xda\x00\x02' + b'\x00'*10 + b'\xff\xd9'
+
+
+@pytest.mark.parametrize("content, size", [(make_png(2127, 1477), (2127, 1477)),
+                                           (make_jpeg(764, 1110), (764, 1110)),
+                                           (make_jpeg(4000, 3000, sof=0xC2), (4000, 3000))],
+                         ids=["png", "jpeg", "progressive jpeg"])
+def test_size_from_header(tmpdir, content, size):
+  path = tmpdir.join("photo")
+  path.write_binary(content)
+  assert tuple(read_image_size(str(path))) == size
+
+
+def test_not_an_image(tmpdir):
+  path = tmpdir.join("photo.bpt.xml")
+  path.write("<xml/>")
+  with pytest.raises(ValueError):
+    read_image_size(str(path))
+
+
+@pytest.mark.parametrize("use_hash", [False, True])
+def test_signature_changes_with_content(tmpdir, use_hash):
+  path = tmpdir.join("photo.jpg")
+  path.write_binary(make_jpeg(10, 10))
+  before = file_signature(str(path), use_hash)
+  assert file_signature(str(path), use_hash) == before
+  path.write_binary(make_jpeg(10, 20))
+  path.setmtime(path.mtime() + 10)
+  assert file_signature(str(path), use_hash) != before
+  assert file_signature(str(tmpdir.join("missing.jpg")), use_hash) is None
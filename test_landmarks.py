@@ -0,0 +1,76 @@
+# PyTest script for uv_alignment_landmarks.py
+# run with: 'py.test -s -v test_landmarks.py'
+
+import io
+
+import numpy as np
+import pytest
+
+from uv_alignment_landmarks import (read_landmarks, get_photo_landmarks, avatar_id, find_landmark_files,
+                                    build_landmark_table, save_landmark_table, load_landmark_table,
+                                    lookup_landmarks, table_landmark_points)
+
+
+# layout of photo.bpt.xml: points of the face are children of the first element of the root
+def make_bpt_xml(points):
+  items = ''.join('<point><x>{}</x><y>{}</y></point>'.format(x, y) for x, y in points)
+  return '<face><points>{}</points><info><width>764</width></info></face>'.format(items)
+
+
+POINTS = [(i * 10, i * 10 + 1) for i in range(12)]
+
+
+def test_points_by_position():
+  landmarks = read_landmarks(io.StringIO(make_bpt_xml(POINTS)))
+  assert len(landmarks) == 12
+  assert landmarks['0/9'] == (90, 91)
+  eR, eL, mR, mL = get_photo_landmarks(io.StringIO(make_bpt_xml(POINTS)))
+  assert np.allclose([eR, eL, mR, mL], [POINTS[9], POINTS[8], POINTS[7], POINTS[6]])
+
+
+def test_points_by_name():
+  xml = ('<face><eyes><point name="eR" x="5" y="6"/><LeftEye><x>7</x><y>8</y></LeftEye></eyes>'
+         '<mouth><point id="mR"><x>1.5</x><y>2.5</y></point></mouth></face>')
+  landmarks = read_landmarks(io.StringIO(xml))
+  assert landmarks['eR'] == (5, 6)
+  assert landmarks['LeftEye'] == (7, 8)
+  assert landmarks['mR'] == (1.5, 2.5)
+  # path still works for named points
+  assert landmarks['1/0'] == (1.5, 2.5)
+
+
+def test_missing_point_raises():
+  # fewer points than driver scripts expect: no silent use of some other point
+  with pytest.raises(KeyError):
+    get_photo_landmarks(io.StringIO(make_bpt_xml(POINTS[:8])))
+
+
+def test_avatar_id():
+  assert avatar_id('d:\\avatars/103/photo.bpt.xml') == '103'
+  assert avatar_id('/data/Girl.xml') == 'Girl'
+
+
+def test_table(tmpdir):
+  for avatar in (103, 7, 2000):
+    points = [(x + avatar, y) for x, y in POINTS]
+    tmpdir.mkdir(str(avatar)).join('photo.bpt.xml').write(make_bpt_xml(points))
+  tmpdir.join('broken.xml').write(make_bpt_xml(POINTS[:8]))
+
+  table = build_landmark_table(find_landmark_files(str(tmpdir)))
+  path = str(tmpdir.join('landmarks.npy'))
+  save_landmark_table(table, path)
+  table = load_landmark_table(path)
+
+  assert isinstance(table, np.memmap)
+  assert list(table['avatar']) == sorted(['103', '7', '2000', 'broken'])
+  row = lookup_landmarks(table, 103)
+  assert np.allclose(row['eR'], (POINTS[9][0] + 103, POINTS[9][1]))
+  assert np.allclose(row['mL'], (POINTS[6][0] + 103, POINTS[6][1]))
+  assert np.isnan(lookup_landmarks(table, 'broken')['eR']).all()
+  with pytest.raises(KeyError):
+    lookup_landmarks(table, 104)
+
+  # avatar with any landmark missing is not in the table for alignment
+  assert np.allclose(table_landmark_points(table, 103)[0], row['eR'])
+  assert table_landmark_points(table, 'broken') is None
+  assert table_landmark_points(table, 104) is None
@@ -0,0 +1,40 @@
+# PyTest script for uv_alignment_obj.py
+# run with: 'py.test -s -v test_obj_vertices.py'
+
+import numpy as np
+import pytest
+
+from uv_alignment_obj import read_obj_vertices
+
+
+OBJ = b"""# Blender v2.79 OBJ File: ''
+mtllib Head.mtl
+o Head
+v 1.000000 2.000000 -3.500000
+v -0.5 0.25 1e-3
+vt 0.1 0.2
+vn 0.0 1.0 0.0
+v\t4 5 6 1.0
+usemtl None
+s off
+f 1/1/1 2/1/1 3/1/1
+"""
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["read", "mmap"])
+def test_reads_only_vertices(tmpdir, use_mmap):
+  path = tmpdir.join("Head.obj")
+  path.write_binary(OBJ)
+  co = read_obj_vertices(str(path), use_mmap)
+  assert co.dtype == np.float32
+  assert np.allclose(co, [[1, 2, -3.5], [-0.5, 0.25, 0.001], [4, 5, 6]])
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["read", "mmap"])
+def test_file_starting_with_vertex_and_empty_file(tmpdir, use_mmap):
+  path = tmpdir.join("eyes.obj")
+  path.write_binary(b"v 1 2 3\r\nv 4 5 6")
+  assert np.allclose(read_obj_vertices(str(path), use_mmap), [[1, 2, 3], [4, 5, 6]])
+
+  path.write_binary(b"")
+  assert read_obj_vertices(str(path), use_mmap).shape == (0, 3)
@@ -0,0 +1,111 @@
+# PyTest script for uv_alignment_orchestrator.py
+# run with: 'py.test -s -v test_orchestrator.py'
+#
+# Blender is replaced by a small script that "aligns" avatars of its manifest:
+# avatar 2 fails on the first attempt, avatar 3 always fails, avatar 4 hangs on the first attempt,
+# avatar 5 is always flagged.
+
+import json
+import sys
+
+import pytest
+
+from uv_alignment_orchestrator import run_jobs
+from uv_alignment_resources import LEAK_EXIT_CODE
+
+
+FAKE_WORKER = r"""
+import json, os, sys, time
+manifest, report, state_dir = sys.argv[1:4]
+for item in json.load(open(manifest)):
+    marker = os.path.join(state_dir, "seen-{}".format(item['avatar']))
+    first = not os.path.exists(marker)
+    open(marker, 'w').close()
+    record = {'job': item['job'], 'avatar': item['avatar'], 'status': 'OK', 'scale_Y': 1.0}
+    if item['avatar'] == 4 and first:
+        time.sleep(30)
+    if item['avatar'] == 3 or (item['avatar'] == 2 and first):
+        record['status'] = 'FAILED'
+    if item['avatar'] == 5:
+        record['status'] = 'FLAGGED'
+    with open(report, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+"""
+
+
+def test_jobs_are_retried_and_aggregated(tmpdir):
+  worker = tmpdir.join("worker.py")
+  worker.write(FAKE_WORKER)
+  command = [sys.executable, str(worker), "{manifest}", "{report}", str(tmpdir)]
+  results_path = tmpdir.join("results.jsonl")
+  items = [{'avatar': avatar} for avatar in range(8)]
+
+  results = run_jobs(items, command, str(results_path), workers=3, chunk_size=2, timeout=1, retries=1,
+                     work_dir=str(tmpdir))
+
+  assert [record['avatar'] for record in results] == list(range(8))
+  assert [record['status'] for record in results] == ['OK']*3 + ['FAILED'] + ['OK', 'FLAGGED'] + ['OK']*2
+  assert results[2]['attempts'] == 2
+  assert results[3]['attempts'] == 2
+  assert results[4]['attempts'] == 2
+  assert all(record['attempts'] == 1 for i, record in enumerate(results) if i not in (2, 3, 4))
+
+  lines = [json.loads(line) for line in results_path.readlines()]
+  assert sorted(record['job'] for record in lines) == list(range(8))
+
+
+# worker that stops on a leak after its first avatar (see uv_alignment_resources.py)
+LEAKY_WORKER = r"""
+import json, sys
+manifest, report = sys.argv[1:3]
+item = json.load(open(manifest))[0]
+with open(report, 'a') as f:
+    f.write(json.dumps({'job': item['job'], 'avatar': item['avatar'], 'status': 'OK'}) + '\n')
+sys.exit(75)
+"""
+
+
+def test_avatars_after_leak_go_back_untouched(tmpdir):
+  worker = tmpdir.join("leaky.py")
+  worker.write(LEAKY_WORKER)
+  command = [sys.executable, str(worker), "{manifest}", "{report}"]
+  items = [{'avatar': avatar} for avatar in range(5)]
+
+  results = run_jobs(items, command, str(tmpdir.join("results.jsonl")), workers=2, chunk_size=3, retries=0,
+                     work_dir=str(tmpdir))
+
+  assert [record['status'] for record in results] == ['OK'] * 5
+  assert all(record['attempts'] == 1 for record in results)
+
+
+# worker that exits with the same code as a leak without reporting anything
+# (e.g. 'uv_alignment_batch.py --no-such-flag' would do it with code of argparse)
+BROKEN_WORKER = r"""
+import sys
+sys.exit(int(sys.argv[3]))
+"""
+
+
+@pytest.mark.parametrize("code", [2, LEAK_EXIT_CODE])
+def test_exit_without_report_takes_an_attempt(tmpdir, code):
+  worker = tmpdir.join("broken.py")
+  worker.write(BROKEN_WORKER)
+  command = [sys.executable, str(worker), "{manifest}", "{report}", str(code)]
+  items = [{'avatar': avatar} for avatar in range(3)]
+
+  results = run_jobs(items, command, str(tmpdir.join("results.jsonl")), workers=2, chunk_size=2, retries=1,
+                     work_dir=str(tmpdir))
+
+  assert [record['status'] for record in results] == ['FAILED'] * 3
+  assert all(record['attempts'] == 2 for record in results)
+
+
+def test_blender_that_does_not_start_fails_avatars(tmpdir):
+  command = [str(tmpdir.join("no-blender")), "{manifest}", "{report}"]
+  items = [{'avatar': avatar} for avatar in range(3)]
+
+  results = run_jobs(items, command, str(tmpdir.join("results.jsonl")), workers=2, chunk_size=2, retries=1,
+                     work_dir=str(tmpdir))
+
+  assert [record['status'] for record in results] == ['FAILED'] * 3
+  assert all(record['attempts'] == 2 and "can't run" in record['error'] for record in results)
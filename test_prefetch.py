@@ -0,0 +1,147 @@
+# PyTest script for uv_alignment_prefetch.py
+# run with: 'py.test -s -v test_prefetch.py'
+#
+# Assets are served by a local stand-in of the avatars server with ETag support.
+
+import hashlib
+import http.server
+import json
+import multiprocessing
+import socketserver
+import threading
+
+import pytest
+
+from uv_alignment_prefetch import AssetCache, Prefetcher
+
+
+FILES = {
+  '/avatars/1/photo.bpt.xml': b'<xml>1</xml>',
+  '/avatars/1/Eyes.obj': b'v 1 2 3\n',
+  '/avatars/2/photo.bpt.xml': b'<xml>2</xml>',
+  '/avatars/2/Eyes.obj': b'v 1 2 3\n', # same content as avatar 1
+}
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+
+
+@pytest.fixture(scope="function")
+def server():
+  stats = {'connections': 0, 'downloads': 0, 'not_modified': 0}
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def setup(self):
+      stats['connections'] += 1
+      http.server.BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+      content = FILES.get(self.path)
+      if content is None:
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+      if self.headers.get('If-None-Match') == etag:
+        stats['not_modified'] += 1
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return
+      stats['downloads'] += 1
+      self.send_response(200)
+      self.send_header('ETag', etag)
+      self.send_header('Content-Length', str(len(content)))
+      self.end_headers()
+      self.wfile.write(content)
+
+    def log_message(self, *args):
+      pass
+
+  httpd = ThreadingServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=httpd.serve_forever)
+  thread.daemon = True
+  thread.start()
+  yield 'http://127.0.0.1:{}/avatars/{{}}/{{}}'.format(httpd.server_address[1]), stats
+  httpd.shutdown()
+  httpd.server_close()
+
+
+def test_prefetch_downloads_once_and_revalidates(server, tmpdir):
+  url, stats = server
+  assets = ('photo.bpt.xml', 'Eyes.obj')
+  prefetcher = Prefetcher(AssetCache(str(tmpdir)), workers=2, url=url, assets=assets)
+  for avatar in (1, 2):
+    prefetcher.prefetch(avatar)
+  paths = [prefetcher.get(avatar) for avatar in (1, 2)]
+  prefetcher.close()
+
+  assert open(paths[0]['photo.bpt.xml'], 'rb').read() == b'<xml>1</xml>'
+  assert open(paths[1]['photo.bpt.xml'], 'rb').read() == b'<xml>2</xml>'
+  # content-addressed: equal files are stored once
+  assert paths[0]['Eyes.obj'] == paths[1]['Eyes.obj']
+  assert stats['downloads'] == 4
+  # connections are kept open between requests
+  assert stats['connections'] <= 2
+
+  # new session with the same cache only revalidates
+  prefetcher = Prefetcher(AssetCache(str(tmpdir)), workers=2, url=url, assets=assets)
+  assert prefetcher.get(1) == paths[0]
+  prefetcher.close()
+  assert stats['downloads'] == 4
+  assert stats['not_modified'] == 2
+
+
+def test_damaged_cache_entry_is_downloaded_again(server, tmpdir):
+  url, stats = server
+  cache = AssetCache(str(tmpdir))
+  path = cache.fetch(url.format(1, 'Eyes.obj'))
+  with open(path, 'ab') as f:
+    f.write(b'garbage')
+
+  assert AssetCache(str(tmpdir)).fetch(url.format(1, 'Eyes.obj')) == path
+  assert open(path, 'rb').read() == b'v 1 2 3\n'
+  assert stats['downloads'] == 2
+
+
+def test_missing_asset_raises(server, tmpdir):
+  url, _ = server
+  prefetcher = Prefetcher(AssetCache(str(tmpdir)), url=url, assets=('Head.obj',))
+  with pytest.raises(IOError):
+    prefetcher.get(1)
+  prefetcher.close()
+
+
+def test_caches_of_two_processes_share_index(server, tmpdir):
+  url, stats = server
+  first, second = AssetCache(str(tmpdir)), AssetCache(str(tmpdir))
+  first.fetch(url.format(1, 'Eyes.obj'))
+  second.fetch(url.format(2, 'Eyes.obj'))
+  index = json.load(open(str(tmpdir.join('index.json'))))
+  assert sorted(index) == sorted([url.format(1, 'Eyes.obj'), url.format(2, 'Eyes.obj')])
+  # a new session knows both
+  AssetCache(str(tmpdir)).fetch(url.format(1, 'Eyes.obj'))
+  assert stats['not_modified'] == 1
+
+
+def save_entries(cache_dir, worker):
+  cache = AssetCache(cache_dir)
+  for i in range(100):
+    cache.save_index({'{}/{}'.format(worker, i): {'sha256': '0' * 64, 'size': 0, 'etag': None}})
+
+
+def test_processes_write_index_at_the_same_time(tmpdir):
+  processes = [multiprocessing.Process(target=save_entries, args=(str(tmpdir), worker)) for worker in range(4)]
+  for process in processes:
+    process.start()
+  for process in processes:
+    process.join()
+  assert [process.exitcode for process in processes] == [0] * 4
+  index = json.load(open(str(tmpdir.join('index.json'))))
+  # the last entry of every process is the last write of the index
+  assert any('{}/99'.format(worker) in index for worker in range(4))
+  assert not tmpdir.listdir(lambda path: path.ext == '.tmp')
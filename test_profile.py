@@ -0,0 +1,46 @@
+# PyTest script for uv_alignment_profile.py
+# run with: 'py.test -s -v test_profile.py'
+
+import json
+import pstats
+import time
+
+from uv_alignment_profile import Profiler
+
+
+def test_stages_are_logged(tmpdir):
+  log_path = str(tmpdir.join("profile.jsonl"))
+  profile_path = str(tmpdir.join("103.prof"))
+  data = {'objects': 10, 'meshes': 5}
+
+  with Profiler(103, log_path, lambda: dict(data), trace_memory=True, profile_path=profile_path) as profiler:
+    with profiler.stage('landmarks'):
+      data['objects'] += 2
+      time.sleep(0.01)
+    with profiler.stage('solve'):
+      kept = [0] * 100000
+    # stage that runs twice adds up
+    for _ in range(2):
+      with profiler.stage('ray_cast'):
+        data['meshes'] += 1
+
+  assert list(profiler.timings) == ['landmarks', 'solve', 'ray_cast']
+  assert profiler.timings['landmarks'] >= 0.01
+
+  lines = open(log_path).read().splitlines()
+  assert len(lines) == 1
+  record = json.loads(lines[0])
+  assert record['avatar'] == 103
+  assert record['stages']['landmarks']['data'] == {'objects': 2}
+  assert record['stages']['ray_cast']['data'] == {'meshes': 2}
+  assert record['stages']['solve']['data'] == {}
+  assert record['stages']['solve']['allocated'] >= 8 * len(kept)
+  assert pstats.Stats(profile_path).total_calls > 0
+
+
+def test_timings_only():
+  profiler = Profiler()
+  with profiler.stage('solve'):
+    pass
+  profiler.close()
+  assert set(profiler.stages['solve']) == {'time'}
@@ -0,0 +1,126 @@
+# PyTest script for uv_alignment_resources.py
+# run with: 'py.test -s -v test_resources.py'
+#
+# bpy.data is replaced by lists of blocks whose users are counted by hand.
+
+import os
+
+import pytest
+
+from uv_alignment_resources import ResourceTracker, ResourceLeakError, resident_memory, remove_new_data, count_data
+
+
+class Block:
+  def __init__(self, name, data=None, users=0):
+    self.name = name
+    self.data = data
+    self.users = users
+    self.key_blocks = []
+
+
+class Blocks(list):
+  def new(self, name, data=None):
+    block = Block(name, data)
+    if data is not None:
+      data.users += 1
+    self.append(block)
+    return block
+
+  def remove(self, block, do_unlink=False):
+    assert block.users == 0 or do_unlink
+    if block.data is not None:
+      block.data.users -= 1
+    list.remove(self, block)
+
+
+class Data:
+  def __init__(self):
+    for kind in ('objects', 'meshes', 'materials', 'textures', 'images', 'actions'):
+      setattr(self, kind, Blocks())
+    self.shape_keys = [] # shape keys go only with their meshes
+    material = self.materials.new("Skin", None)
+    self.objects.new("Head", self.meshes.new("Head", material))
+    self.objects.new("DebugMarkers", self.meshes.new("DebugMarkers"))
+
+
+# what alignment of one avatar leaves: baked object, mesh of to_mesh, its material
+def leave_blocks(data, n=0):
+  material = data.materials.new("Baked{}".format(n))
+  data.objects.new("BakedHead{}".format(n), data.meshes.new("BakedHead{}".format(n), material))
+  data.meshes.new("to_mesh{}".format(n))
+
+
+def test_resident_memory(tmpdir):
+  statm = tmpdir.join("statm")
+  statm.write("1000 250 30 4 0 500 0\n")
+  assert resident_memory(str(statm)) == 250 * os.sysconf('SC_PAGE_SIZE')
+  assert resident_memory(str(tmpdir.join("missing"))) is None
+  # this process on Linux
+  assert resident_memory() is None or resident_memory() > 0
+
+
+def test_new_blocks_and_orphans_are_removed():
+  data = Data()
+  names = dict((kind, set(block.name for block in getattr(data, kind))) for kind in ('objects', 'meshes', 'materials'))
+  before = count_data(data, ('objects', 'meshes', 'materials'))
+  leave_blocks(data)
+  # new object of the kept name stays (with its mesh)
+  data.objects.remove(data.objects[1], do_unlink=True)
+  data.meshes.remove(data.meshes[1])
+  data.objects.new("DebugMarkers", data.meshes.new("DebugMarkers"))
+
+  removed = remove_new_data(data, names, keep=("DebugMarkers",), kinds=('objects', 'meshes', 'materials'))
+  assert removed == {'objects': 1, 'meshes': 2, 'materials': 1}
+  assert count_data(data, ('objects', 'meshes', 'materials')) == before
+  assert [ob.name for ob in data.objects] == ["Head", "DebugMarkers"]
+
+
+def test_tracker_records_every_avatar():
+  data = Data()
+  memory = iter([100, 110, 120])
+  tracker = ResourceTracker(data, keep=("DebugMarkers",), memory=lambda: next(memory))
+  records = []
+  for n in range(3):
+    tracker.begin()
+    leave_blocks(data, n)
+    records.append(tracker.end())
+
+  assert records[0]['rss'] == 100
+  assert records[0]['removed'] == {'objects': 1, 'meshes': 2, 'materials': 1}
+  assert records[0]['data']['objects'] == 2 and records[0]['data']['key_blocks'] == 0
+  # after warmup growth is measured from the first avatar
+  assert 'data_growth' not in records[0]
+  assert records[2]['rss_growth'] == 20
+  assert set(records[2]['data_growth'].values()) == {0}
+  with pytest.raises(ValueError):
+    tracker.end()
+
+
+def test_leak_stops_the_worker():
+  data = Data()
+  tracker = ResourceTracker(data, max_data_growth=2, memory=lambda: None)
+  for n in range(3):
+    tracker.begin()
+    # shape key stack that grows on every avatar
+    data.shape_keys.append(Block("Key{}".format(n)))
+    data.shape_keys[0].key_blocks.append(n)
+    tracker.end()
+  tracker.begin()
+  data.shape_keys.append(Block("Key3"))
+  with pytest.raises(ResourceLeakError) as info:
+    tracker.end()
+  assert "3 shape_keys more" in str(info.value)
+  assert info.value.record['data_growth']['key_blocks'] == 2
+  assert 'rss_growth' not in info.value.record
+
+
+def test_memory_growth_is_a_leak():
+  data = Data()
+  memory = iter([100 << 20, 150 << 20, 300 << 20])
+  tracker = ResourceTracker(data, max_rss_growth=64 << 20, memory=lambda: next(memory))
+  for _ in range(2):
+    tracker.begin()
+    tracker.end()
+  tracker.begin()
+  with pytest.raises(ResourceLeakError, match="resident memory grew by 200.0 MB"):
+    tracker.end()
@@ -0,0 +1,74 @@
+# PyTest script for uv_alignment_rewarp.py
+# run with: 'py.test -s -v test_rewarp.py'
+
+import numpy as np
+import pytest
+
+from uv_alignment_core import get_affine_matrices, get_uv_matrix, transform_uvs
+from uv_alignment_rewarp import texel_uvs, uv_to_pixels, sample_bilinear, rewarp_photo, rewarp_photo_to_file
+
+
+# photo whose channels are linear in pixel coordinates (bilinear sampling of it is exact)
+def make_photo(width=96, height=64):
+  y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+  return np.stack((x, y, x + 2 * y), axis=2)
+
+
+def test_texel_uvs_and_pixels():
+  uvs = texel_uvs(0, 4, 0, 2, 4, 2)
+  assert uvs.shape == (2, 4, 2)
+  assert np.allclose(uvs[0, 0], (0.125, 0.75))
+  assert np.allclose(uvs[1, 3], (0.875, 0.25))
+  x, y = uv_to_pixels(uvs, 4, 2)
+  assert np.allclose(x[0], [0, 1, 2, 3]) and np.allclose(y[:, 0], [0, 1])
+
+
+def test_bilinear_samples():
+  photo = make_photo()
+  samples = sample_bilinear(photo, np.array([10.25, 0, 95]), np.array([3.5, 63, 0]))
+  assert np.allclose(samples, [[10.25, 3.5, 17.25], [0, 63, 126], [95, 0, 95]])
+  # half of pixel outside is the edge, further is fill
+  assert np.allclose(sample_bilinear(photo, np.array([-0.5, -0.6]), np.array([0, 0]), fill=-1), [[0, 0, 0], [-1, -1, -1]])
+  assert sample_bilinear(photo[..., 0], np.array([1.5]), np.array([1.5])).shape == (1,)
+
+
+def test_identity_gives_the_photo():
+  photo = (make_photo() % 256).astype(np.uint8)
+  texture = rewarp_photo(photo, np.eye(3), np.zeros_like(photo), tile=40)
+  assert texture.dtype == np.uint8
+  assert np.array_equal(texture, photo)
+
+
+def test_texel_takes_photo_where_aligned_uv_is():
+  photo = make_photo()
+  t_mat = get_affine_matrices([0.6, 0.5], [0.4, 0.52], [0.62, 0.45], [0.38, 0.48], 1.44, 0.7)[0]
+  uv_mat = get_uv_matrix(t_mat, 1.44, 0.7)
+  texture = rewarp_photo(photo, uv_mat, np.zeros((50, 70, 3), dtype=np.float32), tile=16, fill=-1)
+
+  # the same place on the photo as UVs that transform_UV gives
+  uvs = texel_uvs(0, 70, 0, 50, 70, 50).reshape(-1, 2)
+  x, y = uv_to_pixels(transform_uvs(uvs, t_mat, 1.44, 0.7), 96, 64)
+  inside = (x >= 0) & (x <= 95) & (y >= 0) & (y <= 63)
+  assert inside.mean() > 0.2
+  texels = texture.reshape(-1, 3)
+  assert np.allclose(texels[inside], np.stack((x, y, x + 2 * y), axis=1)[inside], atol=1e-3)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_tiles_in_threads_into_memory_mapped_file(tmpdir, workers):
+  photo = (make_photo(300, 200) % 256).astype(np.uint8)
+  uv_mat = get_uv_matrix(get_affine_matrices([0.6, 0.5], [0.4, 0.5], [0.65, 0.5], [0.35, 0.52], 1.44, 0.67)[0],
+                         1.44, 0.67)
+  expected = rewarp_photo(photo, uv_mat, np.zeros((150, 100, 3), dtype=np.uint8), tile=1000, workers=1)
+  path = str(tmpdir.join("texture.npy"))
+  texture = rewarp_photo_to_file(photo, uv_mat, path, size=(100, 150), tile=32, workers=workers)
+  assert isinstance(texture, np.memmap)
+  assert np.array_equal(np.load(path), expected)
+
+
+def test_function_of_uvs_instead_of_matrix():
+  photo = make_photo()
+  t_mat = get_affine_matrices([0.6, 0.5], [0.4, 0.52], [0.62, 0.45], [0.38, 0.48], 1.44, 0.7)[0]
+  by_matrix = rewarp_photo(photo, get_uv_matrix(t_mat, 1.44, 0.7), np.zeros_like(photo), tile=40)
+  by_function = rewarp_photo(photo, lambda uvs: transform_uvs(uvs, t_mat, 1.44, 0.7), np.zeros_like(photo), tile=40)
+  assert np.allclose(by_function, by_matrix, atol=1e-3)
@@ -4,26 +4,14 @@
 import numpy as np
 import pytest
 
+from uv_alignment_core import get_affine_matrices
+
 # return transformation and its decomposition on scale, rotation, translation
 def get_transform(src2, src1, targ2, targ1):
-  source_mat = np.matrix([[src1[0], -src1[1], 1, 0],
-                         [src1[1],  src1[0], 0, 1], 
-                         [src2[0], -src2[1], 1, 0],
-                         [src2[1],  src2[0], 0, 1]])
-
-  target_vec = np.matrix([[targ1[0]],
-                         [targ1[1]],
-                         [targ2[0]],
-                         [targ2[1]]])
-
-  # Solve SOURCE * t_vec = TARGET
-  # t_vec = [s*cos, s*sin, trans_x, trans_y]
-  t_vec = source_mat.I * target_vec
-
-  # combine transformation matrix
-  t_mat = np.matrix([[t_vec.item(0), -t_vec.item(1), t_vec.item(2)],
-                     [t_vec.item(1),  t_vec.item(0), t_vec.item(3)],
-                     [0,              0,             1]])
+  # Solve SOURCE * t_vec = TARGET for t_vec = [s*cos, s*sin, trans_x, trans_y]
+  # (source points are src1, src2 = right, left eye; target points are targ1, targ2)
+  t_mat = np.matrix(get_affine_matrices(src2, src1, targ2, targ1, 1, 1)[0])
+  t_vec = np.matrix([[t_mat.item(0, 0)], [t_mat.item(1, 0)], [t_mat.item(0, 2)], [t_mat.item(1, 2)]])
 
   # derive translation
   translation = np.matrix([[t_vec.item(2)], [t_vec.item(3)]])
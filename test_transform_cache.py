@@ -0,0 +1,82 @@
+# PyTest script for uv_alignment_cache.py
+# run with: 'py.test -s -v test_transform_cache.py'
+
+import os
+
+import numpy as np
+import pytest
+
+from uv_alignment_cache import TransformCache, plane_key, photo_key, MAX_TRANSFORMS
+
+
+# what get_camera_params in uv_alignment_functions.py reads from camera object
+CAMERA = {'matrix_world': np.eye(4), 'type': 'PERSP'}
+PLANE_POINTS = np.array([[1.2, -0.5], [-1.1, -0.4], [0.05, 1.3]])
+
+
+@pytest.fixture(scope="function")
+def shapekeys(tmpdir):
+  eyes = tmpdir.join("Eyes.obj")
+  eyes.write("v 1 2 3\n")
+  head = tmpdir.join("Head.obj")
+  head.write("v 4 5 6\n")
+  return str(eyes), str(head)
+
+
+def key_of(shapekeys, **changes):
+  args = dict(location=(0, 0, 0), rotation=(np.pi/2, 0, 0), scale=(0.01, 0.01, 0.01),
+              camera=CAMERA, plane_matrix=np.eye(4), plane_size=9.42782)
+  args.update(changes)
+  return plane_key(shapekeys, **args)
+
+
+def test_key_depends_on_every_input(shapekeys):
+  key = key_of(shapekeys)
+  assert key == key_of(shapekeys)
+  assert key != key_of(shapekeys, scale=(0.0085, 0.0085, 0.0085))
+  moved = np.eye(4)
+  moved[:3, 3] = (0, -10, 0)
+  assert key != key_of(shapekeys, camera=dict(CAMERA, matrix_world=moved))
+  assert key != key_of(shapekeys, camera=dict(CAMERA, type='ORTHO'))
+  assert key != key_of(shapekeys, plane_matrix=np.diag([2, 1, 1, 1]))
+  # content of shape key file, not its name or time
+  with open(shapekeys[1], 'a') as f:
+    f.write("v 7 8 9\n")
+  assert key != key_of(shapekeys)
+  with pytest.raises(IOError):
+    key_of((shapekeys[0], shapekeys[1] + ".missing"))
+
+
+def test_entry_is_kept_between_runs(tmpdir, shapekeys):
+  key = key_of(shapekeys)
+  transform = {'t_mat': np.eye(3), 'scale_Y': 1.02, 'AR': 1.45, 'residuals': np.zeros(3)}
+  transform_key = photo_key([[540, 851], [873, 851], [600, 1100], [800, 1100]], (2127, 1477), 1.44, 'EYES')
+  TransformCache(str(tmpdir.join("cache"))).put_transform(key, PLANE_POINTS, transform_key, transform)
+
+  entry = TransformCache(str(tmpdir.join("cache"))).get(key)
+  assert np.allclose(entry['plane_points'], PLANE_POINTS)
+  assert np.allclose(entry['transforms'][transform_key]['t_mat'], np.eye(3))
+  assert entry['transforms'][transform_key]['scale_Y'] == 1.02
+  assert TransformCache(str(tmpdir.join("cache"))).get(key_of(shapekeys, scale=(1, 1, 1))) is None
+
+
+def test_only_latest_transforms_are_kept(tmpdir):
+  cache = TransformCache(str(tmpdir))
+  for i in range(MAX_TRANSFORMS + 3):
+    cache.put_transform('plane', PLANE_POINTS, 'photo{}'.format(i), {'scale_Y': i})
+  transforms = cache.get('plane')['transforms']
+  assert list(transforms) == ['photo{}'.format(i) for i in range(3, MAX_TRANSFORMS + 3)]
+
+
+def test_least_recently_used_entries_are_evicted(tmpdir):
+  cache = TransformCache(str(tmpdir), max_bytes=10**6)
+  for i in range(4):
+    cache.put('entry{}'.format(i), {'plane_points': PLANE_POINTS, 'transforms': {}})
+    os.utime(cache.path('entry{}'.format(i)), (1000 + i, 1000 + i))
+  # reading an entry makes it the most recently used one
+  assert cache.get('entry0') is not None
+  size = os.path.getsize(cache.path('entry0'))
+
+  cache.max_bytes = 3 * size
+  cache.put('entry4', {'plane_points': PLANE_POINTS, 'transforms': {}})
+  assert sorted(name for name in os.listdir(str(tmpdir))) == ['entry0.json', 'entry3.json', 'entry4.json']
@@ -3,9 +3,13 @@ from math import pi
 from mathutils import Vector
 lib_path = os.path.abspath(os.path.join('d:\\desktop\\Matching-Photo-n-3D-4UE\\code\\uv-alignment\\'))
 sys.path.append(lib_path)
+import uv_alignment_functions
 from uv_alignment_functions import match_foto_with_3D
-import xml.etree.ElementTree as ET
-import urllib.request as RQ
+from uv_alignment_prefetch import AssetCache, Prefetcher, copy_asset
+from uv_alignment_landmarks import get_photo_landmarks
+
+# show landmarks and their projections on FotoPlane as crosses in the scene
+uv_alignment_functions.DEBUG_DRAW = True
 
 
 location = (0, 0, 0)
@@ -17,27 +21,23 @@ gender = "Boy"
 
 avatar = 103 # ID of avatar
 
-data = RQ.urlopen("http://face3d.unteleported.com/avatars/{}/photo.bpt.xml".format(avatar))
-tree = ET.parse(data)
-root = tree.getroot()
-eR = Vector((int(root[0][9][0].text), int(root[0][9][1].text))) # right eye coordinates
-eL = Vector((int(root[0][8][0].text), int(root[0][8][1].text))) # left eye coordinates
+# all assets of avatar are downloaded at once (and kept in cache for the next run)
+prefetcher = Prefetcher(AssetCache("d:\\uv-alignment-cache"))
+assets = prefetcher.get(avatar)
+prefetcher.close()
 
-mR = Vector((int(root[0][7][0].text), int(root[0][7][1].text))) # right corner of mouth coordinates
-mL = Vector((int(root[0][6][0].text), int(root[0][6][1].text))) # left corner of mouth coordinates
+# right eye, left eye, right and left corners of mouth
+eR, eL, mR, mL = (Vector(point) for point in get_photo_landmarks(assets['photo.bpt.xml']))
 
 
-RQ.URLopener().retrieve ("http://face3d.unteleported.com/avatars/{}/Eyes.obj".format(avatar), "d:\Boy-eyes-shapekey.obj")
-shapekey_eyes_path = "d:\Boy-eyes-shapekey.obj"
-RQ.URLopener().retrieve ("http://face3d.unteleported.com/avatars/{}/Head.obj".format(avatar), "d:\Boy-head-shapekey.obj")
-shapekey_head_path = "d:\Boy-head-shapekey.obj"
+shapekey_eyes_path = assets['Eyes.obj']
+shapekey_head_path = assets['Head.obj']
 
-RQ.URLopener().retrieve ("http://face3d.unteleported.com/avatars/{}/photo.jpg".format(avatar), "d:\Boy-photo-limbo.jpg")
+copy_asset (assets['photo.jpg'], "d:\Boy-photo-limbo.jpg")
+copy_asset (assets['Head1.jpg'], "d:\Boy-head-texture.jpg")
+copy_asset (assets['boy.fbx'], "d:\Boy.fbx")
 match_foto_with_3D (eR, eL, mR, mL, gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale, AR_plane)
 
-RQ.URLopener().retrieve ("http://face3d.unteleported.com/avatars/{}/Head1.jpg".format(avatar), "d:\Boy-head-texture.jpg")
-RQ.URLopener().retrieve ("http://face3d.unteleported.com/avatars/{}/boy.fbx".format(avatar), "d:\Boy.fbx")
-
 # start match_foto_with_3D function to transform UV of Boy's FotoPlane based on coordinates
 # of eyes on Photo:
 # lx, ly, rx, ry - left eye X, left eye Y, right eye X, right eye Y,
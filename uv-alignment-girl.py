@@ -9,10 +9,12 @@ sys.path.append(lib_path)
 
 from math import radians, pi
 from mathutils import Vector
+import uv_alignment_functions
 from uv_alignment_functions import match_foto_with_3D
+from uv_alignment_landmarks import get_photo_landmarks
 
-# for xml parsing
-import xml.etree.ElementTree as ET
+# show landmarks and their projections on FotoPlane as crosses in the scene
+uv_alignment_functions.DEBUG_DRAW = True
 
 # these transformations moves baked girl to position of skinned girl
 location = (0.16856, 0.13704, 0.02343)
@@ -24,12 +26,8 @@ AR_plane = 1.44 # aspect ratio of Girl's FotoPlane
 gender = "Girl"
 
 data = "d:\Girl.xml"
-tree = ET.parse(data)
-root = tree.getroot()
-eR = Vector((int(root[0][9][0].text), int(root[0][9][1].text))) # right eye coordinates
-eL = Vector((int(root[0][8][0].text), int(root[0][8][1].text))) # left eye coordinates
-mR = Vector((int(root[0][7][0].text), int(root[0][7][1].text))) # right corner of mouth coordinates
-mL = Vector((int(root[0][6][0].text), int(root[0][6][1].text))) # left corner of mouth coordinates
+# right eye, left eye, right and left corners of mouth
+eR, eL, mR, mL = (Vector(point) for point in get_photo_landmarks(data))
 
 shapekey_eyes_path = "d:\Girl-eyes-shapekey.obj"
 shapekey_head_path = "d:\Girl-head-shapekey.obj"
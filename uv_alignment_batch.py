@@ -0,0 +1,284 @@
+# Aligning many avatars in one Blender session.
+#
+# run with: blender <scene>.blend -b -P uv_alignment_batch.py -- <manifest> [--report <report>] [--output-dir <dir>]
+#
+# Manifest is a JSON file with a list of items (or a text file with one item per line).
+# Item is either ID of avatar, whose assets are downloaded from AVATARS_URL
+# (see uv_alignment_prefetch.py, next few avatars are downloaded in background), or a dict:
+#   {"avatar": 103, "gender": "Boy", "landmarks": "d:\\Boy.xml",
+#    "eyes": "d:\\Boy-eyes-shapekey.obj", "head": "d:\\Boy-head-shapekey.obj", "fbx": "d:\\103.fbx"}
+# where every key except "avatar" is optional. With --landmark-table (see uv_alignment_landmarks.py)
+# landmarks of avatars that are in the table are taken from it instead of their landmark files.
+# Table of landmarks detected on photos (for avatars without landmark files) is made by uv_alignment_detect.py.
+#
+# Between avatars the scene is brought back to the state it had before the first one:
+# new objects are removed, shape keys and UVs are restored. With --debug-draw crosses of landmarks
+# of the last avatar are left in DebugMarkers object (see draw_cross in uv_alignment_functions.py).
+# Report gets one JSON line per avatar with its timing and results of alignment.
+# With --profile-log every stage of alignment of every avatar is profiled (see uv_alignment_profile.py),
+# with --profile-dir cProfile stats of every avatar are dumped there as <avatar>.prof.
+# With --transform-cache landmarks on FotoPlane are kept between runs (see uv_alignment_cache.py),
+# so running the manifest again with corrected photo landmarks skips all 3D work.
+# --export chooses outputs (FBX, UV, MATRIX, TEXTURE - see export_alignment in uv_alignment_functions.py),
+# with --incremental outputs that would not change are not written again.
+# With --robust landmarks that don't agree with the others are left out (see align_landmarks_robust
+# in uv_alignment_core.py), avatars with a landmark left out or confidence below --min-confidence
+# are reported as FLAGGED and not exported (see flag_alignments).
+# With --dense-vertices (file with indices of vertices of Head) all points of landmark file of the avatar
+# are matched to these vertices and FotoPlane is warped through them (see match_foto_with_3D).
+# After every avatar data-blocks it created are removed and memory of Blender is measured (see
+# uv_alignment_resources.py, report gets "resources" of the avatar). When memory grows by more than
+# --max-memory-growth MB or data-blocks by more than --max-data-growth, the batch stops with exit code 75
+# (the orchestrator gives the rest of the avatars to a new Blender).
+
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from math import pi, radians
+
+import bpy
+from mathutils import Vector
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import uv_alignment_functions
+from uv_alignment_functions import match_foto_with_3D, get_uvs, set_uvs, DEBUG_MARKERS_NAME
+from uv_alignment_landmarks import get_photo_landmarks, load_landmark_table, table_landmark_points
+from uv_alignment_landmarks import get_all_landmarks, read_vertex_indices
+from uv_alignment_manifest import read_manifest
+from uv_alignment_prefetch import AssetCache, Prefetcher, avatar_assets, copy_asset
+from uv_alignment_profile import Profiler
+from uv_alignment_cache import TransformCache
+from uv_alignment_core import ROBUST_THRESHOLD, MIN_CONFIDENCE
+from uv_alignment_resources import ResourceTracker, ResourceLeakError, LEAK_EXIT_CODE, count_data
+
+
+# these transformations move baked character to position of skinned character
+# (the same constants as in uv-alignment-boy.py and uv-alignment-girl.py)
+RIGS = {
+    'Boy': {'location': (0, 0, 0),
+            'rotation': (pi/2, 0, 0),
+            'scale': (0.01, 0.01, 0.01),
+            'plane_AR': 1.44},
+    'Girl': {'location': (0.16856, 0.13704, 0.02343),
+             'rotation': (pi/2, 0, radians (-69.89)),
+             'scale': (0.0085, 0.0085, 0.0085),
+             'plane_AR': 1.44},
+}
+
+
+# eyes and mouth corners on photo: eR, eL, mR, mL
+# (X = 0, Y = 0 in the top left corner of the photo, Y points downwards)
+def read_photo_landmarks (source):
+    return tuple(Vector(point) for point in get_photo_landmarks (source))
+
+
+# eR, eL, mR, mL of avatar from the table of landmarks, None if it's not there or misses any of them
+def table_photo_landmarks (table, avatar):
+    if table is None or avatar is None:
+        return None
+    points = table_landmark_points (table, avatar)
+    return None if points is None else tuple(Vector(point) for point in points)
+
+
+# does the item miss any local file, so assets of its avatar have to be downloaded
+def needs_download (item):
+    return item.get('avatar') is not None and None in (item.get(key) for key in ('landmarks', 'eyes', 'head', 'photo'))
+
+
+# local paths of everything alignment of the item needs, missing assets come from prefetcher
+def fetch_assets (item, gender, work_dir, prefetcher):
+    avatar = item.get('avatar')
+    paths = {'landmarks': item.get('landmarks'), 'eyes': item.get('eyes'), 'head': item.get('head')}
+    photo = item.get('photo')
+    if needs_download (item):
+        cached = prefetcher.get (avatar, avatar_assets (gender))
+        for key, name in (('landmarks', 'photo.bpt.xml'), ('eyes', 'Eyes.obj'), ('head', 'Head.obj')):
+            paths[key] = paths[key] or cached[name]
+        # head texture and FBX of the character go next to exported FotoPlane
+        copy_asset (cached['Head1.jpg'], os.path.join(work_dir, "{}_{}-head-texture.jpg".format(avatar, gender)))
+        copy_asset (cached['{}.fbx'.format(gender.lower())], os.path.join(work_dir, "{}_{}.fbx".format(avatar, gender)))
+        photo = photo or cached['photo.jpg']
+
+    # photo goes to where Foto image of the scene takes it from
+    if photo is not None:
+        copy_asset (photo, bpy.path.abspath(bpy.data.images['Foto'].filepath))
+    return paths
+
+
+#######################################################################################
+### SCENE SNAPSHOT
+# state of the scene that alignment changes: names of objects,
+# shape keys (names and values) of mesh objects, UV layers of photo planes
+def snapshot_scene ():
+    snapshot = {'objects': set(bpy.data.objects.keys()), 'shape_keys': {}, 'uvs': {}}
+    for ob in bpy.data.objects:
+        if ob.type != 'MESH':
+            continue
+        keys = ob.data.shape_keys
+        snapshot['shape_keys'][ob.name] = [] if keys is None else [(kb.name, kb.value) for kb in keys.key_blocks]
+        if ob.name.endswith('FotoPlane') and ob.data.uv_layers.active is not None:
+            snapshot['uvs'][ob.name] = get_uvs (ob)
+    return snapshot
+
+
+def restore_scene (snapshot):
+    # whatever was added (debug markers are reused by the next avatar)
+    for name in set(bpy.data.objects.keys()) - snapshot['objects'] - {DEBUG_MARKERS_NAME}:
+        ob = bpy.data.objects[name]
+        data = ob.data
+        bpy.data.objects.remove (ob, do_unlink=True)
+        if isinstance(data, bpy.types.Mesh) and data.users == 0:
+            bpy.data.meshes.remove (data)
+
+    # shape keys added by apply_shapekey
+    for name, key_blocks in snapshot['shape_keys'].items():
+        ob = bpy.data.objects.get(name)
+        if ob is None or ob.data.shape_keys is None:
+            continue
+        if not key_blocks:
+            ob.shape_key_clear()
+            continue
+        values = dict(key_blocks)
+        for kb in reversed(list(ob.data.shape_keys.key_blocks)):
+            if kb.name in values:
+                kb.value = values[kb.name]
+            else:
+                ob.shape_key_remove (kb)
+
+    # UVs changed by transform_UV
+    for name, uvs in snapshot['uvs'].items():
+        ob = bpy.data.objects.get(name)
+        if ob is not None:
+            set_uvs (ob, uvs)
+
+
+#######################################################################################
+### BATCH
+# align every item of the manifest, one JSON line per item goes to report_path.
+# Assets of next 'prefetch' avatars are downloaded (into cache_dir) while current one is aligned
+def align_batch (items, report_path, output_dir, default_gender='Boy', solver='EYES',
+                 cache_dir=None, prefetch=4, download_workers=4, landmark_table=None,
+                 profile_log=None, profile_dir=None, transform_cache=None, transform_cache_size=64,
+                 outputs=('FBX',), incremental=False, robust_threshold=None, min_confidence=MIN_CONFIDENCE,
+                 dense_vertices=None, max_memory_growth=1024, max_data_growth=8):
+    snapshot = snapshot_scene ()
+    tracker = ResourceTracker (bpy.data, keep=(DEBUG_MARKERS_NAME,), max_data_growth=max_data_growth,
+                               max_rss_growth=None if max_memory_growth is None else max_memory_growth << 20)
+    leak = None
+    table = load_landmark_table (landmark_table) if landmark_table else None
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    cache = TransformCache (transform_cache, transform_cache_size << 20) if transform_cache else None
+    prefetcher = Prefetcher (AssetCache (cache_dir or os.path.join(output_dir, 'cache')), download_workers)
+    failed = 0
+    with open(report_path, 'a') as report:
+        for i, item in enumerate(items):
+            for next_item in items[i:i + 1 + prefetch]:
+                if needs_download (next_item):
+                    prefetcher.prefetch (next_item['avatar'], avatar_assets (next_item.get('gender', default_gender)))
+
+            gender = item.get('gender', default_gender)
+            avatar = item.get('avatar')
+            record = {'avatar': avatar, 'gender': gender}
+            if 'job' in item:
+                record['job'] = item['job']
+            profiler = Profiler (avatar, profile_log, lambda: count_data (bpy.data), trace_memory=bool(profile_log),
+                                 profile_path=os.path.join(profile_dir, "{}.prof".format(avatar)) if profile_dir else None)
+            start = time.time()
+            profiler.start ()
+            tracker.begin ()
+            try:
+                rig = RIGS[gender]
+                with profiler.stage ('fetch'):
+                    paths = fetch_assets (item, gender, output_dir, prefetcher)
+                record['fetch_time'] = time.time() - start
+                landmarks = table_photo_landmarks (table, avatar)
+                if landmarks is None and paths['landmarks'] is None:
+                    raise ValueError ("Avatar {} has no landmarks: not in the table (or no face on its photo) "
+                                      "and no landmark file".format(avatar))
+                eR, eL, mR, mL = landmarks or read_photo_landmarks (paths['landmarks'])
+                dense_landmarks = None
+                if dense_vertices is not None and paths['landmarks'] is not None:
+                    dense_landmarks = get_all_landmarks (paths['landmarks'])
+                fbx_path = item.get('fbx') or os.path.join(
+                    output_dir, "{}_{}FotoPlane_transfUV.fbx".format(avatar, gender))
+                record.update(match_foto_with_3D (eR, eL, mR, mL, gender, paths['eyes'], paths['head'],
+                                                  rig['location'], rig['rotation'], rig['scale'], rig['plane_AR'],
+                                                  solver=item.get('solver', solver), fbx_path=fbx_path,
+                                                  profiler=profiler, cache=cache, outputs=outputs,
+                                                  incremental=incremental, robust_threshold=robust_threshold,
+                                                  min_confidence=min_confidence, dense_vertices=dense_vertices,
+                                                  dense_landmarks=dense_landmarks))
+                record['status'] = 'FLAGGED' if record.get('flagged') else 'OK'
+            except Exception:
+                failed += 1
+                record['status'] = 'FAILED'
+                record['error'] = traceback.format_exc()
+                print (record['error'])
+            finally:
+                with profiler.stage ('restore'):
+                    restore_scene (snapshot)
+                    try:
+                        record['resources'] = tracker.end ()
+                    except ResourceLeakError as error:
+                        record['resources'] = error.record
+                        leak = error
+                profiler.close ()
+            record['time'] = time.time() - start
+            print ("Avatar {} ({}): {} in {:.2f}s".format(avatar, gender, record['status'], record['time']))
+            report.write(json.dumps(record) + '\n')
+            report.flush()
+            if leak is not None:
+                break
+    prefetcher.close()
+    if leak is not None:
+        raise leak
+    return failed
+
+
+if __name__ == "__main__":
+    # blender passes arguments of the script after '--'
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(prog="uv_alignment_batch.py", description="Align many avatars in one Blender session")
+    parser.add_argument("manifest")
+    parser.add_argument("--report", default="uv_alignment_report.jsonl")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--gender", default="Boy", choices=sorted(RIGS))
+    parser.add_argument("--solver", default="EYES", choices=["EYES", "SIMILARITY", "AFFINE"])
+    parser.add_argument("--cache-dir", help="where downloaded assets are kept (default: <output-dir>/cache)")
+    parser.add_argument("--prefetch", type=int, default=4, help="number of avatars to download ahead")
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--landmark-table", help="landmarks of many avatars in one .npy file (see uv_alignment_landmarks.py)")
+    parser.add_argument("--debug-draw", action="store_true", help="draw crosses at landmarks (see draw_cross)")
+    parser.add_argument("--profile-log", help="append profile of stages of every avatar to this JSON lines file")
+    parser.add_argument("--profile-dir", help="dump cProfile stats of every avatar to this directory")
+    parser.add_argument("--transform-cache", help="directory where landmarks on FotoPlane are kept between runs")
+    parser.add_argument("--transform-cache-size", type=int, default=64, help="size limit of transform cache in MB")
+    parser.add_argument("--export", nargs='+', default=["FBX"], choices=["FBX", "UV", "MATRIX", "TEXTURE"])
+    parser.add_argument("--incremental", action="store_true", help="don't write outputs that would not change")
+    parser.add_argument("--robust", type=float, nargs='?', const=ROBUST_THRESHOLD, metavar="THRESHOLD",
+                        help="leave out landmarks further than THRESHOLD (UV-space) from their place")
+    parser.add_argument("--min-confidence", type=float, default=MIN_CONFIDENCE,
+                        help="with --robust, don't export worse avatars")
+    parser.add_argument("--dense-vertices", help="file with indices of vertices of Head matched to all landmarks of photo")
+    parser.add_argument("--max-memory-growth", type=int, default=1024,
+                        help="stop when memory of Blender grows by more MB after the first avatar")
+    parser.add_argument("--max-data-growth", type=int, default=8,
+                        help="stop when any kind of data-blocks grows by more after the first avatar")
+    args = parser.parse_args(argv)
+    uv_alignment_functions.DEBUG_DRAW = args.debug_draw
+
+    try:
+        failed = align_batch (read_manifest (args.manifest), args.report, args.output_dir, args.gender, args.solver,
+                              args.cache_dir, args.prefetch, args.download_workers, args.landmark_table,
+                              args.profile_log, args.profile_dir, args.transform_cache, args.transform_cache_size,
+                              args.export, args.incremental, args.robust, args.min_confidence,
+                              read_vertex_indices (args.dense_vertices) if args.dense_vertices else None,
+                              args.max_memory_growth, args.max_data_growth)
+    except ResourceLeakError as error:
+        print (error)
+        sys.exit(LEAK_EXIT_CODE)
+    sys.exit(1 if failed else 0)
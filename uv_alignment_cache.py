@@ -0,0 +1,125 @@
+# Persistent store of landmarks projected on FotoPlane and transformations found from them.
+#
+# Landmarks on FotoPlane don't depend on the photo, only on shape keys, character specific
+# transformation and setup of camera (its matrix and type, rays from it don't depend on the rest) and plane.
+# So they are kept under a key made of all of these (see plane_key), and alignment with corrected
+# photo landmarks or another export of the same avatar skips evaluation of landmarks and ray casting.
+# Entry of the cache:
+#   {"plane_points": [[x, z], ...], "transforms": {<photo key>: {"t_mat", "scale_Y", "AR", "residuals"}}}
+#
+# Every entry is one JSON file <cache_dir>/<key>.json, time of its last use is its mtime.
+# When the cache grows over max_bytes, least recently used entries are removed.
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from uv_alignment_images import file_signature
+
+
+# transforms kept per entry (for different photo landmarks), the oldest go first
+MAX_TRANSFORMS = 16
+
+
+# plain JSON value of numbers, arrays, dicts and sequences (for hashing)
+def _to_json (value):
+    if isinstance(value, dict):
+        return OrderedDict((str(k), _to_json(v)) for k, v in value.items())
+    if isinstance(value, (str, bytes)):
+        return value.decode() if isinstance(value, bytes) else value
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    try:
+        return [_to_json(v) for v in value]
+    except TypeError:
+        return value
+
+
+# hash of everything that identifies an entry
+def cache_key (*parts):
+    return hashlib.sha256(json.dumps(_to_json(parts), sort_keys=True).encode()).hexdigest()
+
+
+# key of landmarks on FotoPlane: content of shape key files and everything about the scene they're projected in
+def plane_key (shapekey_paths, location, rotation, scale, camera, plane_matrix, plane_size, scene=None):
+    files = []
+    for path in shapekey_paths:
+        signature = file_signature (path, use_hash=True)
+        if signature is None:
+            raise IOError ("No shape key file '{}'".format(path))
+        files.append(signature)
+    return cache_key ('plane', files, location, rotation, scale, camera, plane_matrix, plane_size, scene)
+
+
+# key of transformation: landmarks and size of photo and how it's solved
+def photo_key (photo_points, photo_size, plane_AR, solver):
+    return cache_key ('photo', photo_points, photo_size, plane_AR, solver)
+
+
+class TransformCache:
+
+    def __init__ (self, cache_dir, max_bytes=64 << 20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path (self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    # entry of the key or None, marks it as used
+    def get (self, key):
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f, object_pairs_hook=OrderedDict)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def put (self, key, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(_to_json(entry), f)
+            os.replace(tmp_path, self.path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict ()
+
+    # add transformation found for photo to entry of plane landmarks
+    def put_transform (self, key, plane_points, transform_key, transform):
+        entry = self.get(key) or {'plane_points': _to_json(plane_points), 'transforms': OrderedDict()}
+        transforms = entry['transforms']
+        transforms.pop(transform_key, None)
+        transforms[transform_key] = _to_json(transform)
+        for old_key in list(transforms)[:-MAX_TRANSFORMS]:
+            del transforms[old_key]
+        self.put(key, entry)
+
+    # remove least recently used entries until cache fits into max_bytes
+    def evict (self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,746 @@
+# Alignment math of uv_alignment_functions.py in NumPy (Blender functions call into it).
+#
+# Everything here works on whole stacks of avatars at once: landmark arguments
+# are arrays of shape (N, 2) (a single (2,) point is treated as N = 1) and
+# aspect ratios are scalars or arrays of shape (N,). Nothing in this file
+# depends on Blender, so it runs on plain CPU workers as well as inside Blender:
+# align_landmarks() gives the matrices and aspect ratios that transform_UV() needs.
+# SciPy (optional) makes nearest neighbour search of dense landmarks faster.
+
+import itertools
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+# turn (N, 2) landmarks into complex numbers x + i*y*AR (AR is broadcast per avatar)
+def _to_complex(points, AR=1.0):
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    return points[..., 0] + 1j * points[..., 1] * np.asarray(AR, dtype=np.float64)
+
+
+# build (N, 3, 3) similarity matrices from complex s*exp(i*r) and tx + i*ty
+def _similarity_matrices(rot_scale, translation):
+    rot_scale, translation = np.broadcast_arrays(rot_scale, translation)
+    t_mats = np.zeros(rot_scale.shape + (3, 3))
+    t_mats[..., 0, 0] = rot_scale.real
+    t_mats[..., 0, 1] = -rot_scale.imag
+    t_mats[..., 0, 2] = translation.real
+    t_mats[..., 1, 0] = rot_scale.imag
+    t_mats[..., 1, 1] = rot_scale.real
+    t_mats[..., 1, 2] = translation.imag
+    t_mats[..., 2, 2] = 1
+    return t_mats
+
+
+#######################################################################################
+### NORMALIZED (UV) COORDINATES
+# Same as convert_to_uv() in uv_alignment_functions.py for (..., 2) points:
+# normalized coordinates of 2D points on plane with dimensions width and height
+# (scalars or broadcastable to points[..., 0]), origin of coordinates 'CENTER' or 'TOPLEFT',
+# Y-axis points 'UP' or 'DOWN'. (0, 0) is bottom left, (1, 1) is top right.
+def to_uv(points, width, height, origin='TOPLEFT', y_dir='DOWN'):
+    points = np.asarray(points, dtype=np.float64)
+    uvs = np.stack((points[..., 0] / width, points[..., 1] / height), axis=-1)
+
+    if origin == 'CENTER':
+        uvs += 0.5
+    elif origin != 'TOPLEFT':
+        raise ValueError("Unknown origin of coordinates '{}': use 'CENTER' or 'TOPLEFT'".format(origin))
+
+    if y_dir == 'DOWN':
+        uvs[..., 1] = 1 - uvs[..., 1]
+    elif y_dir != 'UP':
+        raise ValueError("Unknown direction of Y axis '{}': use 'UP' or 'DOWN'".format(y_dir))
+    return uvs
+
+
+#######################################################################################
+### FIND AFFINE TRANSFORMATIONS FOR A BATCH OF AVATARS (source, target)
+def get_affine_matrices(eyeL_plane, eyeR_plane, eyeL_photo, eyeR_photo, plane_AR, photo_AR):
+
+    # Batched version of get_affine_matrix(): for every avatar we look for the same
+    # similarity 'T' with photo_points = T * plane_points (see Equation 1 there).
+    #
+    # Instead of inverting a 4x4 matrix per avatar we use complex numbers z = x + i*y.
+    # Equation 1 then reads
+    #
+    #   photo = (s*cos(r) + i*s*sin(r)) * plane + (tx + i*ty)
+    #
+    # and two pairs of corresponding landmarks give the closed-form solution
+    #
+    #   s*cos(r) + i*s*sin(r) = (photo_R - photo_L) / (plane_R - plane_L)
+    #   tx + i*ty             = photo_R - (s*cos(r) + i*s*sin(r)) * plane_R
+    #
+    # which is evaluated for all avatars in one go. Result has shape (N, 3, 3).
+    plane_R = _to_complex(eyeR_plane, plane_AR)
+    plane_L = _to_complex(eyeL_plane, plane_AR)
+    photo_R = _to_complex(eyeR_photo, photo_AR)
+    photo_L = _to_complex(eyeL_photo, photo_AR)
+
+    rot_scale = (photo_R - photo_L) / (plane_R - plane_L)
+    translation = photo_R - rot_scale * plane_R
+
+    return _similarity_matrices(rot_scale, translation)
+
+
+#######################################################################################
+### SCALE VERTICAL ONLY (to compensate difference between position of real mouth and mouth on foto)
+def get_scale_Y(eyeL_plane, eyeR_plane, mouth_plane, eyeL_photo, eyeR_photo, mouth_photo, plane_AR, photo_AR):
+
+    # Ratio of "eyes to mouth" distance to "eye to eye" distance on the plane,
+    # divided by the same ratio on the photo. All points are UV-coordinates.
+    plane_R = _to_complex(eyeR_plane, plane_AR)
+    plane_L = _to_complex(eyeL_plane, plane_AR)
+    plane_M = _to_complex(mouth_plane, plane_AR)
+    photo_R = _to_complex(eyeR_photo, photo_AR)
+    photo_L = _to_complex(eyeL_photo, photo_AR)
+    photo_M = _to_complex(mouth_photo, photo_AR)
+
+    dist_between_3D_eyes = np.abs(plane_L - plane_R)
+    dist_between_photo_eyes = np.abs(photo_L - photo_R)
+    dist_eyes_to_mouth_3D = np.abs(plane_M - (plane_L + plane_R) / 2)
+    dist_eyes_to_mouth_photo = np.abs(photo_M - (photo_L + photo_R) / 2)
+
+    return (dist_eyes_to_mouth_3D * dist_between_photo_eyes) / (dist_eyes_to_mouth_photo * dist_between_3D_eyes)
+
+
+#######################################################################################
+### WHOLE 2D PART OF match_foto_with_3D (from landmarks on FotoPlane and on photo)
+# plane_points - (N, 3, 2) eyeL, eyeR, mouth of 3D mesh projected on plane (plane's local X and Z,
+#                origin in the center, Z looking down)
+# plane_size - (width, height) of plane in its units
+# photo_points - (N, 4, 2) eR, eL, mR, mL on photo in pixels (origin in the top left corner, Y looking down)
+# photo_size - (width, height) of photo in pixels, (2,) or (N, 2)
+# solver - 'EYES', 'SIMILARITY' or 'AFFINE' (see match_foto_with_3D)
+# A single avatar ((3, 2) and (4, 2) points) is treated as N = 1.
+# Returns (N, 3, 3) transformation matrices, scale_Y, aspect ratios AR that go to transform_UV()
+# and (N, 3) residuals of eyeL, eyeR, mouth.
+def align_landmarks(plane_points, plane_size, photo_points, photo_size, plane_AR, solver='EYES'):
+    plane_uv, photo_uv, photo_AR = _landmarks_to_uv(plane_points, plane_size, photo_points, photo_size)
+    scale_Y = get_scale_Y(plane_uv[:, 0], plane_uv[:, 1], plane_uv[:, 2],
+                          photo_uv[:, 0], photo_uv[:, 1], photo_uv[:, 2], plane_AR, photo_AR)
+    # aspect ration of photo with scale_Y compensation
+    AR = photo_AR * scale_Y
+
+    if solver == 'EYES':
+        t_mats = get_affine_matrices(plane_uv[:, 0], plane_uv[:, 1], photo_uv[:, 0], photo_uv[:, 1], plane_AR, AR)
+    else:
+        # Affine fit has its own vertical scale, so it works with not compensated aspect ratio
+        if solver == 'AFFINE':
+            AR = np.broadcast_to(photo_AR, scale_Y.shape)
+        t_mats, _ = fit_transforms(plane_uv, photo_uv, plane_AR, AR, solver)
+
+    residuals = get_residuals(t_mats, plane_uv, photo_uv, plane_AR, AR)
+    return t_mats, scale_Y, AR, residuals
+
+
+# (N, 3, 2) UV-coordinates of eyeL, eyeR, mouth on planes and on photos
+# and (N,) aspect ratios of photos (see align_landmarks)
+def _landmarks_to_uv(plane_points, plane_size, photo_points, photo_size):
+    plane_points = np.asarray(plane_points, dtype=np.float64)
+    photo_points = np.asarray(photo_points, dtype=np.float64)
+    if plane_points.ndim == 2:
+        plane_points, photo_points = plane_points[None], photo_points[None]
+    plane_size = np.reshape(np.asarray(plane_size, dtype=np.float64), (-1, 1, 2))
+    photo_size = np.reshape(np.asarray(photo_size, dtype=np.float64), (-1, 1, 2))
+
+    # Convert plane landmarks to UV-coordinates: plane origin is located at center and y-axis points down
+    plane_uv = to_uv(plane_points, plane_size[..., 0], plane_size[..., 1], 'CENTER', 'DOWN')
+
+    # eyes and the point in the middle of mouth on the photo
+    eR, eL, mR, mL = np.moveaxis(photo_points, 1, 0)
+    photo_uv = to_uv(np.stack((eL, eR, (mL + mR) / 2), axis=1), photo_size[..., 0], photo_size[..., 1], 'TOPLEFT', 'DOWN')
+
+    # aspect ratio of photo (not compensated)
+    photo_AR = np.broadcast_to(photo_size[:, 0, 1] / photo_size[:, 0, 0], (len(plane_uv),))
+    return plane_uv, photo_uv, photo_AR
+
+
+# multiply Y of (N, K, 2) points by the aspect ratio of each avatar
+def _scale_points_Y(points, AR):
+    points = points.copy()
+    points[..., 1] *= np.reshape(np.asarray(AR, dtype=np.float64), (-1, 1))
+    return points
+
+
+# apply (N, 3, 3) transformations to (N, K, 2) points, returns (N, K, 2)
+def apply_transforms(t_mats, points):
+    t_mats = np.asarray(t_mats, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    return np.einsum('...ij,...kj->...ki', t_mats[..., :2, :2], points) + t_mats[..., None, :2, 2]
+
+
+# (N, K) distances between plane landmarks brought to the photo by (N, 3, 3) transformations
+# and corresponding photo landmarks (UV-coordinates, Y scaled by aspect ratios like in the solvers)
+def get_residuals(t_mats, plane_points, photo_points, plane_AR=1.0, photo_AR=1.0):
+    src = np.asarray(plane_points, dtype=np.float64)
+    dst = np.asarray(photo_points, dtype=np.float64)
+    if src.ndim == 2:
+        src, dst = src[None], dst[None]
+    src = _scale_points_Y(src, plane_AR)
+    dst = _scale_points_Y(dst, photo_AR)
+    return np.linalg.norm(apply_transforms(t_mats, src) - dst, axis=2)
+
+
+#######################################################################################
+### LEAST-SQUARES FIT OVER ANY NUMBER OF LANDMARKS (source, target)
+# plane_points, photo_points - (N, K, 2) corresponding UV-coordinates of K landmarks
+#                              (a single (K, 2) set is treated as N = 1)
+# mode - 'SIMILARITY' (rotation, uniform scale, translation) or 'AFFINE' (all 6 parameters)
+# weights - optional (N, K) or (K,) weights of the landmarks
+# Returns (N, 3, 3) transformation matrices in the same convention as get_affine_matrices()
+# and (N, K) residuals: distance between transformed plane landmark and photo landmark.
+def fit_transforms(plane_points, photo_points, plane_AR=1.0, photo_AR=1.0, mode='SIMILARITY', weights=None):
+    src = np.asarray(plane_points, dtype=np.float64)
+    dst = np.asarray(photo_points, dtype=np.float64)
+    if src.ndim == 2:
+        src, dst = src[None], dst[None]
+    src = _scale_points_Y(src, plane_AR)
+    dst = _scale_points_Y(dst, photo_AR)
+
+    if weights is None:
+        weights = np.ones(src.shape[:2])
+    weights = np.broadcast_to(np.asarray(weights, dtype=np.float64), src.shape[:2])
+    weights = weights / weights.sum(axis=1, keepdims=True)
+
+    if mode == 'SIMILARITY':
+        # Umeyama: centre both sets, one SVD of the 2x2 cross-covariance per avatar
+        # gives the rotation, the singular values give the uniform scale.
+        src_mean = np.einsum('nk,nki->ni', weights, src)
+        dst_mean = np.einsum('nk,nki->ni', weights, dst)
+        src_c = src - src_mean[:, None]
+        dst_c = dst - dst_mean[:, None]
+        cov = np.einsum('nk,nki,nkj->nij', weights, dst_c, src_c)
+        src_var = np.einsum('nk,nki,nki->n', weights, src_c, src_c)
+
+        U, S, Vt = np.linalg.svd(cov)
+        # no reflections: photo and plane always have the same handedness
+        d = np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+        d[d == 0] = 1
+        U[:, :, 1] *= d[:, None]
+        rotation = np.einsum('nij,njk->nik', U, Vt)
+        scale = (S[:, 0] + d * S[:, 1]) / src_var
+
+        t_mats = np.zeros((len(src), 3, 3))
+        t_mats[:, :2, :2] = scale[:, None, None] * rotation
+        t_mats[:, :2, 2] = dst_mean - np.einsum('nij,nj->ni', t_mats[:, :2, :2], src_mean)
+        t_mats[:, 2, 2] = 1
+
+    elif mode == 'AFFINE':
+        # weighted normal equations (X' W X) A' = X' W dst, X = [x, y, 1], solved for all avatars at once
+        X = np.concatenate((src, np.ones(src.shape[:2] + (1,))), axis=2)
+        XtWX = np.einsum('nk,nki,nkj->nij', weights, X, X)
+        XtWd = np.einsum('nk,nki,nkj->nij', weights, X, dst)
+        A = np.linalg.solve(XtWX, XtWd)
+
+        t_mats = np.zeros((len(src), 3, 3))
+        t_mats[:, :2, :] = np.swapaxes(A, 1, 2)
+        t_mats[:, 2, 2] = 1
+
+    else:
+        raise ValueError("Give me correct fit mode: 'SIMILARITY' or 'AFFINE'")
+
+    residuals = np.linalg.norm(apply_transforms(t_mats, src) - dst, axis=2)
+    return t_mats, residuals
+
+
+#######################################################################################
+### ROBUST FIT (RANSAC) AND CONFIDENCE OF ALIGNMENT
+# Landmark further than this from its place after alignment is an outlier
+# (UV-space, Y scaled by aspect ratio: 0.05 is 5% of width of the photo).
+# Difference between real mouth and mouth on photo (what scale_Y compensates) stays within it.
+ROBUST_THRESHOLD = 0.05
+
+# landmarks needed to fit a transformation
+MIN_LANDMARKS = {'SIMILARITY': 2, 'AFFINE': 3}
+
+# alignment with lower confidence (see get_confidence) is not trusted
+MIN_CONFIDENCE = 0.5
+
+
+# (H, sample_size) indices of landmarks of hypotheses: all combinations of K landmarks
+# while there are no more than max_hypotheses of them, otherwise max_hypotheses random ones
+def _hypothesis_samples(k, sample_size, max_hypotheses=64, seed=0):
+    combinations = list(itertools.islice(itertools.combinations(range(k), sample_size), max_hypotheses + 1))
+    if len(combinations) <= max_hypotheses:
+        return np.array(combinations, dtype=np.intp)
+    return np.random.RandomState(seed).rand(max_hypotheses, k).argsort(axis=1)[:, :sample_size]
+
+
+# can the transformation be fitted to (..., K, 2) points with (..., K) weights:
+# points with weight are not all in one place (SIMILARITY) or on one line (AFFINE)
+def _can_fit(points, weights, mode, eps=1e-12):
+    weights = weights / np.maximum(weights.sum(axis=-1, keepdims=True), eps)
+    mean = np.einsum('...k,...ki->...i', weights, points)
+    centered = points - mean[..., None, :]
+    cov = np.einsum('...k,...ki,...kj->...ij', weights, centered, centered)
+    if mode == 'SIMILARITY':
+        return np.trace(cov, axis1=-2, axis2=-1) > eps
+    return np.linalg.det(cov) > eps
+
+
+# 1 for landmarks that are where they should be, falls to 0 at threshold: (..., K) residuals -> (...)
+def get_confidence(residuals, threshold=ROBUST_THRESHOLD):
+    return np.mean(np.clip(1 - (np.asarray(residuals) / threshold) ** 2, 0, 1), axis=-1)
+
+
+# RANSAC version of fit_transforms(): hypotheses are fitted to minimal samples of landmarks
+# (2 for 'SIMILARITY', 3 for 'AFFINE'), all hypotheses of all avatars at once, and scored
+# by truncated squared residuals (MSAC). The best hypothesis is fitted again to its inliers.
+# threshold - residual of inliers, max_hypotheses - samples tried per avatar
+# (all combinations of landmarks when there are not more of them).
+# Returns (N, 3, 3) transformation matrices, (N, K) residuals, (N, K) inlier masks
+# and (N,) confidence (see get_confidence).
+def fit_transforms_robust(plane_points, photo_points, plane_AR=1.0, photo_AR=1.0, mode='SIMILARITY',
+                          threshold=ROBUST_THRESHOLD, max_hypotheses=64, seed=0):
+    src = np.asarray(plane_points, dtype=np.float64)
+    dst = np.asarray(photo_points, dtype=np.float64)
+    if src.ndim == 2:
+        src, dst = src[None], dst[None]
+    n, k = src.shape[:2]
+    if mode not in MIN_LANDMARKS:
+        raise ValueError("Give me correct fit mode: 'SIMILARITY' or 'AFFINE'")
+    if k < MIN_LANDMARKS[mode]:
+        raise ValueError("{} fit needs at least {} landmarks, got {}".format(mode, MIN_LANDMARKS[mode], k))
+    plane_AR = np.broadcast_to(np.asarray(plane_AR, dtype=np.float64), (n,))
+    photo_AR = np.broadcast_to(np.asarray(photo_AR, dtype=np.float64), (n,))
+    src_scaled = _scale_points_Y(src, plane_AR)
+    dst_scaled = _scale_points_Y(dst, photo_AR)
+
+    # (H, K) weights of landmarks of hypotheses, (N, H) hypotheses that can be fitted
+    samples = _hypothesis_samples(k, MIN_LANDMARKS[mode], max_hypotheses, seed)
+    weights = np.zeros((len(samples), k))
+    weights[np.arange(len(samples))[:, None], samples] = 1
+    valid = _can_fit(src_scaled[:, None], weights, mode)
+
+    hypotheses = np.tile(np.eye(3), (n, len(samples), 1, 1))
+    avatars, hyps = np.nonzero(valid)
+    if len(avatars):
+        hypotheses[avatars, hyps], _ = fit_transforms(src[avatars], dst[avatars], plane_AR[avatars],
+                                                      photo_AR[avatars], mode, weights[hyps])
+
+    # (N, H, K) residuals of every landmark under every hypothesis
+    residuals = np.linalg.norm(apply_transforms(hypotheses, src_scaled[:, None]) - dst_scaled[:, None], axis=-1)
+    cost = np.sum(np.minimum(residuals, threshold) ** 2, axis=-1)
+    cost[~valid] = np.inf
+    best = np.argmin(cost, axis=1)
+    t_mats = hypotheses[np.arange(n), best]
+    inliers = residuals[np.arange(n), best] < threshold
+
+    # fit again to all inliers of the best hypothesis
+    refit = _can_fit(src_scaled, inliers.astype(np.float64), mode) & (inliers.sum(axis=1) >= MIN_LANDMARKS[mode])
+    if refit.any():
+        t_mats[refit], _ = fit_transforms(src[refit], dst[refit], plane_AR[refit], photo_AR[refit], mode,
+                                          inliers[refit].astype(np.float64))
+
+    residuals = get_residuals(t_mats, src, dst, plane_AR, photo_AR)
+    return t_mats, residuals, residuals < threshold, get_confidence(residuals, threshold)
+
+
+# Robust align_landmarks(): eyeL, eyeR, mouth that don't agree with the others are left out.
+# Outliers are found by RANSAC with similarity (any two landmarks make a hypothesis) on aspect
+# ratio that is not compensated, as bad mouth would spoil scale_Y. scale_Y is found only when all
+# landmarks are inliers (1 otherwise), then the solver fits the transformation to the inliers
+# ('EYES' needs both eyes, otherwise similarity over inliers is used).
+# With three landmarks every pair of them fits exactly, so a single bad landmark can't be told
+# from the others by their residuals: the eyes are trusted (the first hypothesis wins a tie),
+# so a bad eye may keep its place and the good mouth is left out (see flag_alignments).
+# Returns t_mats, scale_Y, AR and residuals like align_landmarks(), (N, 3) inlier masks of
+# eyeL, eyeR, mouth and (N,) confidence (see get_confidence).
+def align_landmarks_robust(plane_points, plane_size, photo_points, photo_size, plane_AR, solver='EYES',
+                           threshold=ROBUST_THRESHOLD):
+    plane_uv, photo_uv, photo_AR = _landmarks_to_uv(plane_points, plane_size, photo_points, photo_size)
+    n = len(plane_uv)
+    plane_AR = np.broadcast_to(np.asarray(plane_AR, dtype=np.float64), (n,))
+    _, _, inliers, _ = fit_transforms_robust(plane_uv, photo_uv, plane_AR, photo_AR, 'SIMILARITY', threshold)
+    # too few inliers: nothing to choose from, confidence tells the rest
+    weights = np.where(inliers.sum(axis=1, keepdims=True) >= 2, inliers, True).astype(np.float64)
+
+    scale_Y = np.ones(n)
+    complete = inliers.all(axis=1)
+    if complete.any():
+        scale_Y[complete] = get_scale_Y(plane_uv[complete, 0], plane_uv[complete, 1], plane_uv[complete, 2],
+                                        photo_uv[complete, 0], photo_uv[complete, 1], photo_uv[complete, 2],
+                                        plane_AR[complete], photo_AR[complete])
+    AR = photo_AR * scale_Y
+
+    if solver == 'AFFINE':
+        AR = np.array(photo_AR)
+        affine = _can_fit(_scale_points_Y(plane_uv, plane_AR), weights, 'AFFINE')
+        exact = np.zeros(n, dtype=bool)
+    elif solver == 'EYES':
+        affine = np.zeros(n, dtype=bool)
+        exact = inliers[:, 0] & inliers[:, 1]
+    else:
+        affine = exact = np.zeros(n, dtype=bool)
+
+    t_mats = np.zeros((n, 3, 3))
+    if exact.any():
+        t_mats[exact] = get_affine_matrices(plane_uv[exact, 0], plane_uv[exact, 1], photo_uv[exact, 0],
+                                            photo_uv[exact, 1], plane_AR[exact], AR[exact])
+    if affine.any():
+        t_mats[affine], _ = fit_transforms(plane_uv[affine], photo_uv[affine], plane_AR[affine], AR[affine],
+                                           'AFFINE', weights[affine])
+    similarity = ~(exact | affine)
+    if similarity.any():
+        t_mats[similarity], _ = fit_transforms(plane_uv[similarity], photo_uv[similarity], plane_AR[similarity],
+                                               AR[similarity], 'SIMILARITY', weights[similarity])
+
+    residuals = get_residuals(t_mats, plane_uv, photo_uv, plane_AR, AR)
+    inliers = residuals < threshold
+    return t_mats, scale_Y, AR, residuals, inliers, get_confidence(residuals, threshold)
+
+
+# (N,) alignments that are not trusted: (N, K) inlier masks and (N,) confidence of align_landmarks_robust().
+# Confidence below min_confidence, or any outlier of no more than three landmarks
+# (the outlier may be the good one there, see align_landmarks_robust)
+def flag_alignments(inliers, confidence, min_confidence=MIN_CONFIDENCE):
+    inliers = np.asarray(inliers, dtype=bool)
+    flagged = np.asarray(confidence) < min_confidence
+    if inliers.shape[-1] <= 3:
+        flagged = flagged | ~inliers.all(axis=-1)
+    return flagged
+
+
+#######################################################################################
+### DENSE LANDMARKS: CORRESPONDENCE AND THIN-PLATE SPLINE UV WARP
+# Hundreds of mesh vertices projected on the plane are matched to (as many) photo landmarks
+# by their nearest neighbours once the plane landmarks are brought to the photo by the
+# similarity of eyes and mouth. A thin-plate spline through the matched pairs bends UVs
+# where a single transformation can't follow the face.
+
+# (M,) distances and indices of nearest of (K, 2) points for (M, 2) queries:
+# KD-tree of SciPy when it's there, otherwise brute force over chunks of queries
+def nearest_neighbors(points, queries, chunk_size=1024):
+    points = np.asarray(points, dtype=np.float64)
+    queries = np.asarray(queries, dtype=np.float64)
+    if cKDTree is not None:
+        return cKDTree(points).query(queries)
+    distances = np.empty(len(queries))
+    indices = np.empty(len(queries), dtype=np.intp)
+    for start in range(0, len(queries), chunk_size):
+        diff = queries[start:start + chunk_size, None] - points[None]
+        d2 = np.einsum('mki,mki->mk', diff, diff)
+        indices[start:start + chunk_size] = np.argmin(d2, axis=1)
+        distances[start:start + chunk_size] = np.sqrt(d2[np.arange(len(d2)), indices[start:start + chunk_size]])
+    return distances, indices
+
+
+# pairs of (K, 2) src and (P, 2) dst points that are nearest to each other (both ways)
+# and not further than max_distance: (Q,) indices of src and (Q,) indices of dst
+def match_nearest(src, dst, max_distance=np.inf):
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    if not len(src) or not len(dst):
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    distances, to_dst = nearest_neighbors(dst, src)
+    _, to_src = nearest_neighbors(src, dst)
+    matched = (to_src[to_dst] == np.arange(len(src))) & (distances <= max_distance)
+    return np.flatnonzero(matched), to_dst[matched]
+
+
+# radial basis of thin-plate spline of squared distances: r^2 * log(r)
+def _thin_plate_kernel(d2):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(d2 > 0, 0.5 * d2 * np.log(d2), 0)
+
+
+def _squared_distances(a, b):
+    diff = a[:, None] - b[None]
+    return np.einsum('mki,mki->mk', diff, diff)
+
+
+# Thin-plate spline that takes (K, 2) src points to (K, 2) dst points (exactly with smoothing = 0,
+# larger smoothing brings it closer to affine transformation). Needs 3 points that are not on one line.
+# Returns (control points (K, 2), weights (K, 2), affine part (3, 2))
+def fit_thin_plate(src, dst, smoothing=0.0):
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    k = len(src)
+    system = np.zeros((k + 3, k + 3))
+    system[:k, :k] = _thin_plate_kernel(_squared_distances(src, src)) + smoothing * np.eye(k)
+    system[:k, k] = system[k, :k] = 1
+    system[:k, k + 1:] = src
+    system[k + 1:, :k] = src.T
+    rhs = np.zeros((k + 3, 2))
+    rhs[:k] = dst
+    params = np.linalg.solve(system, rhs)
+    return src, params[:k], params[k:]
+
+
+# (M, 2) points moved by thin-plate spline (see fit_thin_plate), chunk by chunk of points
+def apply_thin_plate(tps, points, chunk_size=4096):
+    control, weights, affine = tps
+    points = np.asarray(points, dtype=np.float64)
+    moved = affine[0] + np.dot(points, affine[1:])
+    for start in range(0, len(points), chunk_size):
+        kernel = _thin_plate_kernel(_squared_distances(points[start:start + chunk_size], control))
+        moved[start:start + chunk_size] += np.dot(kernel, weights)
+    return moved
+
+
+# Thin-plate spline warp of the plane from dense landmarks:
+# plane_uv - (D, 2) UVs of mesh vertices projected on the plane (NaN for vertices that missed it),
+# photo_uv - (P, 2) UVs of photo landmarks, t_mat - transformation of align_landmarks() that brings
+# plane landmarks close enough to their photo landmarks to be matched by nearest neighbours
+# (not further than max_distance, in UV-space with Y scaled by aspect ratios like in the solvers).
+# Returns thin-plate spline (see warp_uvs) and (Q,) indices of matched plane and photo landmarks,
+# (None, ...) when fewer than 3 landmarks are matched.
+def fit_dense_warp(plane_uv, photo_uv, t_mat, plane_AR, photo_AR, max_distance=0.02, smoothing=0.0):
+    plane_uv = np.asarray(plane_uv, dtype=np.float64)
+    photo_uv = np.asarray(photo_uv, dtype=np.float64)
+    known = np.flatnonzero(np.isfinite(plane_uv).all(axis=1))
+    src = _scale_points_Y(plane_uv[known][None], plane_AR)[0]
+    dst = _scale_points_Y(photo_uv[None], photo_AR)[0]
+
+    plane_matched, photo_matched = match_nearest(apply_transforms(t_mat, src), dst, max_distance)
+    if len(plane_matched) < 3 or not _can_fit(src[plane_matched], np.ones(len(plane_matched)), 'AFFINE'):
+        return None, known[plane_matched], photo_matched
+    tps = fit_thin_plate(src[plane_matched], dst[photo_matched], smoothing)
+    return tps, known[plane_matched], photo_matched
+
+
+# transform_uvs() with thin-plate spline of fit_dense_warp() instead of matrix
+def warp_uvs(uvs, tps, plane_AR, photo_AR):
+    uvs = np.asarray(uvs)
+    warped = apply_thin_plate(tps, np.asarray(uvs, dtype=np.float64) * [1, plane_AR]) / [1, photo_AR]
+    return warped.astype(uvs.dtype)
+
+
+#######################################################################################
+### RAY - PLANE INTERSECTION
+# origins, directions - (M, 3) rays; plane_co, plane_no - any point on the plane and its normal.
+# Returns (M, 3) intersections and (M,) ray parameters 'lambda' (point = origin + lambda*direction).
+# Rays that are parallel to the plane or point away from it give NaN.
+# Several planes at once: (T, M, 3) rays and (T, 3) points and normals give (T, M, 3) and (T, M).
+def intersect_rays_plane(origins, directions, plane_co, plane_no):
+    origins = np.atleast_2d(np.asarray(origins, dtype=np.float64))
+    directions = np.atleast_2d(np.asarray(directions, dtype=np.float64))
+    plane_co = np.asarray(plane_co, dtype=np.float64)[..., None, :]
+    plane_no = np.asarray(plane_no, dtype=np.float64)[..., None, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lam = np.sum((plane_co - origins) * plane_no, axis=-1) / np.sum(directions * plane_no, axis=-1)
+    lam = np.where(np.isfinite(lam) & (lam >= 0), lam, np.nan)
+    return origins + lam[..., None] * directions, lam
+
+
+#######################################################################################
+### CAMERA PROJECTION (same conventions as Blender's camera)
+# Alignment casts rays from the camera straight through 3D points (get_point_rays), it needs only
+# 'matrix_world' and 'type' of the camera (see get_camera_params() in uv_alignment_functions.py).
+# Projection to pixels and back (get_camera_intrinsics, project_points, get_camera_rays) is used only
+# by tests and bench_alignment.py to check these rays, it needs a dict with all parameters of the camera:
+#   'matrix_world' - 4x4 world matrix of camera object (camera looks along its local -Z, Y is up)
+#   'type' - 'PERSP' or 'ORTHO', 'lens' - focal length in mm, 'ortho_scale'
+#   'sensor_width', 'sensor_height' in mm, 'sensor_fit' - 'AUTO', 'HORIZONTAL' or 'VERTICAL'
+#   'shift_x', 'shift_y' - lens shift
+#   'resolution_x', 'resolution_y' - render resolution in pixels (with resolution percentage applied)
+#   'pixel_aspect_x', 'pixel_aspect_y'
+# Pixel coordinates have origin in the top left corner of the render and Y pointing down
+# (like coordinates of landmarks on the photo).
+
+# focal lengths and principal point in pixels: fx, fy, cx, cy
+# (for orthographic camera fx, fy are pixels per unit)
+def get_camera_intrinsics(camera):
+    res_x, res_y = camera['resolution_x'], camera['resolution_y']
+    pixel_aspect = camera['pixel_aspect_y'] / camera['pixel_aspect_x']
+
+    sensor_fit = camera['sensor_fit']
+    sensor_size = camera['sensor_height'] if sensor_fit == 'VERTICAL' else camera['sensor_width']
+    if sensor_fit == 'AUTO':
+        sensor_fit = 'HORIZONTAL' if res_x * camera['pixel_aspect_x'] >= res_y * camera['pixel_aspect_y'] else 'VERTICAL'
+    view_fac = res_x if sensor_fit == 'HORIZONTAL' else pixel_aspect * res_y
+
+    if camera['type'] == 'PERSP':
+        pixel_size = sensor_size / camera['lens'] / view_fac
+    elif camera['type'] == 'ORTHO':
+        pixel_size = camera['ortho_scale'] / view_fac
+    else:
+        raise ValueError("Give me 'PERSP' or 'ORTHO' camera, not '{}'".format(camera['type']))
+
+    fx = 1 / pixel_size
+    fy = fx / pixel_aspect
+    cx = res_x / 2 - camera['shift_x'] * view_fac
+    cy = res_y / 2 + camera['shift_y'] * view_fac / pixel_aspect
+    return fx, fy, cx, cy
+
+
+# camera location and rotation (scale of camera object does not affect projection)
+def _camera_frame(camera):
+    matrix_world = np.asarray(camera['matrix_world'], dtype=np.float64)
+    rotation = matrix_world[:3, :3] / np.linalg.norm(matrix_world[:3, :3], axis=0)
+    return matrix_world[:3, 3], rotation
+
+
+# project (M, 3) world points into the camera, returns (M, 2) pixel coordinates
+def project_points(points, camera):
+    location, rotation = _camera_frame(camera)
+    fx, fy, cx, cy = get_camera_intrinsics(camera)
+    points_cam = np.dot(np.atleast_2d(np.asarray(points, dtype=np.float64)) - location, rotation)
+
+    depth = -points_cam[:, 2] if camera['type'] == 'PERSP' else 1.0
+    return np.stack((cx + fx * points_cam[:, 0] / depth,
+                     cy - fy * points_cam[:, 1] / depth), axis=1)
+
+
+# rays from the camera through (M, 2) pixel coordinates.
+# Returns (M, 3) origins and (M, 3) unit directions in world space
+def get_camera_rays(pixels, camera):
+    location, rotation = _camera_frame(camera)
+    fx, fy, cx, cy = get_camera_intrinsics(camera)
+    pixels = np.atleast_2d(np.asarray(pixels, dtype=np.float64))
+    x = (pixels[:, 0] - cx) / fx
+    y = (cy - pixels[:, 1]) / fy
+
+    if camera['type'] == 'PERSP':
+        directions = np.dot(np.stack((x, y, -np.ones_like(x)), axis=1), rotation.T)
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        origins = np.broadcast_to(location, directions.shape).copy()
+    else:
+        origins = location + np.dot(np.stack((x, y, np.zeros_like(x)), axis=1), rotation.T)
+        directions = np.broadcast_to(-rotation[:, 2], origins.shape).copy()
+    return origins, directions
+
+
+# Rays from T cameras through (M, 3) world points: the same rays as get_camera_rays gives
+# for pixels of project_points, but for all cameras at once and without going through pixels.
+# Returns (T, M, 3) origins and (T, M, 3) unit directions
+def get_point_rays(points, cameras):
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    frames = [_camera_frame(camera) for camera in cameras]
+    locations = np.array([location for location, _ in frames])[:, None]
+    # cameras look along their local -Z
+    forwards = -np.array([rotation[:, 2] for _, rotation in frames])[:, None]
+    perspective = np.array([camera['type'] == 'PERSP' for camera in cameras])[:, None, None]
+    for camera in cameras:
+        if camera['type'] not in ('PERSP', 'ORTHO'):
+            raise ValueError("Give me 'PERSP' or 'ORTHO' camera, not '{}'".format(camera['type']))
+
+    to_points = points - locations
+    with np.errstate(divide='ignore', invalid='ignore'):
+        persp_directions = to_points / np.linalg.norm(to_points, axis=2, keepdims=True)
+    # orthographic rays start on the plane of the camera
+    ortho_origins = points - np.sum(to_points * forwards, axis=2, keepdims=True) * forwards
+
+    origins = np.where(perspective, np.broadcast_to(locations, to_points.shape), ortho_origins)
+    directions = np.where(perspective, persp_directions, np.broadcast_to(forwards, to_points.shape))
+    return origins, directions
+
+
+#######################################################################################
+### APPLY AFFINE TRANSFORMATION TO UV COORDINATES
+# uvs - (M, 2) UV-coordinates of the plane (e.g. the whole UV layer read with foreach_get)
+# Same as transform_UV() in uv_alignment_functions.py for every UV-coordinate:
+#   uv_tr = t_mat * (u, v*plane_AR, 1)
+#   (u, v) = (uv_tr[0], uv_tr[1]/photo_AR)
+# but with aspect ratios folded into the matrix, so it's a single matrix product for all of them.
+# With (F, 3, 3) matrices (and aspect ratios scalars or (F,)) returns (F, M, 2) UVs of every frame.
+def transform_uvs(uvs, t_mat, plane_AR, photo_AR):
+    uv_mat = get_uv_matrix(t_mat, plane_AR, photo_AR)
+    uvs = np.asarray(uvs)
+    return (np.matmul(uvs, np.swapaxes(uv_mat[..., :2, :2], -1, -2).astype(uvs.dtype))
+            + uv_mat[..., None, :2, 2].astype(uvs.dtype))
+
+
+# 3x3 matrix that takes UV-coordinates of the plane straight to aligned UV-coordinates
+# (t_mat with aspect ratios folded in): (u, v, 1)_aligned = uv_mat * (u, v, 1)
+# (F, 3, 3) matrices for (F, 3, 3) t_mats.
+def get_uv_matrix(t_mat, plane_AR, photo_AR):
+    uv_mat = np.array(t_mat, dtype=np.float64)
+    # diag(1, 1/photo_AR, 1) * t_mat * diag(1, plane_AR, 1)
+    uv_mat[..., 1, :] /= np.asarray(photo_AR, dtype=np.float64)[..., None]
+    uv_mat[..., :, 1] *= np.asarray(plane_AR, dtype=np.float64)[..., None]
+    return uv_mat
+
+
+#######################################################################################
+### SEQUENCES OF FRAMES (photo or video sequence of one avatar)
+# temporal smoothing of (F, K, 2) landmark tracks: centered moving average
+# over 2*radius + 1 frames (the window is cut at the ends of the sequence)
+def smooth_tracks(tracks, radius=0):
+    tracks = np.asarray(tracks, dtype=np.float64)
+    if radius <= 0:
+        return tracks.copy()
+    sums = np.concatenate((np.zeros((1,) + tracks.shape[1:]), np.cumsum(tracks, axis=0)))
+    frames = np.arange(len(tracks))
+    start = np.maximum(frames - radius, 0)
+    end = np.minimum(frames + radius + 1, len(tracks))
+    return (sums[end] - sums[start]) / (end - start).reshape((-1,) + (1,) * (tracks.ndim - 1))
+
+
+# Frames where no landmark moved further than 'tolerance' (pixels) from the last solved frame
+# reuse its solution. Returns (F,) index of the solved frame that every frame uses.
+def find_reused_frames(tracks, tolerance=0.0):
+    tracks = np.asarray(tracks, dtype=np.float64)
+    sources = np.arange(len(tracks))
+    solved = 0
+    for frame in range(1, len(tracks)):
+        if np.linalg.norm(tracks[frame] - tracks[solved], axis=-1).max() <= tolerance:
+            sources[frame] = solved
+        else:
+            solved = frame
+    return sources
+
+
+# align_landmarks() for every frame of a sequence: plane_points (3, 2) are the same for all frames,
+# tracks - (F, 4, 2) eR, eL, mR, mL of every frame in pixels, smoothing - radius of smooth_tracks(),
+# tolerance - see find_reused_frames(). Frames that don't reuse a solution are solved in one batch.
+# Returns (F, 3, 3) t_mats, (F,) scale_Y, (F,) AR, (F, 3) residuals (of the solved frame
+# each frame uses) and (F,) index of that frame.
+def align_sequence(plane_points, plane_size, tracks, photo_size, plane_AR, solver='EYES', smoothing=0, tolerance=0.0):
+    tracks = smooth_tracks(tracks, smoothing)
+    sources = find_reused_frames(tracks, tolerance)
+    solved = np.unique(sources)
+    plane_points = np.broadcast_to(np.asarray(plane_points, dtype=np.float64), (len(solved), 3, 2))
+    t_mats, scale_Y, AR, residuals = align_landmarks(plane_points, plane_size, tracks[solved], photo_size,
+                                                     plane_AR, solver)
+    index = np.searchsorted(solved, sources)
+    return t_mats[index], scale_Y[index], AR[index], residuals[index], sources
+
+
+#######################################################################################
+### EVALUATION OF MESH LANDMARKS
+# apply 4x4 matrix to (K, 3) points
+def transform_points(matrix, points):
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return np.dot(np.atleast_2d(np.asarray(points, dtype=np.float64)), matrix[:3, :3].T) + matrix[:3, 3]
+
+
+# 4x4 matrix of location, rotation (XYZ euler, radians) and scale
+# (what Blender builds from object's location, rotation_euler and scale)
+def compose_matrix(location, rotation, scale):
+    (cx, cy, cz), (sx, sy, sz) = np.cos(rotation), np.sin(rotation)
+    rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+
+    matrix = np.eye(4)
+    matrix[:3, :3] = np.dot(np.dot(rot_z, rot_y), rot_x) * np.asarray(scale, dtype=np.float64)
+    matrix[:3, 3] = location
+    return matrix
+
+
+# linear blend skinning the way Blender's armature modifier does it (vertex groups only)
+# points - (K, 3) coordinates in armature space
+# weights - (K, B) weights of points in vertex groups of deforming bones
+# bone_matrices - (B, 4, 4) deform matrices of bones: pose matrix * inverted rest matrix
+# Weights are normalized, points that belong to no bone stay in place.
+def skin_points(points, weights, bone_matrices):
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    weights = np.asarray(weights, dtype=np.float64)
+    bone_matrices = np.asarray(bone_matrices, dtype=np.float64)
+
+    # (B, K, 3) every point deformed by every bone
+    deformed = np.einsum('bij,kj->bki', bone_matrices[:, :3, :3], points) + bone_matrices[:, None, :3, 3]
+    total = weights.sum(axis=1)
+    skinned = np.einsum('kb,bki->ki', weights, deformed)
+    has_bones = total > 0
+    skinned[has_bones] /= total[has_bones, None]
+    skinned[~has_bones] = points[~has_bones]
+    return skinned
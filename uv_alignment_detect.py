@@ -0,0 +1,161 @@
+# Landmarks of photos found on the photos themselves, for avatars without photo.bpt.xml.
+#
+# run with: 'python uv_alignment_detect.py <shape_predictor_68_face_landmarks.dat> <directory with photos> <table>.npy'
+# to detect landmarks of all photos of a directory into one table (the same as of uv_alignment_landmarks.py,
+# pass it to uv_alignment_batch.py with --landmark-table).
+#
+# Faces are found by dlib (HOG detector and 68-point shape predictor, iBUG 300-W layout), on CPU.
+# Photos are decoded by PIL already downscaled to about max_size (JPEG is decoded at 1/2, 1/4 or 1/8
+# of its size without decoding all pixels) and in grayscale, points are scaled back to pixels of the photo.
+# Photos are spread over a pool of worker processes in chunks, every worker loads the model once.
+# dlib and PIL are needed only for detection, not for the rest of the alignment.
+
+import argparse
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import dlib
+except ImportError:
+    dlib = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from uv_alignment_landmarks import PHOTO_LANDMARKS, avatar_id, make_landmark_table, save_landmark_table
+
+
+# points of 68-point shape that make eR, eL, mR, mL (right/left of the person like in photo.bpt.xml):
+# eyes are centers of their six points, mouth corners are single points
+SHAPE_LANDMARKS = OrderedDict((('eR', list(range(36, 42))), ('eL', list(range(42, 48))),
+                               ('mR', [48]), ('mL', [54])))
+
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# columns of the table of detected landmarks, they're named like the columns
+DETECTED_COLUMNS = OrderedDict((name, name) for name in PHOTO_LANDMARKS)
+
+
+# eR, eL, mR, mL (..., 4, 2) from points of 68-point shapes (..., 68, 2)
+# found on photo downscaled by 'scale' (size of detected image / size of photo, scalar or (X, Y))
+def shape_to_landmarks (shapes, scale=1.0):
+    shapes = np.asarray(shapes, dtype=np.float64)
+    if shapes.shape[-2:] != (68, 2):
+        raise ValueError ("Expected 68 points (..., 68, 2), got {}".format(shapes.shape))
+    landmarks = np.stack([shapes[..., indices, :].mean(axis=-2) for indices in SHAPE_LANDMARKS.values()], axis=-2)
+    # center of pixel of downscaled image is in the center of its block of pixels of the photo
+    return (landmarks + 0.5) / scale - 0.5
+
+
+def _require_detection ():
+    if dlib is None or Image is None:
+        raise ImportError ("Landmark detection needs dlib and PIL (pip install dlib pillow)")
+
+
+# grayscale pixels (H, W) of photo decoded at about max_size and its scale (X, Y) (size of pixels / size of photo)
+def load_photo (path, max_size=640):
+    _require_detection ()
+    image = Image.open(path)
+    size = image.size
+    # JPEG: pick the smallest DCT scale that is still bigger than max_size
+    image.draft('L', (max_size, max_size))
+    image = image.convert('L')
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.BILINEAR)
+    return np.asarray(image), np.array(image.size, dtype=np.float64) / size
+
+
+#######################################################################################
+### WORKERS
+# model of the worker process (loaded once by init_worker)
+_detector = None
+_predictor = None
+
+
+def init_worker (predictor_path):
+    global _detector, _predictor
+    _require_detection ()
+    _detector = dlib.get_frontal_face_detector()
+    _predictor = dlib.shape_predictor(predictor_path)
+
+
+# 68 points (68, 2) of the biggest face on the pixels, None if there's no face
+def detect_shape (pixels, upsample=0):
+    faces = _detector(pixels, upsample)
+    if not len(faces):
+        return None
+    face = max(faces, key=lambda rect: rect.width() * rect.height())
+    shape = _predictor(pixels, face)
+    return np.array([(shape.part(i).x, shape.part(i).y) for i in range(shape.num_parts)], dtype=np.float64)
+
+
+# (path, eR, eL, mR, mL (4, 2) in pixels of the photo or None) of one photo
+def detect_photo (path, max_size=640, upsample=0):
+    pixels, scale = load_photo (path, max_size)
+    shape = detect_shape (pixels, upsample)
+    return path, None if shape is None else shape_to_landmarks (shape, scale)
+
+
+def _detect_photo (args):
+    return detect_photo (*args)
+
+
+# landmarks of photos: OrderedDict path -> (4, 2) or None, in order of paths.
+# Photos go to 'workers' processes in chunks of 'chunk_size'
+def detect_landmarks (paths, predictor_path, workers=None, max_size=640, upsample=0, chunk_size=8):
+    tasks = [(path, max_size, upsample) for path in paths]
+    if workers == 1:
+        init_worker (predictor_path)
+        return OrderedDict(map(_detect_photo, tasks))
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(predictor_path,)) as pool:
+        return OrderedDict(pool.imap(_detect_photo, tasks, chunksize=chunk_size))
+
+
+# is it photo of avatar directory: <avatar>/photo.jpg (or .jpeg, .png)
+def is_avatar_photo (path):
+    return os.path.splitext(os.path.basename(path))[0].lower() == 'photo'
+
+
+# all photos in the directory (and its subdirectories). Directory of avatar (with photo.jpg, .jpeg or .png)
+# gives only its photo, other images there (Head1.jpg...) are textures, not photos
+def find_photos (directory):
+    for dir_path, _, file_names in sorted(os.walk(directory)):
+        images = [file_name for file_name in sorted(file_names) if file_name.lower().endswith(PHOTO_EXTENSIONS)]
+        photos = [file_name for file_name in images if is_avatar_photo (file_name)]
+        for file_name in photos[:1] or images:
+            yield os.path.join(dir_path, file_name)
+
+
+# table of landmarks (see uv_alignment_landmarks.py) of detected landmarks: dict path -> (4, 2) or None,
+# avatar of photo is the name of its directory for <avatar>/photo.jpg (.jpeg, .png), otherwise its file name
+def detected_landmark_table (detected):
+    landmarks = OrderedDict()
+    for path, points in detected.items():
+        avatar = avatar_id (os.path.join(os.path.dirname(path), 'photo.bpt.xml') if is_avatar_photo (path) else path)
+        landmarks[avatar] = None if points is None else dict(zip(DETECTED_COLUMNS, points.tolist()))
+    return make_landmark_table (landmarks, DETECTED_COLUMNS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect landmarks of photos of a directory into one table")
+    parser.add_argument("predictor", help="dlib shape predictor (shape_predictor_68_face_landmarks.dat)")
+    parser.add_argument("directory")
+    parser.add_argument("table")
+    parser.add_argument("--workers", type=int, help="number of processes (default: number of CPUs)")
+    parser.add_argument("--max-size", type=int, default=640, help="photos are decoded downscaled to about this size")
+    parser.add_argument("--upsample", type=int, default=0, help="upsample images for detection of small faces")
+    parser.add_argument("--chunk-size", type=int, default=8, help="photos sent to a worker at once")
+    args = parser.parse_args()
+
+    detected = detect_landmarks (list(find_photos (args.directory)), args.predictor, args.workers,
+                                 args.max_size, args.upsample, args.chunk_size)
+    table = detected_landmark_table (detected)
+    save_landmark_table (table, args.table)
+    missing = [path for path, points in detected.items() if points is None]
+    for path in missing:
+        print ("No face on '{}'".format(path))
+    print ("{} photos, {} without face, written to {}".format(len(table), len(missing), args.table))
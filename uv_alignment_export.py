@@ -0,0 +1,84 @@
+# Outputs of alignment and skipping of the ones that would not change.
+#
+# Every written output gets a fingerprint file next to it (<output>.fingerprint) with SHA-256
+# of everything the output is made of (UV buffer, export settings...). Incremental export
+# doesn't write the output again while its fingerprint stays the same.
+#
+# Besides FBX with the whole FotoPlane there are two light outputs for engines that
+# only need to change UVs of their own plane:
+#   <name>.uv.npy  - UV layer of aligned FotoPlane, (M, 2) float32 in order of loops
+#   <name>.uv.json - {"uv_matrix": 3x3, "t_mat": 3x3, "plane_AR", "photo_AR"},
+#                    where (u, v, 1)_aligned = uv_matrix * (u, v, 1) (see get_uv_matrix in uv_alignment_core.py)
+#   <name>.texture.npy - photo rewarped to default UVs of FotoPlane (see uv_alignment_rewarp.py)
+# Aligned sequence (see match_sequence_with_3D in uv_alignment_functions.py) has UV layers of all
+# frames (F, M, 2) in .uv.npy and lists of F matrices and photo_AR and "frames" in .uv.json.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from uv_alignment_core import get_uv_matrix
+
+
+# SHA-256 of arrays (their dtype, shape and content) and JSON values
+def export_fingerprint (*parts):
+    sha = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            sha.update(json.dumps([part.dtype.str, part.shape]).encode())
+            sha.update(part.tobytes())
+        else:
+            sha.update(json.dumps(part, sort_keys=True).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def fingerprint_path (path):
+    return path + '.fingerprint'
+
+
+# is output at path written from content with this fingerprint
+def is_up_to_date (path, fingerprint):
+    try:
+        with open(fingerprint_path(path)) as f:
+            return f.read().strip() == fingerprint and os.path.exists(path)
+    except IOError:
+        return False
+
+
+def mark_exported (path, fingerprint):
+    with open(fingerprint_path(path), 'w') as f:
+        f.write(fingerprint + '\n')
+
+
+# write(path) the output unless (incremental and) it's up to date, returns was it written
+def export_if_changed (path, fingerprint, write, incremental=True):
+    if incremental and is_up_to_date(path, fingerprint):
+        return False
+    # fingerprint of output that is being rewritten is not valid anymore
+    if os.path.exists(fingerprint_path(path)):
+        os.remove(fingerprint_path(path))
+    write(path)
+    mark_exported(path, fingerprint)
+    return True
+
+
+# (M, 2) UVs or (F, M, 2) UVs of frames
+def save_uvs (path, uvs):
+    uvs = np.asarray(uvs, dtype=np.float32)
+    with open(path, 'wb') as f:
+        np.save(f, uvs if uvs.ndim == 3 else uvs.reshape(-1, 2))
+
+
+# t_mat 3x3 or (F, 3, 3) of 'frames' (then photo_AR is (F,))
+def save_uv_matrix (path, t_mat, plane_AR, photo_AR, frames=None):
+    t_mat = np.asarray(t_mat, dtype=np.float64)
+    matrix = {'uv_matrix': get_uv_matrix(t_mat, plane_AR, photo_AR).tolist(), 't_mat': t_mat.tolist(),
+              'plane_AR': float(plane_AR), 'photo_AR': np.asarray(photo_AR, dtype=np.float64).tolist()}
+    if frames is not None:
+        matrix['frames'] = [int(frame) for frame in frames]
+    with open(path, 'w') as f:
+        json.dump(matrix, f, indent=1)
@@ -8,11 +8,23 @@
 #
 # v.01 We rely on left and rigth eyes to be our predefined landmarks
 
-import bpy, bmesh
+import os
+import bpy
+import bmesh
+import numpy as np
 from mathutils import Vector, Matrix
-from mathutils.geometry import intersect_ray_tri
-from bpy_extras.view3d_utils import region_2d_to_vector_3d
-from bpy_extras.view3d_utils import location_3d_to_region_2d
+from mathutils.bvhtree import BVHTree
+from uv_alignment_core import to_uv, get_affine_matrices, align_landmarks, align_landmarks_robust
+from uv_alignment_core import flag_alignments, MIN_CONFIDENCE
+from uv_alignment_core import fit_dense_warp, warp_uvs
+from uv_alignment_core import intersect_rays_plane, get_point_rays, transform_uvs, align_sequence, get_uv_matrix
+from uv_alignment_core import transform_points, compose_matrix, skin_points
+from uv_alignment_obj import read_obj_vertices
+from uv_alignment_images import read_image_size, file_signature
+from uv_alignment_profile import Profiler
+from uv_alignment_cache import plane_key, photo_key
+from uv_alignment_export import export_fingerprint, export_if_changed, save_uvs, save_uv_matrix
+from uv_alignment_rewarp import load_photo_pixels, rewarp_photo_to_file
 
 # Briefly, our approach is the following:
 # 1. Find projection of mesh's landmarks on photo_plane
@@ -31,245 +43,636 @@ from bpy_extras.view3d_utils import location_3d_to_region_2d
 # transform UV of Girl's FotoPlane based on morphed eyes and coordinates of eyes on photo:
 # lx, ly, rx, ry - left eye X, left eye Y, right eye X, right eye Y,
 # where X = 0, Y = 0 in the tob left corner of the photo. Y points downwards.
+# solver - 'EYES': exact solve from two eyes (mouth only used for scale_Y compensation)
+#          'SIMILARITY': least-squares similarity over eyes and mouth (with scale_Y compensation)
+#          'AFFINE': least-squares 6-DOF affine over eyes and mouth (no scale_Y compensation needed)
+# fbx_path - where to export FotoPlane (see export_object_to_FBX for default)
+# outputs - what to export: 'FBX', 'UV', 'MATRIX' (see export_alignment),
+# incremental - don't export outputs that would not change
+# profiler - Profiler (see uv_alignment_profile.py) that records stages of alignment
+# cache - TransformCache (see uv_alignment_cache.py): landmarks on FotoPlane (and transformation)
+#         of the same shape keys and scene are taken from it, so shape keys are not applied and
+#         no landmarks are evaluated or projected
+# robust_threshold - landmarks that are further than this from their place after alignment are
+#                    left out (UV-space, see align_landmarks_robust in uv_alignment_core.py),
+#                    None - all landmarks are trusted
+# min_confidence - with robust_threshold, alignment with lower confidence or with any landmark left out
+#                  is flagged (see flag_alignments in uv_alignment_core.py): UVs of the plane
+#                  are not changed and nothing is exported
+# Returns dict with results of alignment: 't_mat', 'scale_Y', 'AR', 'residuals', 'fbx_path',
+# 'outputs' ({output: path}), 'written' (outputs that were exported),
+# 'timings' of stages in seconds and 'cached' (were landmarks on FotoPlane taken from cache),
+# dense_vertices - indices of many vertices of Head that are matched to dense_landmarks - (P, 2) landmarks
+#                  on the photo in pixels, the plane is warped by thin-plate spline through the matched
+#                  landmarks (see fit_dense_warp in uv_alignment_core.py) instead of a single transformation
+# with robust_threshold also 'inliers' (eyeL, eyeR, mouth), 'confidence' and 'flagged',
+# with dense landmarks also 'dense_matches' (number of matched landmarks)
 #def match_foto_with_3D (lx, ly, rx, ry, fbx_path, shapekey_eyes_path, shapekey_head_path, location, rotation, scale, plane_AR):
-def match_foto_with_3D (eR, eL, mR, mL, gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale, plane_AR):
+def match_foto_with_3D (eR, eL, mR, mL, gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale, plane_AR,
+                        solver='EYES', fbx_path=None, profiler=None, cache=None, outputs=('FBX',), incremental=False,
+                        robust_threshold=None, min_confidence=MIN_CONFIDENCE, dense_vertices=None, dense_landmarks=None):
 
     scene = bpy.context.scene
 
-    # finding eyes object of skinned character
-    skinned_eyes_obj = bpy.data.objects["Eyes"]
-
-    # finding head object of skinned character
-    skinned_head_obj = bpy.data.objects["Head"]
-
-    # finding plane with photo of character
-    photo_plane = scene.objects.get('{}FotoPlane'.format(gender))
-
-    # finding camera looking at character 
-    cam = scene.objects.get('cam')
-
-    # Setting size of FotoPlane. 
-    # Because origin is in the center, I need sum length in positive and negative direction
-    photo_plane_size = 4.71391 * 2 # width/height of the BoyFotoPlane in units (because width=height)
-
-    #########################################################################################################################
-    ### DEALING WITH 3D POINTS (POINTS ON photo_plane)
-
-    # import and apply shape key to eyes
-    apply_shapekey (shapekey_eyes_path, skinned_eyes_obj)
-    # import and apply shape key to head
-    apply_shapekey (shapekey_head_path, skinned_head_obj)
-
-    # applying skin to eyes/mouth
-    eyes_obj = convert_skinned_mesh_to_mesh (skinned_eyes_obj)
-    head_obj = convert_skinned_mesh_to_mesh (skinned_head_obj)
-
-    # applying character specific transormation to align baked eyes/mouth with skinned eyes/mouth
-    apply_transformations (eyes_obj, location, rotation, scale)
-    apply_transformations (head_obj, location, rotation, scale)
-
-    # Getting world coordinates of 3D eyes'/mouth's mesh (our landmarks)
-    # vertex 192 - center of left eye
-    eyeL_3D_world = eyes_obj.matrix_world * eyes_obj.data.vertices[192].co
-    # vertex 385 - center of right eye
-    eyeR_3D_world = eyes_obj.matrix_world * eyes_obj.data.vertices[385].co 
-    # vertex 1211 - middle of mouth
-    mouth_3D_world = head_obj.matrix_world * head_obj.data.vertices[1211].co
-    draw_cross (mouth_3D_world)
-
-    # find coordinates on FotoPlane (local space) of 3D mesh landmarks
-    eyeL_3D_plane = convert_point3D_to_point2D_w_same_screen_co (eyeL_3D_world, cam, photo_plane)
-    eyeR_3D_plane = convert_point3D_to_point2D_w_same_screen_co (eyeR_3D_world, cam, photo_plane)
-    mouth_3D_plane = convert_point3D_to_point2D_w_same_screen_co (mouth_3D_world, cam, photo_plane)
-
-    # Converting 3D coordinates to 2D point.
-    # Because I need only local axis X and Z (Y = 0 for all vertices)
-    eyeL_plane = Vector ((eyeL_3D_plane[0], eyeL_3D_plane[2]))
-    eyeR_plane = Vector ((eyeR_3D_plane[0], eyeR_3D_plane[2]))
-    mouth_plane = Vector ((mouth_3D_plane[0], mouth_3D_plane[2]))
-
-    # Convert plane landmark to UV-coordinates: (0,0) is bottom left, (1,1) is top right
-    # Plane origin is located at center and y-axis points down
-    eyeL_plane_uv = convert_to_uv (eyeL_plane, photo_plane_size, photo_plane_size, 'CENTER', 'DOWN')
-    print ("Left Eye Plane normalized coordinates =", eyeL_plane_uv)
-
-    eyeR_plane_uv = convert_to_uv (eyeR_plane, photo_plane_size, photo_plane_size, 'CENTER', 'DOWN')
-    print ("Right Eye Plane normalized coordinates =", eyeR_plane_uv)
-
-    mouth_plane_uv = convert_to_uv (mouth_plane, photo_plane_size, photo_plane_size, 'CENTER', 'DOWN')
+    # camera looking at character, plane with photo of character and the photo
+    target = {'camera': scene.objects.get('cam'),
+              'plane': scene.objects.get('{}FotoPlane'.format(gender)),
+              'image': bpy.data.images['Foto'],
+              'landmarks': (eR, eL, mR, mL),
+              'plane_AR': plane_AR,
+              'fbx_path': fbx_path,
+              'dense_landmarks': dense_landmarks}
+
+    return match_targets_with_3D ([target], gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale,
+                                  solver, profiler, cache, outputs, incremental, robust_threshold, min_confidence,
+                                  dense_vertices)[0]
+
+
+# transform UV of several planes with photos of the same character (other cameras, other shots)
+# in one pass: shape keys are applied and landmarks of 3D mesh are evaluated once for all of them.
+# targets - list of dicts:
+#   'camera' - camera object, 'plane' - plane object with photo, 'image' - image of the photo,
+#   'landmarks' - eR, eL, mR, mL on the photo, 'plane_AR' - aspect ratio of the plane,
+#   'fbx_path' - where to export the plane (optional, see export_object_to_FBX for default)
+#   'dense_landmarks' - (P, 2) dense landmarks of the photo (optional, see match_foto_with_3D)
+# dense_max_distance, dense_smoothing - see fit_dense_warp in uv_alignment_core.py
+# Other arguments are the same as of match_foto_with_3D.
+# Returns list of results (see match_foto_with_3D) in order of targets.
+def match_targets_with_3D (targets, gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale,
+                           solver='EYES', profiler=None, cache=None, outputs=('FBX',), incremental=False,
+                           robust_threshold=None, min_confidence=MIN_CONFIDENCE, dense_vertices=None,
+                           dense_max_distance=0.02, dense_smoothing=0.0):
+
+    profiler = profiler or Profiler ()
+
+    # crosses of previous avatar
+    clear_debug_markers ()
+
+    planes, plane_sizes, plane_points, keys, entries, dense_points = find_plane_points (
+        targets, gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale, profiler, cache,
+        dense_vertices)
 
     #########################################################################################################################
     ### DEALING WITH 2D POINTS (POINTS ON FOTO)
 
-    # reload Foto file
+    # reload Foto file (and any other image whose file has changed)
     # bpy.ops.image.reload () # old methond (not worked)
-    images = bpy.data.images
-    for img in images:
-        img.reload()
-
-    # finding width and height of Foto of character
-    photo_width = bpy.data.images['Foto'].size[0]   # width of the photo in pixels
-    photo_height = bpy.data.images['Foto'].size[1]  # height of the photo in pixels
-    
-    # normalizing coordinates of left eye on the photo. 
-    # In other words, I'm looking UV coordinates of eyes on foto
-    eyeL_photo_uv = convert_to_uv (eL, photo_width, photo_height, 'TOPLEFT', 'DOWN')
-    print ("Left Eye Foto normalized coordinates =", eyeL_photo_uv)
-
-    # normalizing coordinates of right eye on the photo
-    eyeR_photo_uv = convert_to_uv (eR, photo_width, photo_height, 'TOPLEFT', 'DOWN')
-    print ("Right Eye Foto normalized coordinates =", eyeR_photo_uv)
+    with profiler.stage ('image_reload'):
+        reload_changed_images ()
 
-    # getting coordinates of the point in the middle of mouth
-    mouth_photo = (mL + mR)/2
-
-    # normalizing coordinates of right eye on the photo
-    mouth_photo_uv = convert_to_uv (mouth_photo, photo_width, photo_height, 'TOPLEFT', 'DOWN')
+    # finding width and height of photos (in pixels)
+    photo_sizes = np.array([get_image_size (target['image']) for target in targets], dtype=np.float64)
 
     #########################################################################################################################
-    ### SCALE VERTICAL ONLY (to compensate difference between position of real mouth and mouth on foto)
-
-    # aspect ratio of photo (not compensated)
-    photo_AR = photo_height/photo_width
+    ### FIND TRANSFORMATION (see align_landmarks in uv_alignment_core.py)
+    # Landmarks go to UV-space, vertical scale compensates difference between position of real mouth
+    # and mouth on foto, then transformation is found that brings landmarks on plane to landmarks on foto.
+    # All targets are solved together
+    photo_points = np.array([[tuple(point) for point in target['landmarks']] for target in targets], dtype=np.float64)
+    plane_ARs = np.array([target['plane_AR'] for target in targets], dtype=np.float64)
+    solver_key = solver if robust_threshold is None else [solver, 'ROBUST', robust_threshold]
+    transform_keys = [photo_key (photo_points[i], photo_sizes[i], plane_ARs[i], solver_key) for i in range(len(targets))]
+    transforms = [entry['transforms'].get(transform_key) if entry is not None else None
+                  for entry, transform_key in zip(entries, transform_keys)]
+
+    unsolved = [i for i, transform in enumerate(transforms) if transform is None]
+    if unsolved:
+        with profiler.stage ('solve'):
+            if robust_threshold is None:
+                t_mats, scale_Y, AR, residuals = align_landmarks (plane_points[unsolved], plane_sizes[unsolved],
+                                                                  photo_points[unsolved], photo_sizes[unsolved],
+                                                                  plane_ARs[unsolved], solver)
+            else:
+                t_mats, scale_Y, AR, residuals, inliers, confidence = align_landmarks_robust (
+                    plane_points[unsolved], plane_sizes[unsolved], photo_points[unsolved], photo_sizes[unsolved],
+                    plane_ARs[unsolved], solver, robust_threshold)
+        for j, i in enumerate(unsolved):
+            transforms[i] = {'t_mat': t_mats[j], 'scale_Y': float(scale_Y[j]), 'AR': float(AR[j]),
+                             'residuals': residuals[j]}
+            if robust_threshold is not None:
+                transforms[i].update(inliers=inliers[j].tolist(), confidence=float(confidence[j]))
+            if cache is not None:
+                cache.put_transform (keys[i], plane_points[i], transform_keys[i], transforms[i])
+
+    results = []
+    for i, (target, transform) in enumerate(zip(targets, transforms)):
+        t_mat, scale_Y, AR, residuals = (np.array(transform['t_mat']), transform['scale_Y'], transform['AR'],
+                                         np.array(transform['residuals']))
+        print (planes[i].name, "scale_Y", scale_Y)
+        # how far landmarks of plane are from landmarks of photo after alignment (eyeL, eyeR, mouth)
+        print (planes[i].name, "Landmark residuals", residuals)
+
+        result = {'plane': planes[i].name, 't_mat': t_mat.tolist(), 'scale_Y': scale_Y, 'AR': AR,
+                  'residuals': residuals.tolist(), 'cached': entries[i] is not None}
+        if robust_threshold is not None:
+            result.update(inliers=transform['inliers'], confidence=transform['confidence'],
+                          flagged=bool(flag_alignments (transform['inliers'], transform['confidence'],
+                                                        min_confidence)))
+            print (planes[i].name, "Inliers", transform['inliers'], "confidence", transform['confidence'])
+        results.append(result)
+        if result.get('flagged'):
+            # landmarks don't agree with each other, UV map from them would be wrong
+            print (planes[i].name, "Low confidence of alignment, not exported")
+            result.update(fbx_path=None, outputs={}, written=[])
+            continue
+
+        # dense landmarks of the mesh are matched to dense landmarks of the photo
+        warp = None
+        if dense_points is not None and target.get('dense_landmarks') is not None:
+            with profiler.stage ('dense_warp'):
+                plane_uv = to_uv (dense_points[i], plane_sizes[i][0], plane_sizes[i][1], 'CENTER', 'DOWN')
+                photo_uv = to_uv (np.asarray(target['dense_landmarks'], dtype=np.float64),
+                                  photo_sizes[i][0], photo_sizes[i][1], 'TOPLEFT', 'DOWN')
+                warp, plane_matched, _ = fit_dense_warp (plane_uv, photo_uv, t_mat, plane_ARs[i], AR,
+                                                         dense_max_distance, dense_smoothing)
+            result['dense_matches'] = len(plane_matched)
+            print (planes[i].name, "Dense landmarks matched", len(plane_matched), "of", len(plane_uv))
+
+        # Transforming UV of plane with help of transformation matrix (or warp of dense landmarks)
+        with profiler.stage ('uv_transform'):
+            if warp is not None:
+                warp_UV (warp, planes[i], plane_ARs[i], AR)
+            else:
+                transform_UV (t_mat, planes[i], plane_ARs[i], AR)
+
+        # Exportin plane with animation to FBX (and/or its UVs, see export_alignment)
+        with profiler.stage ('fbx_export'):
+            output_paths, written = export_alignment (gender, planes[i], target.get('fbx_path'), t_mat,
+                                                       plane_ARs[i], AR, outputs, incremental, image=target['image'],
+                                                       warp=warp)
+
+        result.update(fbx_path=output_paths.get('FBX'), outputs=output_paths, written=written)
+
+    for result in results:
+        result['timings'] = profiler.timings
+    return results
+
+
+# Align FotoPlane with every frame of a photo or video sequence (Foto image shows the sequence).
+# tracks - (F, 4, 2) eR, eL, mR, mL of every frame (see read_landmark_tracks in uv_alignment_landmarks.py),
+# frames - frames of the scene the tracks belong to (default: F frames from scene.frame_start),
+# smoothing - radius in frames of temporal smoothing of tracks,
+# tolerance - frames whose landmarks moved less than this (pixels) since the last solved frame
+#             reuse its solution (see align_sequence in uv_alignment_core.py).
+# Landmarks of 3D mesh are found once, all frames are solved in one batch and UV layer of FotoPlane
+# is keyed at solved frames (see key_UV_frames) instead of aligning the plane frame by frame.
+# Other arguments are the same as of match_foto_with_3D, 'UV' and 'MATRIX' outputs hold all frames.
+# FBX exporter doesn't write keys of UVs (they are F-curves of mesh data), so 'FBX' output holds only
+# UVs of the current frame of the scene and sequences export 'UV' and 'MATRIX' by default.
+# Returns dict like match_foto_with_3D with 't_mat', 'scale_Y', 'AR', 'residuals' of every frame,
+# 'frames' and 'solved_frames'
+def match_sequence_with_3D (tracks, gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale, plane_AR,
+                            frames=None, solver='EYES', smoothing=0, tolerance=0.0, fbx_path=None, profiler=None,
+                            cache=None, outputs=('UV', 'MATRIX'), incremental=False):
 
-    dist_between_3D_eyes = (Vector((eyeL_plane_uv[0], eyeL_plane_uv[1]*plane_AR)) - Vector((eyeR_plane_uv[0], eyeR_plane_uv[1]*plane_AR))).length
-    dist_between_photo_eyes = (Vector((eyeL_photo_uv[0], eyeL_photo_uv[1]*photo_AR)) - Vector((eyeR_photo_uv[0], eyeR_photo_uv[1]*photo_AR))).length
-    
-    eyes_midpoint_photo = (Vector((eyeL_photo_uv[0], eyeL_photo_uv[1]*photo_AR)) + Vector((eyeR_photo_uv[0], eyeR_photo_uv[1]*photo_AR)))/2
-    dist_eyes_to_mouth_photo = (Vector((mouth_photo_uv[0], mouth_photo_uv[1]*photo_AR)) - eyes_midpoint_photo).length
-        
-    eyes_midpoint_3D = (Vector((eyeL_plane_uv[0], eyeL_plane_uv[1]*plane_AR)) + Vector((eyeR_plane_uv[0], eyeR_plane_uv[1]*plane_AR)))/2
-    dist_eyes_to_mouth_3D = (Vector((mouth_plane_uv[0], mouth_plane_uv[1]*plane_AR)) - eyes_midpoint_3D).length
-    
-    scale_Y = (dist_eyes_to_mouth_3D*dist_between_photo_eyes)/(dist_eyes_to_mouth_photo*dist_between_3D_eyes)
-    print ("scale_Y", scale_Y)
-    # aspect ration of photo with scale_Y compensation (something around 5%)
-    AR = (photo_height/photo_width)*scale_Y
-
-    # Calculating matrix to transform landmarks on foto to match landmarks on plane
-    t_mat = get_affine_matrix (eyeL_plane_uv, eyeR_plane_uv, eyeL_photo_uv, eyeR_photo_uv, plane_AR, AR)
-
-    # Transforming UV of FotoPlane with help of transformation matrix
-    transform_UV (t_mat, photo_plane, plane_AR, AR)
-
-    # Exportin FotoPlane with animation to FBX
-    export_object_to_FBX (gender, photo_plane)
+    scene = bpy.context.scene
+    profiler = profiler or Profiler ()
+
+    tracks = np.asarray(tracks, dtype=np.float64)
+    frames = np.arange(scene.frame_start, scene.frame_start + len(tracks)) if frames is None else np.asarray(frames)
+    if len(frames) != len(tracks):
+        raise ValueError ("{} frames for {} frames of landmark tracks".format(len(frames), len(tracks)))
+
+    target = {'camera': scene.objects.get('cam'),
+              'plane': scene.objects.get('{}FotoPlane'.format(gender)),
+              'image': bpy.data.images['Foto']}
+
+    # crosses of previous avatar
+    clear_debug_markers ()
+
+    planes, plane_sizes, plane_points, keys, entries, _ = find_plane_points (
+        [target], gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale, profiler, cache)
+    plane = planes[0]
+    if cache is not None and entries[0] is None:
+        cache.put (keys[0], {'plane_points': plane_points[0], 'transforms': {}})
+
+    with profiler.stage ('image_reload'):
+        reload_changed_images ()
+    photo_size = get_image_size (target['image'])
+
+    # all frames at once, frames where landmarks stood still are not solved again
+    with profiler.stage ('solve'):
+        t_mats, scale_Y, AR, residuals, sources = align_sequence (plane_points[0], plane_sizes[0], tracks, photo_size,
+                                                                  plane_AR, solver, smoothing, tolerance)
+    solved = np.unique(sources)
+    print (plane.name, "solved {} of {} frames".format(len(solved), len(frames)))
+    print (plane.name, "Largest landmark residuals", residuals.max(axis=0))
+
+    # UVs of every frame from UVs of the plane before any alignment
+    with profiler.stage ('uv_transform'):
+        clear_UV_keys (plane)
+        uv_frames = transform_uvs (get_uvs (plane), t_mats, plane_AR, AR)
+        key_UV_frames (plane, frames[solved], uv_frames[solved])
+        scene.frame_set (scene.frame_current)
+
+    with profiler.stage ('fbx_export'):
+        output_paths, written = export_alignment (gender, plane, fbx_path, t_mats, plane_AR, AR, outputs, incremental,
+                                                   uvs=uv_frames, frames=frames)
+
+    return {'plane': plane.name, 't_mat': t_mats.tolist(), 'scale_Y': scale_Y.tolist(), 'AR': AR.tolist(),
+            'residuals': residuals.tolist(), 'frames': frames.tolist(), 'solved_frames': frames[solved].tolist(),
+            'fbx_path': output_paths.get('FBX'), 'outputs': output_paths, 'written': written,
+            'cached': entries[0] is not None, 'timings': profiler.timings}
+
+
+# Landmarks of 3D mesh (eyeL, eyeR, mouth) on planes of targets (see match_targets_with_3D):
+# local X and Z of planes relative to their centers. They are taken from cache, or shape keys are applied,
+# landmarks evaluated and rays cast from cameras to planes (for all targets that are not cached at once).
+# dense_vertices - indices of more vertices of Head to find on planes (they are not cached,
+#                  so shape keys are applied and landmarks evaluated for all targets).
+# Returns planes, (T, 2) sizes of planes, (T, 3, 2) points on planes, cache keys, cache entries
+# (None for targets that were not cached) and (T, D, 2) points of dense_vertices (NaN for vertices
+# whose rays miss the plane, None without dense_vertices)
+def find_plane_points (targets, gender, shapekey_eyes_path, shapekey_head_path, location, rotation, scale,
+                       profiler, cache=None, dense_vertices=None):
 
+    # finding eyes object of skinned character
+    skinned_eyes_obj = bpy.data.objects["Eyes"]
 
-def apply_shapekey (shapekey_path, ob):
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.ops.import_scene.obj(filepath = shapekey_path, use_groups_as_vgroups=False, split_mode='OFF')
-    # get list of selected objects
-    selected_objects = bpy.context.selected_objects
-    bpy.context.scene.objects.active = ob
-    selected_objects[0].select = True
-    ob.select = True
-    # create shapekey for eyes
-    bpy.ops.object.join_shapes()
-    # set value of last shapekey in list to 1
-    bpy.context.active_object.data.shape_keys.key_blocks[-1].value = 1
-
-
-# apply skin to mesh (bake skin)
-def convert_skinned_mesh_to_mesh (skinned_mesh):
-    scene = bpy.context.scene
-    bpy.ops.object.select_all(action='DESELECT')
-    # apply all modifiers (and skin also)
-    to_mesh = skinned_mesh.to_mesh (scene, 1, 'RENDER')
-    # convert mesh to object
-    obj = bpy.data.objects.new ("Baked" + skinned_mesh.name, to_mesh)
-    # link object to scene
-    scene.objects.link(obj)
-    return obj
+    # finding head object of skinned character
+    skinned_head_obj = bpy.data.objects["Head"]
 
+    planes = [target['plane'] for target in targets]
+    cameras = [get_camera_params (target['camera']) for target in targets]
+    # width/height of planes in units and their centers (local X and Z)
+    plane_bounds = [get_plane_bounds (plane) for plane in planes]
+    plane_sizes = np.array([size for size, _ in plane_bounds])
 
+    #########################################################################################################################
+    ### DEALING WITH 3D POINTS (POINTS ON photo_plane)
 
-def apply_transformations (obj, location, rotation, scale):
-    # rotate, transform and scale eyes to match skinned
-    obj.location = location
-    obj.rotation_euler = rotation
-    obj.scale = scale
-    obj.select = True
-    bpy.ops.object.transform_apply (location=True, rotation=True, scale=True)
+    # landmarks on planes don't depend on photo, they may be known from previous runs
+    keys = [None] * len(targets)
+    entries = [None] * len(targets)
+    if cache is not None:
+        with profiler.stage ('cache_lookup'):
+            for i, target in enumerate(targets):
+                keys[i] = plane_key ((shapekey_eyes_path, shapekey_head_path), location, rotation, scale,
+                                     cameras[i], np.array(planes[i].matrix_world), plane_sizes[i],
+                                     (bpy.data.filepath, gender, planes[i].name))
+                entries[i] = cache.get (keys[i])
+
+    plane_points = np.empty((len(targets), 3, 2))
+    for i, entry in enumerate(entries):
+        if entry is not None:
+            plane_points[i] = entry['plane_points']
+
+    missing = [i for i, entry in enumerate(entries) if entry is None or dense_vertices is not None]
+    dense_points = None
+    if missing:
+        with profiler.stage ('shapekey_import'):
+            # import and apply shape key to eyes
+            apply_shapekey (shapekey_eyes_path, skinned_eyes_obj)
+            # import and apply shape key to head
+            apply_shapekey (shapekey_head_path, skinned_head_obj)
+
+        # Getting world coordinates of 3D eyes'/mouth's mesh (our landmarks):
+        # skin and character specific transormation are applied to these vertices only
+        # (the same as baking skinned eyes/mouth and applying transformations to baked meshes)
+        with profiler.stage ('landmarks'):
+            # vertex 192 - center of left eye, vertex 385 - center of right eye
+            eyeL_3D_world, eyeR_3D_world = evaluate_landmarks (skinned_eyes_obj, (192, 385), location, rotation, scale)
+            # vertex 1211 - middle of mouth
+            mouth_3D_world, = evaluate_landmarks (skinned_head_obj, (1211,), location, rotation, scale)
+            draw_cross (mouth_3D_world)
+            points_3D_world = np.array([eyeL_3D_world, eyeR_3D_world, mouth_3D_world])
+            if dense_vertices is not None:
+                points_3D_world = np.concatenate((points_3D_world, evaluate_landmarks (
+                    skinned_head_obj, dense_vertices, location, rotation, scale)))
+
+        # find coordinates on every plane (local space) of 3D mesh landmarks (all in one batch)
+        with profiler.stage ('ray_cast'):
+            points_3D_plane = convert_points3D_to_planes (points_3D_world,
+                                                          [targets[i]['camera'] for i in missing],
+                                                          [planes[i] for i in missing],
+                                                          allow_miss=dense_vertices is not None)
+            if np.isnan(points_3D_plane[:, :3]).any():
+                raise ValueError ("Rays to eyes or mouth miss the plane")
+
+        # Converting 3D coordinates to 2D point.
+        # Because I need only local axis X and Z (Y = 0 for all vertices), relative to center of plane
+        if dense_vertices is not None:
+            dense_points = np.full((len(targets), len(points_3D_world) - 3, 2), np.nan)
+        for points, i in zip(points_3D_plane, missing):
+            plane_points[i] = points[:3, [0, 2]] - plane_bounds[i][1]
+            if dense_points is not None:
+                dense_points[i] = points[3:, [0, 2]] - plane_bounds[i][1]
+
+    return planes, plane_sizes, plane_points, keys, entries, dense_points
+
+
+# add shape key with vertices of OBJ file to the mesh object and set it to 1.
+# Vertices are read straight from the file (no import into the scene),
+# use_mmap - memory-map OBJ file instead of reading it (for large heads)
+def apply_shapekey (shapekey_path, ob, use_mmap=False):
+    co = read_obj_vertices (shapekey_path, use_mmap)
+    if len(co) != len(ob.data.vertices):
+        raise ValueError ("'{}' has {} vertices, '{}' has {}".format(
+            shapekey_path, len(co), ob.name, len(ob.data.vertices)))
+
+    if ob.data.shape_keys is None:
+        ob.shape_key_add (name='Basis', from_mix=False)
+    # create shapekey named after OBJ file
+    key_block = ob.shape_key_add (name=os.path.splitext(os.path.basename(shapekey_path))[0], from_mix=False)
+    key_block.data.foreach_set('co', co.ravel())
+    # set value of the new shapekey to 1
+    key_block.value = 1
+
+
+# World coordinates of vertices 'indices' of skinned mesh after baking skin and applying
+# character specific transformation (location, rotation, scale) to the baked mesh.
+# Only requested vertices are evaluated: shape keys, then armature modifiers, then the transformation.
+# Meshes with other modifiers fall back to baking the whole mesh (nothing is added to the scene).
+def evaluate_landmarks (skinned_mesh, indices, location, rotation, scale):
+    indices = list(indices)
+    if can_evaluate_landmarks (skinned_mesh):
+        co = mix_shape_keys (skinned_mesh, indices)
+        for mod in skinned_mesh.modifiers:
+            if mod.show_render:
+                co = deform_with_armature (skinned_mesh, mod.object, indices, co)
+    else:
+        to_mesh = skinned_mesh.to_mesh (bpy.context.scene, 1, 'RENDER')
+        co = np.array([to_mesh.vertices[i].co for i in indices])
+        bpy.data.meshes.remove (to_mesh)
+
+    return transform_points (compose_matrix (location, rotation, scale), co)
+
+
+# can landmarks of the mesh be evaluated without baking:
+# only relative shape keys and plain armature modifiers with vertex groups
+def can_evaluate_landmarks (ob):
+    keys = ob.data.shape_keys
+    if keys is not None and not keys.use_relative:
+        return False
+    for mod in ob.modifiers:
+        if not mod.show_render:
+            continue
+        if mod.type != 'ARMATURE' or mod.object is None:
+            return False
+        if (not mod.use_vertex_groups or mod.use_bone_envelopes or mod.use_deform_preserve_volume
+                or mod.use_multi_modifier or mod.vertex_group):
+            return False
+    return True
+
+
+# local coordinates of vertices 'indices' with all shape keys mixed in
+def mix_shape_keys (ob, indices):
+    mesh = ob.data
+    keys = mesh.shape_keys
+    if keys is None:
+        return np.array([mesh.vertices[i].co for i in indices])
+
+    basis = keys.reference_key
+    co = np.array([basis.data[i].co for i in indices])
+    for key_block in keys.key_blocks:
+        if key_block == basis or key_block.mute or key_block.value == 0:
+            continue
+        relative = key_block.relative_key
+        delta = np.array([key_block.data[i].co - relative.data[i].co for i in indices])
+        factor = np.full(len(indices), key_block.value)
+        if key_block.vertex_group:
+            group = ob.vertex_groups[key_block.vertex_group].index
+            factor *= [sum(g.weight for g in mesh.vertices[i].groups if g.group == group) for i in indices]
+        co += factor[:, None] * delta
+    return co
+
+
+# deform local coordinates 'co' of vertices 'indices' the way armature modifier does it
+def deform_with_armature (ob, armature_obj, indices, co):
+    bones = [pose_bone for pose_bone in armature_obj.pose.bones if pose_bone.bone.use_deform]
+    if not bones:
+        return co
+    bone_index = dict((pose_bone.name, b) for b, pose_bone in enumerate(bones))
+    bone_matrices = [np.dot(np.array(pose_bone.matrix), np.linalg.inv(np.array(pose_bone.bone.matrix_local)))
+                     for pose_bone in bones]
+
+    group_names = [group.name for group in ob.vertex_groups]
+    weights = np.zeros((len(indices), len(bones)))
+    for row, i in enumerate(indices):
+        for g in ob.data.vertices[i].groups:
+            b = bone_index.get(group_names[g.group])
+            if b is not None:
+                weights[row, b] += g.weight
+
+    # skinning happens in armature's space
+    premat = np.dot(np.linalg.inv(np.array(armature_obj.matrix_world)), np.array(ob.matrix_world))
+    co = skin_points (transform_points (premat, co), weights, bone_matrices)
+    return transform_points (np.linalg.inv(premat), co)
 
 
-# looking for 3d view. It MUST be one with Camera as main camera. 
-# Camera frame must be visible completely in 3d view
-def view3d_find():
-    # returns first 3d view, normally we get from context
-    for area in bpy.context.window.screen.areas:
-        if area.type == 'VIEW_3D':
+#######################################################################################
+### DEBUG MARKERS
+# Set DEBUG_DRAW = True to see landmarks and their intersections with FotoPlane in the scene.
+# All crosses are edges of one mesh object (DEBUG_MARKERS_NAME) that is reused from avatar to avatar,
+# so the number of objects in the scene doesn't grow.
+DEBUG_DRAW = False
+DEBUG_MARKERS_NAME = "DebugMarkers"
 
-            v3d = area.spaces[0]
-            rv3d = v3d.region_3d
-            for region in area.regions:
-                if region.type == 'WINDOW':
-                    # region - part of screen area in Blender; 
-                    # rv3d - region that has 3D view (we can see our 3D scene through this region)
-                    return region, rv3d
-    return None, None
+# crosses drawn since the last clear_debug_markers: (position, size)
+_debug_markers = []
 
 
 # draw cross at certain position (world coordinates)
 def draw_cross (cross_position, message="Drew cross at:", size=1):
-    scene = bpy.context.scene
+    if not DEBUG_DRAW:
+        return
     print(message, cross_position)
-    cross = bpy.data.objects.new("Cross", None)
-    cross.location = cross_position
-    cross.empty_draw_size = size
-    scene.objects.link(cross)
-
-
-
-# looking for the first intersection of line 
-# (line between 2 points: ray_dir and origin)
-# and FotoPlane
-def get_intesection (ob, origin, ray_dir):
-    if None not in (ob, origin, ray_dir) and ob.type == 'MESH':
-        scene = bpy.context.scene
-        bm = bmesh.new()
-        bm.from_object(ob, scene)
-        bm.transform(ob.matrix_world)
-        bmesh.ops.triangulate(bm, faces=bm.faces)
-       
-        for face in bm.faces:
-            intersection = intersect_ray_tri(face.verts[0].co, face.verts[1].co, face.verts[2].co, ray_dir, origin)
-            if intersection is not None:
-                draw_cross (intersection, "Intersection found:")
-                # print("Intersection found:", intersection)
-                # # drawing cross in place of intersection
-                # inter = bpy.data.objects.new("Intersection", None)
-                # inter.location = intersection
-                # inter.empty_draw_size = 2
-                # scene.objects.link(inter)
-
-                break # find the first intersection only
-        
-    return intersection
-
-
-
-# find 2D point on plane (local space) corresponding to 3D point (world space) 
-# with the same coordinates in screen space of camera
-def convert_point3D_to_point2D_w_same_screen_co (point3D, cam, plane):
-    scene = bpy.context.scene
-    region, rv3d = view3d_find()
-    # Find out screen coordinates of 3d point
-    point2D_screen = location_3d_to_region_2d(region, rv3d, point3D)
-    # print ("point2D in pixels =", point2D_screen)
-
-    # Project RAYS from screen points back to landmarks
-    ray_dir = region_2d_to_vector_3d (region, rv3d, point2D_screen) # direction from camera origin to 2D point
-
-    # Find out intersection with plane
-    inter = get_intesection (plane, cam.location, ray_dir) # get intersection world coordinates
-
-    # convert coordinates of intersection from world to plane's local
-    # local coordinates of plane start in center and have axis X = looking right, Y = 0, Z = looking down
-    point2D = plane.matrix_world.inverted() * inter
+    _debug_markers.append((tuple(cross_position), size))
+    update_debug_markers ()
 
-    return point2D
 
+# (re)build mesh of DebugMarkers object from drawn crosses
+def update_debug_markers ():
+    scene = bpy.context.scene
+    ob = bpy.data.objects.get(DEBUG_MARKERS_NAME)
+    if ob is None:
+        ob = bpy.data.objects.new(DEBUG_MARKERS_NAME, bpy.data.meshes.new(DEBUG_MARKERS_NAME))
+        ob.hide_render = True
+        ob.hide_select = True
+    if ob.name not in scene.objects:
+        scene.objects.link(ob)
+
+    bm = bmesh.new()
+    for position, size in _debug_markers:
+        for axis in range(3):
+            offset = Vector((0, 0, 0))
+            offset[axis] = size
+            bm.edges.new((bm.verts.new(Vector(position) - offset), bm.verts.new(Vector(position) + offset)))
+    bm.to_mesh(ob.data)
+    bm.free()
+    ob.data.update()
+
+
+# remove all crosses (DebugMarkers object stays in the scene with empty mesh)
+def clear_debug_markers ():
+    del _debug_markers[:]
+    if bpy.data.objects.get(DEBUG_MARKERS_NAME) is not None:
+        update_debug_markers ()
+
+
+
+# Ray casting data of meshes we intersect with, so the mesh is not rebuilt for every ray:
+# object name -> (cache key, ray caster). Key changes when mesh or matrix_world changes.
+_ray_casters = {}
+
+
+# Build ray caster of the object. All casting happens in object's local space.
+# Flat rectangular meshes (like FotoPlane) are intersected analytically,
+# everything else goes through BVH-tree (modifiers are taken into account there).
+def get_ray_caster (ob):
+    scene = bpy.context.scene
+    mesh = ob.data
+    key = (mesh.name, len(mesh.vertices), len(mesh.polygons), tuple(tuple(row) for row in ob.matrix_world))
+    cached = _ray_casters.get(ob.name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    caster = {'matrix': np.array(ob.matrix_world), 'plane': None, 'bvh': None}
+    caster['matrix_inv'] = np.linalg.inv(caster['matrix'])
+
+    co = np.empty(len(mesh.vertices) * 3)
+    mesh.vertices.foreach_get('co', co)
+    co = co.reshape(-1, 3)
+    areas = np.empty(len(mesh.polygons))
+    mesh.polygons.foreach_get('area', areas)
+
+    # modifiers may bend the mesh, so only bare meshes are treated as planes
+    if len(mesh.polygons) and not ob.modifiers:
+        center = co.mean(axis=0)
+        # only 3x3 V is needed (full U of thousands of vertices would not fit into memory)
+        normal = np.linalg.svd(co - center, full_matrices=False)[2][2]
+        size = np.ptp(co, axis=0).max()
+        if np.abs(np.dot(co - center, normal)).max() <= 1e-6 * size:
+            # axes of the plane go along the first edge of the mesh
+            v0, v1 = mesh.polygons[0].vertices[:2]
+            axis_u = co[v1] - co[v0]
+            axis_u -= np.dot(axis_u, normal) * normal
+            axis_u /= np.linalg.norm(axis_u)
+            axis_v = np.cross(normal, axis_u)
+            co_2d = np.dot(co - center, np.array([axis_u, axis_v]).T)
+            lo, hi = co_2d.min(axis=0), co_2d.max(axis=0)
+            # faces cover the whole bounding rectangle - nothing to check except the bounds
+            if abs(areas.sum() - np.prod(hi - lo)) <= 1e-6 * np.prod(hi - lo):
+                caster['plane'] = (center, normal, np.array([axis_u, axis_v]), lo, hi)
+
+    if caster['plane'] is None:
+        caster['bvh'] = BVHTree.FromObject(ob, scene)
+
+    _ray_casters[ob.name] = (key, caster)
+    return caster
+
+
+# looking for the first intersections of rays (origins - (M, 3), ray_dirs - (M, 3), world space)
+# with mesh object. Returns (M, 3) array of world coordinates, NaN for rays without intersection
+def get_intersections (ob, origins, ray_dirs):
+    caster = get_ray_caster (ob)
+    origins = np.atleast_2d(np.asarray(origins, dtype=np.float64))
+    ray_dirs = np.atleast_2d(np.asarray(ray_dirs, dtype=np.float64))
+
+    # rays to object's local space
+    origins_local = np.dot(origins, caster['matrix_inv'][:3, :3].T) + caster['matrix_inv'][:3, 3]
+    ray_dirs_local = np.dot(ray_dirs, caster['matrix_inv'][:3, :3].T)
+
+    if caster['plane'] is not None:
+        center, normal, axes, lo, hi = caster['plane']
+        hits, _ = intersect_rays_plane (origins_local, ray_dirs_local, center, normal)
+        hits_2d = np.dot(hits - center, axes.T)
+        eps = 1e-9 * np.max(hi - lo)
+        with np.errstate(invalid='ignore'):
+            inside = np.all((hits_2d >= lo - eps) & (hits_2d <= hi + eps), axis=1)
+        hits[~inside] = np.nan
+    else:
+        hits = np.full(origins_local.shape, np.nan)
+        for i, (origin, ray_dir) in enumerate(zip(origins_local, ray_dirs_local)):
+            location = caster['bvh'].ray_cast(Vector(origin), Vector(ray_dir))[0]
+            if location is not None:
+                hits[i] = location
+
+    # back to world space
+    return np.dot(hits, caster['matrix'][:3, :3].T) + caster['matrix'][:3, 3]
+
+
+# read parameters of camera object that define rays from it to points (see get_point_rays in uv_alignment_core.py).
+# Lens, sensor, shift and resolution don't change these rays, so they are not part of the key of cached landmarks
+def get_camera_params (cam):
+    return {'matrix_world': np.array(cam.matrix_world),
+            'type': cam.data.type}
+
+
+# find 2D points on T planes (local space) corresponding to 3D points (world space, (M, 3))
+# with the same coordinates in screen space of T cameras, returns (T, M, 3) local coordinates on planes.
+# Works without any 3D view, so it can be run in background mode (blender -b).
+# Rays from all cameras through 3D points are built in one batch (the same rays as through
+# screen coordinates of the points, see get_point_rays in uv_alignment_core.py)
+def convert_points3D_to_planes (points3D, cams, planes, allow_miss=False):
+    origins, ray_dirs = get_point_rays (points3D, [get_camera_params (cam) for cam in cams])
+
+    points_local = []
+    for cam, plane, plane_origins, plane_ray_dirs in zip(cams, planes, origins, ray_dirs):
+        # Find out intersections with plane (world coordinates)
+        inters = get_intersections (plane, plane_origins, plane_ray_dirs)
+        if np.isnan(inters).any() and not allow_miss:
+            raise ValueError ("Rays from camera '{}' miss '{}'".format(cam.name, plane.name))
+        for inter in inters[np.isfinite(inters).all(axis=1)]:
+            draw_cross (inter, "Intersection found:")
+
+        # convert coordinates of intersections from world to plane's local
+        # local coordinates of plane start in center and have axis X = looking right, Y = 0, Z = looking down
+        matrix_inv = np.linalg.inv(np.array(plane.matrix_world))
+        points_local.append(np.dot(inters, matrix_inv[:3, :3].T) + matrix_inv[:3, 3])
+    return np.array(points_local)
+
+
+# (width, height) of plane in its units and (x, z) of its center, from bounds of the mesh
+# (plane lies in its local XZ, Z looking down)
+def get_plane_bounds (plane):
+    co = np.array([tuple(corner) for corner in plane.bound_box])
+    lo, hi = co.min(axis=0), co.max(axis=0)
+    return (hi - lo)[[0, 2]], ((lo + hi) / 2)[[0, 2]]
+
+
+# signatures of image files when images were (re)loaded: image name -> (path, signature)
+_image_signatures = {}
+
+
+# reload only images whose files have changed since they were loaded last time
+# (images that have not been loaded yet will read the new file anyway).
+# use_hash - compare content of files instead of their modification time and size
+def reload_changed_images (use_hash=False):
+    reloaded = []
+    for img in bpy.data.images:
+        if img.source != 'FILE' or img.packed_file is not None:
+            continue
+        path = bpy.path.abspath(img.filepath)
+        signature = (path, file_signature (path, use_hash))
+        if _image_signatures.get(img.name) != signature:
+            if img.has_data:
+                img.reload()
+                reloaded.append(img.name)
+            _image_signatures[img.name] = signature
+    return reloaded
+
+
+# (width, height) of image in pixels read from header of its file, without decoding it
+def get_image_size (img):
+    if img.source == 'FILE' and img.packed_file is None:
+        try:
+            return read_image_size (bpy.path.abspath(img.filepath))
+        except (IOError, ValueError):
+            pass
+    return tuple(img.size)
+
+
+# pixels of image (H, W, C) from the top row down: decoded from its file (uint8, needs PIL)
+# or float RGBA pixels of Blender's image
+def get_image_pixels (img):
+    if img.source == 'FILE' and img.packed_file is None:
+        try:
+            return load_photo_pixels (bpy.path.abspath(img.filepath))
+        except (IOError, ImportError):
+            pass
+    width, height = img.size
+    return np.array(img.pixels[:], dtype=np.float32).reshape(height, width, img.channels)[::-1]
 
 
 # get normalized coordinates of 2D point on plane with dimensions: WIDTH and HEIGHT
@@ -277,27 +680,7 @@ def convert_point3D_to_point2D_w_same_screen_co (point3D, cam, plane):
 # Y-axis can poit UP or DOWN
 # Output value limits from 0,0 to 1,1
 def convert_to_uv (point, width, height, origin, y_dir):
-    x_orig = point[0]
-    y_orig = point[1]
-
-    x_uv = x_orig/width
-    y_uv = y_orig/height
-
-    if origin == 'CENTER':
-        x_uv = x_uv + 0.5
-        y_uv = y_uv + 0.5
-    elif origin != 'TOPLEFT':
-        print ("Give me correct origin of coordinates: 'CENTER' or 'TOPLEFT'")
-
-    if y_dir == 'DOWN':
-        y_uv = 1 - y_uv
-    elif y_dir != 'UP':
-        print ("Give me correct direction of Y axis: 'UP' or 'DOWN'")
-
-    # TODO Add name of input parameter to print output
-    # print ("Normailzed coordinates:", Vector ((point_norm_x, point_norm_y)))
-
-    return Vector ((x_uv, y_uv))
+    return Vector (to_uv (point[:2], width, height, origin, y_dir))
 
 
 
@@ -334,57 +717,84 @@ def get_affine_matrix(eyeL_plane, eyeR_plane, eyeL_photo, eyeR_photo, plane_AR,
     # | ty       |   | plane_y2   plane_x2  0  1 |     | photo_y2 |
 
     
-    # Populate matrix with plane's X's and Y's
-    plane_mat = Matrix(([eyeR_plane[0], -eyeR_plane[1]*plane_AR, 1, 0],
-                        [eyeR_plane[1]*plane_AR,  eyeR_plane[0], 0, 1],
-                        [eyeL_plane[0], -eyeL_plane[1]*plane_AR, 1, 0],
-                        [eyeL_plane[1]*plane_AR,  eyeL_plane[0], 0, 1]))
-
-    # Set photo's X's and Y's
-    photo_vec = Vector ((eyeR_photo[0],
-                         eyeR_photo[1]*photo_AR,
-                         eyeL_photo[0],
-                         eyeL_photo[1]*photo_AR))
-
-    # compute vertical vector ( s*cos(r), s*sin(r), tx, ty )'
-    t_vec = plane_mat.inverted() * photo_vec
-
-    # Fill in affinity transformation matrix with now known 's*cos(r)', 's*sin(r)', 'tx', 'ty'
-    t_mat =  Matrix(([t_vec[0], -t_vec[1], t_vec[2]],
-                     [t_vec[1],  t_vec[0], t_vec[3]],
-                     [0,         0,               1]))
-
-    return t_mat
+    # The same solution in closed form (with complex numbers) is in get_affine_matrices of uv_alignment_core.py
+    t_mats = get_affine_matrices (eyeL_plane[:2], eyeR_plane[:2], eyeL_photo[:2], eyeR_photo[:2], plane_AR, photo_AR)
+    return Matrix (t_mats[0].tolist())
 
 
 
 #######################################################################################
 ### APPLY AFFINE TRANSFORMATION TO UV MAP
 def transform_UV (affineMatrix, obj, plane_AR, photo_AR):
-    scene = bpy.context.scene
     # Now we have affine transformation 'T' that for every point on plane locates matching
     # point on photo:
     # photo_point = T * plane_point
     #
-    # In order to align photo with plane we just need to apply transformation 'T' to plane's UV map
-    uv_map = obj.data.uv_layers.active
+    # In order to align photo with plane we just need to apply transformation 'T' to plane's UV map.
+    # All UV-coordinates are read at once, transformed with one matrix product and written back
+    set_uvs (obj, transform_uvs (get_uvs (obj), np.array(affineMatrix), plane_AR, photo_AR))
 
-    # iterate over all vertices of UV map
-    for v in obj.data.loops :
-        uv_coord = uv_map.data[v.index].uv # exract UV-coordinate from UV map
 
-        # transform UV coordinate
-        uv_tr = affineMatrix * Vector((uv_coord[0], uv_coord[1]*plane_AR, 1))
-
-        uv_coord[0] = uv_tr[0]
-        uv_coord[1] = uv_tr[1] / photo_AR
-
-
-def export_object_to_FBX (gender, obj):
-    bpy.ops.object.select_all(action='DESELECT')
-    obj.select = True
-    fbx_path_gender = "d:\sc01_sh0030_{}FotoPlane_transfUV.fbx".format(gender)
-    bpy.ops.export_scene.fbx (filepath=fbx_path_gender, check_existing=False, axis_forward='-Z', axis_up='Y',
+#######################################################################################
+### KEYED UV LAYER (aligned sequences)
+# action of UV keys of the object
+UV_ACTION_NAME = "{}UVAlignment"
+# property of mesh with UVs it had before they were keyed
+UV_BASE_PROPERTY = "uv_alignment_base"
+
+
+# Key UV layer of the object at frames (K,) with UVs of these frames (K, M, 2).
+# Every UV-coordinate gets its own F-curves, all keys are added at once. Interpolation is constant:
+# a frame that reuses solution of previous frame has no key and keeps its UVs.
+def key_UV_frames (obj, frames, uv_frames):
+    mesh = obj.data
+    layer = mesh.uv_layers.active
+    mesh[UV_BASE_PROPERTY] = get_uvs (obj).ravel().tolist()
+    if mesh.animation_data is None:
+        mesh.animation_data_create ()
+    action = bpy.data.actions.new (UV_ACTION_NAME.format(obj.name))
+    mesh.animation_data.action = action
+
+    co = np.empty((len(frames), 2), dtype=np.float32)
+    co[:, 0] = frames
+    for loop in range(uv_frames.shape[1]):
+        data_path = 'uv_layers["{}"].data[{}].uv'.format(layer.name, loop)
+        for axis in range(2):
+            fcurve = action.fcurves.new (data_path, index=axis, action_group=layer.name)
+            fcurve.keyframe_points.add (len(frames))
+            co[:, 1] = uv_frames[:, loop, axis]
+            fcurve.keyframe_points.foreach_set('co', co.ravel())
+            for point in fcurve.keyframe_points:
+                point.interpolation = 'CONSTANT'
+            fcurve.update ()
+    return action
+
+
+# remove UV keys of key_UV_frames and bring back UVs the object had before them
+def clear_UV_keys (obj):
+    mesh = obj.data
+    animation = mesh.animation_data
+    if animation is not None and animation.action is not None and animation.action.name.startswith(
+            UV_ACTION_NAME.format(obj.name)):
+        action = animation.action
+        animation.action = None
+        if action.users == 0:
+            bpy.data.actions.remove (action)
+    if UV_BASE_PROPERTY in mesh:
+        set_uvs (obj, mesh[UV_BASE_PROPERTY])
+        del mesh[UV_BASE_PROPERTY]
+
+
+# transform_UV with thin-plate spline of dense landmarks (see fit_dense_warp in uv_alignment_core.py)
+def warp_UV (warp, obj, plane_AR, photo_AR):
+    set_uvs (obj, warp_uvs (get_uvs (obj), warp, plane_AR, photo_AR))
+
+
+# plane goes to this FBX file (with name of plane) when no other path is given
+FBX_PATH = "d:\sc01_sh0030_{}_transfUV.fbx"
+
+# settings of FBX export (they are part of fingerprint of exported FBX)
+FBX_EXPORT_SETTINGS = dict(check_existing=False, axis_forward='-Z', axis_up='Y',
                     filter_glob="*.fbx", version='BIN7400', ui_tab='MAIN', use_selection=True,
                     global_scale=1.0, apply_unit_scale=True, bake_space_transform=False,
                     object_types={'MESH'}, use_custom_props=False, path_mode='AUTO', batch_mode='OFF',
@@ -397,3 +807,94 @@ def export_object_to_FBX (gender, obj):
                     use_anim=True, use_anim_action_all=True, use_default_take=True,
                     use_anim_optimize=True, anim_optimize_precision=6.0,  embed_textures=False, 
                     use_batch_own_dir=False, use_metadata=True)
+
+
+# export object with animation to FBX, returns path of FBX file
+def export_object_to_FBX (gender, obj, fbx_path=None):
+    bpy.ops.object.select_all(action='DESELECT')
+    obj.select = True
+    fbx_path_gender = fbx_path or FBX_PATH.format(obj.name)
+    bpy.ops.export_scene.fbx (filepath=fbx_path_gender, **FBX_EXPORT_SETTINGS)
+    return fbx_path_gender
+
+
+# UV layer of object as (M, 2) float32 array
+def get_uvs (obj):
+    uv_data = obj.data.uv_layers.active.data
+    uvs = np.empty(len(uv_data) * 2, dtype=np.float32)
+    uv_data.foreach_get('uv', uvs)
+    return uvs.reshape(-1, 2)
+
+
+# write (M, 2) UVs (or flat list of them) to UV layer of object at once
+def set_uvs (obj, uvs):
+    obj.data.uv_layers.active.data.foreach_set('uv', np.asarray(uvs, dtype=np.float32).ravel())
+
+
+# fingerprint of everything FBX of FotoPlane is made of: its UVs, vertices, placement,
+# animated frames and export settings
+def get_FBX_fingerprint (obj, uvs):
+    scene = bpy.context.scene
+    co = np.empty(len(obj.data.vertices) * 3, dtype=np.float32)
+    obj.data.vertices.foreach_get('co', co)
+    action = obj.animation_data.action.name if obj.animation_data and obj.animation_data.action else None
+    settings = dict((name, sorted(value) if isinstance(value, set) else value)
+                    for name, value in FBX_EXPORT_SETTINGS.items())
+    return export_fingerprint (uvs, co, np.array(obj.matrix_world), [action, scene.frame_start, scene.frame_end],
+                               settings)
+
+
+# Export results of alignment of FotoPlane, outputs - any of
+#   'FBX'    - FotoPlane with animation (fbx_path, see export_object_to_FBX), UVs are those of its UV layer
+#   'UV'     - UV layer of FotoPlane (<fbx_path without extension>.uv.npy)
+#   'MATRIX' - UV transformation matrix (<fbx_path without extension>.uv.json)
+#   'TEXTURE' - photo of 'image' rewarped to default UVs of FotoPlane (<fbx_path without extension>.texture.npy,
+#               see uv_alignment_rewarp.py)
+# (see uv_alignment_export.py). incremental - don't write outputs that would not change.
+# uvs - UVs to export instead of UV layer of the object, for sequences (F, M, 2) UVs of
+# 'frames' with (F, 3, 3) t_mat and (F,) photo_AR.
+# warp - thin-plate spline of dense landmarks that 'TEXTURE' follows ('MATRIX' has only t_mat).
+# Returns {output: path} and list of outputs that were written
+def export_alignment (gender, obj, fbx_path, t_mat, plane_AR, photo_AR, outputs=('FBX',), incremental=False,
+                      uvs=None, frames=None, image=None, warp=None):
+    fbx_path = fbx_path or FBX_PATH.format(obj.name)
+    base_path = os.path.splitext(fbx_path)[0]
+    uvs = get_uvs (obj) if uvs is None else uvs
+    # how matrices of all frames are fingerprinted
+    matrix_parts = ((np.asarray(photo_AR, dtype=np.float64), np.asarray(frames).tolist()) if frames is not None
+                    else (float(photo_AR),))
+    paths = {}
+    written = []
+    for output in outputs:
+        if output == 'FBX':
+            path = fbx_path
+            # FBX takes UV layer of the object as it is (the current frame of sequence)
+            fingerprint = get_FBX_fingerprint (obj, get_uvs (obj))
+            write = lambda path: export_object_to_FBX (gender, obj, path)
+        elif output == 'UV':
+            path = base_path + '.uv.npy'
+            fingerprint = export_fingerprint (uvs)
+            write = lambda path: save_uvs (path, uvs)
+        elif output == 'MATRIX':
+            path = base_path + '.uv.json'
+            fingerprint = export_fingerprint (np.asarray(t_mat, dtype=np.float64), float(plane_AR), *matrix_parts)
+            write = lambda path: save_uv_matrix (path, t_mat, plane_AR, photo_AR, frames)
+        elif output == 'TEXTURE':
+            if image is None or frames is not None:
+                raise ValueError ("'TEXTURE' output needs the photo and a single frame")
+            path = base_path + '.texture.npy'
+            uv_mat = get_uv_matrix (t_mat, plane_AR, photo_AR)
+            fingerprint = export_fingerprint (uv_mat, [image.filepath, file_signature (bpy.path.abspath(image.filepath),
+                                                                                        use_hash=True)],
+                                              *(warp or ()))
+            if warp is not None:
+                uv_mat = lambda uvs: warp_uvs (uvs, warp, plane_AR, photo_AR)
+            write = lambda path: rewarp_photo_to_file (get_image_pixels (image), uv_mat, path)
+        else:
+            raise ValueError ("Unknown output '{}': use 'FBX', 'UV', 'MATRIX' or 'TEXTURE'".format(output))
+        paths[output] = path
+        if export_if_changed (path, fingerprint, write, incremental):
+            written.append(output)
+        else:
+            print ("Up to date:", path)
+    return paths, written
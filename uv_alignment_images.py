@@ -0,0 +1,57 @@
+# Image metadata without decoding pixels.
+#
+# Width and height of the photo come from the header of its file (JPEG or PNG),
+# signature of a file tells whether it changed since it was seen last time.
+
+import hashlib
+import os
+import struct
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# JPEG start-of-frame markers (they hold the size), DHT, JPG and DAC use the same range
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+# (width, height) of JPEG or PNG image from its header
+def read_image_size (path):
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == PNG_SIGNATURE and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+
+        if head[:2] == b'\xff\xd8':
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    break
+                if marker[1] == 0xFF: # fill byte
+                    f.seek(-1, os.SEEK_CUR)
+                    continue
+                if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7: # markers without length
+                    continue
+                length = struct.unpack('>H', f.read(2))[0]
+                if marker[1] in JPEG_SOF_MARKERS:
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    return width, height
+                f.seek(length - 2, os.SEEK_CUR)
+
+    raise ValueError ("Can't read size of '{}': not a JPEG or PNG image".format(path))
+
+
+# what tells that file has changed: (mtime, size) or its SHA-1 if use_hash
+# (None if there's no such file)
+def file_signature (path, use_hash=False):
+    try:
+        if not use_hash:
+            stat = os.stat(path)
+            return stat.st_mtime, stat.st_size
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+    except OSError:
+        return None
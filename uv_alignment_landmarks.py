@@ -0,0 +1,198 @@
+# Landmarks of photos (photo.bpt.xml files).
+#
+# run with: 'python uv_alignment_landmarks.py <directory with landmark files> <table>.npy'
+# to convert all landmark files of a directory into one table.
+#
+# Landmark file is stream-parsed: every element that holds a point, either as numeric
+# first two children (x, y) or as 'x' and 'y' attributes, becomes a landmark. Landmark is found by
+#  - its 'name' or 'id' attribute,
+#  - its tag, if no other point has the same tag,
+#  - its path of child indices from the root, e.g. '0/9' (what root[0][9] used to be).
+# Unknown landmark raises KeyError instead of silently taking some other point.
+#
+# Table is a structured NumPy array (.npy, can be memory-mapped) sorted by 'avatar'
+# with one (x, y) column per landmark.
+
+import argparse
+import json
+import os
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Landmarks that match_foto_with_3D needs: eR, eL - right/left eye, mR, mL - right/left corner of mouth
+# (X = 0, Y = 0 in the top left corner of the photo, Y points downwards).
+# photo.bpt.xml does not name its points, so they are taken by position like driver scripts did.
+PHOTO_LANDMARKS = OrderedDict((('eR', '0/9'), ('eL', '0/8'), ('mR', '0/7'), ('mL', '0/6')))
+
+
+class LandmarkSet:
+
+    def __init__ (self, points, paths):
+        self.points = points # name -> (x, y), in order of the file
+        self.paths = paths   # path of child indices -> name
+
+    def __getitem__ (self, name):
+        if name in self.points:
+            return self.points[name]
+        if name in self.paths:
+            return self.points[self.paths[name]]
+        raise KeyError ("No landmark '{}', there are: {}".format(name, ', '.join(self.points)))
+
+    def __contains__ (self, name):
+        return name in self.points or name in self.paths
+
+    def __len__ (self):
+        return len(self.points)
+
+
+# (x, y) of element that holds a point, None for any other element
+def _element_point (elem):
+    try:
+        if 'x' in elem.attrib and 'y' in elem.attrib:
+            return float(elem.attrib['x']), float(elem.attrib['y'])
+        if len(elem) >= 2 and not len(elem[0]) and not len(elem[1]):
+            return float(elem[0].text), float(elem[1].text)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+# stream-parse landmark file (path or file object), returns LandmarkSet
+def read_landmarks (source):
+    found = [] # (attribute name, tag, path, point)
+    counters = [0]
+    path = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(counters[-1])
+            counters[-1] += 1
+            counters.append(0)
+            continue
+        counters.pop()
+        point = _element_point (elem)
+        if point is not None:
+            # path of the root itself is not part of the path
+            found.append((elem.get('name') or elem.get('id'), elem.tag, '/'.join(map(str, path[1:])), point))
+            elem.clear()
+        path.pop()
+
+    tag_count = {}
+    for _, tag, _, _ in found:
+        tag_count[tag] = tag_count.get(tag, 0) + 1
+
+    points = OrderedDict()
+    paths = {}
+    for name, tag, elem_path, point in found:
+        name = name or (tag if tag_count[tag] == 1 else elem_path)
+        points[name] = point
+        paths[elem_path] = name
+    return LandmarkSet (points, paths)
+
+
+# eR, eL, mR, mL as (2,) arrays (see PHOTO_LANDMARKS)
+def get_photo_landmarks (source, names=PHOTO_LANDMARKS):
+    landmarks = read_landmarks (source)
+    return tuple(np.array(landmarks[name]) for name in names.values())
+
+
+# all points of landmark file as (P, 2) array in order of the file (dense landmarks)
+def get_all_landmarks (source):
+    return np.array(list(read_landmarks (source).points.values()), dtype=np.float64).reshape(-1, 2)
+
+
+# indices of mesh vertices (dense landmarks of mesh) from JSON list or text file with one or more indices per line
+def read_vertex_indices (path):
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return [int(i) for i in json.loads(text)]
+    return [int(i) for i in text.split()]
+
+
+# landmarks of a sequence of photos (frames of video): (F, 4, 2) eR, eL, mR, mL of every landmark file
+def read_landmark_tracks (sources, names=PHOTO_LANDMARKS):
+    return np.array([get_photo_landmarks (source, names) for source in sources], dtype=np.float64).reshape(-1, len(names), 2)
+
+
+#######################################################################################
+### TABLE OF LANDMARKS OF MANY AVATARS
+# ID of avatar from path of its landmark file: <avatar>/photo.bpt.xml or <avatar>.xml
+def avatar_id (path):
+    file_name = os.path.basename(path)
+    if file_name == 'photo.bpt.xml':
+        return os.path.basename(os.path.dirname(os.path.abspath(path)))
+    return file_name.split('.')[0]
+
+
+# all landmark files in the directory (and its subdirectories)
+def find_landmark_files (directory):
+    for dir_path, _, file_names in sorted(os.walk(directory)):
+        for file_name in sorted(file_names):
+            if file_name.endswith('.xml'):
+                yield os.path.join(dir_path, file_name)
+
+
+# Table of landmarks from dict avatar -> landmarks (anything that gives (x, y) by landmark name,
+# or None), columns - column name -> landmark name. Missing landmarks are NaN.
+def make_landmark_table (landmarks, columns=PHOTO_LANDMARKS):
+    avatars = sorted(landmarks, key=str)
+    id_size = max([len(str(avatar)) for avatar in avatars] + [1])
+    dtype = [('avatar', 'U{}'.format(id_size))] + [(column, 'f4', (2,)) for column in columns]
+    table = np.zeros(len(avatars), dtype=dtype)
+    for row, avatar in enumerate(avatars):
+        points = landmarks[avatar]
+        table[row]['avatar'] = str(avatar)
+        for column, name in columns.items():
+            table[row][column] = points[name] if points is not None and name in points else (np.nan, np.nan)
+    return table
+
+
+# Build table of landmarks: 'sources' - paths of landmark files (or dict avatar -> path)
+def build_landmark_table (sources, columns=PHOTO_LANDMARKS):
+    if not isinstance(sources, dict):
+        sources = OrderedDict((avatar_id (path), path) for path in sources)
+    return make_landmark_table (OrderedDict((avatar, read_landmarks (path)) for avatar, path in sources.items()),
+                                columns)
+
+
+def save_landmark_table (table, path):
+    np.save(path, table)
+
+
+# mmap - don't read the table into memory, only rows that are used are loaded
+def load_landmark_table (path, mmap=True):
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+
+# row of the table of the avatar (KeyError if there's none)
+def lookup_landmarks (table, avatar):
+    avatar = str(avatar)
+    row = np.searchsorted(table['avatar'], avatar)
+    if row >= len(table) or table['avatar'][row] != avatar:
+        raise KeyError ("No landmarks of avatar '{}'".format(avatar))
+    return table[row]
+
+
+# (len(columns), 2) landmarks of the avatar from the table, None if the avatar is not there
+# or any of its landmarks is missing (NaN: no face on the photo, no point in the landmark file)
+def table_landmark_points (table, avatar, columns=PHOTO_LANDMARKS):
+    try:
+        row = lookup_landmarks (table, avatar)
+    except KeyError:
+        return None
+    points = np.array([row[column] for column in columns], dtype=np.float64)
+    return None if np.isnan(points).any() else points
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert directory of landmark files into one table")
+    parser.add_argument("directory")
+    parser.add_argument("table")
+    args = parser.parse_args()
+
+    table = build_landmark_table (find_landmark_files (args.directory))
+    save_landmark_table (table, args.table)
+    print ("{} avatars written to {}".format(len(table), args.table))
@@ -0,0 +1,21 @@
+# Manifest of avatars to align (used by uv_alignment_batch.py and uv_alignment_orchestrator.py).
+#
+# Manifest is a JSON file with a list of items (or a text file with one item per line).
+# Item is either ID of avatar or a dict with "avatar" and optional paths of its assets,
+# see uv_alignment_batch.py for the keys.
+
+import json
+
+
+# read manifest: JSON list or one item per line (avatar ID or JSON dict)
+def read_manifest (path):
+    with open(path) as f:
+        text = f.read()
+    try:
+        items = json.loads(text)
+    except ValueError:
+        items = [json.loads(line) if line.lstrip().startswith('{') else line.strip()
+                 for line in text.splitlines() if line.strip()]
+    if not isinstance(items, list):
+        items = [items]
+    return [item if isinstance(item, dict) else {'avatar': item} for item in items]
@@ -0,0 +1,46 @@
+# Reading vertices of OBJ files (shape keys of Eyes and Head) without importing them into Blender.
+#
+# Only 'v' lines are parsed: texture coordinates, normals, faces and groups are skipped.
+# Vertices come in the order of the file, which is the order of mesh's vertices when
+# OBJ is exported from (and imported into) Blender without splitting.
+
+import mmap
+
+import numpy as np
+
+
+# count 'v' lines of OBJ file content (bytes or mmap)
+def count_obj_vertices(data):
+    count = 1 if data[:2] in (b'v ', b'v\t') else 0
+    for pattern in (b'\nv ', b'\nv\t'):
+        pos = data.find(pattern)
+        while pos != -1:
+            count += 1
+            pos = data.find(pattern, pos + 3)
+    return count
+
+
+# (V, 3) float32 array of vertex coordinates of OBJ file.
+# use_mmap - memory-map the file instead of reading it into memory (for large heads)
+def read_obj_vertices(path, use_mmap=False):
+    with open(path, 'rb') as f:
+        if use_mmap:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # empty file can't be mapped
+                data = b''
+        else:
+            data = f.read()
+
+    try:
+        co = np.empty((count_obj_vertices(data), 3), dtype=np.float32)
+        lines = iter(data.readline, b'') if use_mmap and len(data) else data.splitlines()
+        i = 0
+        for line in lines:
+            if line[:2] in (b'v ', b'v\t'):
+                co[i] = line.split()[1:4]
+                i += 1
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    return co
@@ -0,0 +1,169 @@
+# Aligning a whole catalog of avatars with several background Blender processes.
+#
+# run with: python uv_alignment_orchestrator.py <manifest> --blend <scene>.blend --workers 8
+#
+# Manifest is the same as for uv_alignment_batch.py. Every worker takes the next few
+# avatars from a shared queue (so a fast worker takes more work than a slow one), writes them
+# to a small manifest and aligns them in one 'blender -b' run of uv_alignment_batch.py.
+# Avatars that fail, time out or crash their Blender are put back to the queue until
+# they run out of retries (FLAGGED avatars are not, their landmarks stay the same).
+# Blender that stops because its memory grows (exit code LEAK_EXIT_CODE, see
+# uv_alignment_resources.py) puts avatars it didn't get to back to the queue as they were.
+# Final record of every avatar (transformation matrix, scale_Y, residuals, export path,
+# timing) goes as one JSON line to the results file.
+
+import argparse
+import json
+import math
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from uv_alignment_manifest import read_manifest
+from uv_alignment_resources import LEAK_EXIT_CODE
+
+
+BATCH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uv_alignment_batch.py")
+
+
+# command that aligns items of {manifest} and reports them to {report}
+def blender_command (blender, blend_path, output_dir, extra_args=()):
+    return [blender, blend_path, "-b", "-P", BATCH_SCRIPT, "--",
+            "{manifest}", "--report", "{report}", "--output-dir", output_dir] + list(extra_args)
+
+
+# read JSON lines of report, missing file (process crashed before first avatar) gives nothing
+def read_report (path):
+    records = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError: # line cut by killed process
+                    pass
+    return records
+
+
+# Run all items with 'workers' parallel processes of 'command'
+# (list of arguments with '{manifest}' and '{report}' placeholders).
+# chunk_size - max number of avatars one process aligns
+# timeout - seconds one avatar is allowed to take
+# retries - how many times failed avatar is tried again
+# Returns list of final records (in order of items), they are also appended to results_path.
+def run_jobs (items, command, results_path, workers=os.cpu_count(), chunk_size=8, timeout=600, retries=2,
+              work_dir=None):
+    work_dir = work_dir or tempfile.mkdtemp(prefix="uv_alignment_")
+    jobs = queue.Queue()
+    for job, item in enumerate(items):
+        item = dict(item, job=job)
+        jobs.put((item, 0))
+
+    results = [None] * len(items)
+    lock = threading.Lock()
+    remaining = [len(items)]
+
+    def finish (record):
+        with lock:
+            results[record['job']] = record
+            remaining[0] -= 1
+            with open(results_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def take_chunk ():
+        # smaller chunks near the end, so the last avatars are spread over all workers
+        size = max(1, min(chunk_size, int(math.ceil(jobs.qsize() / float(workers)))))
+        chunk = []
+        while len(chunk) < size:
+            try:
+                chunk.append(jobs.get_nowait())
+            except queue.Empty:
+                break
+        return chunk
+
+    def worker (n):
+        log_path = os.path.join(work_dir, "worker-{}.log".format(n))
+        run = 0
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+            chunk = take_chunk ()
+            if not chunk:
+                time.sleep(0.05) # jobs being retried by other workers may come back
+                continue
+
+            run += 1
+            manifest_path = os.path.join(work_dir, "manifest-{}-{}.json".format(n, run))
+            report_path = os.path.join(work_dir, "report-{}-{}.jsonl".format(n, run))
+            with open(manifest_path, 'w') as f:
+                json.dump([item for item, _ in chunk], f)
+
+            start = time.time()
+            error = None
+            returncode = None
+            args = [arg.format(manifest=manifest_path, report=report_path) for arg in command]
+            with open(log_path, 'a') as log:
+                try:
+                    returncode = subprocess.run(args, stdout=log, stderr=subprocess.STDOUT,
+                                                timeout=timeout * len(chunk)).returncode
+                except subprocess.TimeoutExpired:
+                    error = "timed out after {:.0f}s".format(time.time() - start)
+                except OSError as e:
+                    # Blender is not there or can't be started, avatars fail (and are retried) as after a crash
+                    error = "can't run '{}': {}".format(args[0], e)
+                    log.write(error + '\n')
+
+            reported = dict((record.get('job'), record) for record in read_report (report_path))
+            # Blender that stopped on a leak after reporting its last avatar has not tried the rest
+            crashed = returncode == LEAK_EXIT_CODE and bool(reported)
+            for item, attempts in chunk:
+                record = reported.get(item['job'])
+                if record is None:
+                    if crashed:
+                        # Blender died on one of previous avatars, this one was not even tried
+                        jobs.put((item, attempts))
+                        continue
+                    crashed = True
+                    record = {'job': item['job'], 'avatar': item.get('avatar'), 'status': 'FAILED',
+                              'error': error or "Blender exited before reporting (see {})".format(log_path)}
+                record['attempts'] = attempts + 1
+                record['worker'] = n
+                # FLAGGED avatar would be flagged again, only failures are tried again
+                if record['status'] == 'FAILED' and attempts < retries:
+                    jobs.put((item, attempts + 1))
+                else:
+                    finish (record)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Align avatars with several background Blender processes")
+    parser.add_argument("manifest")
+    parser.add_argument("--blend", required=True, help="scene with characters, FotoPlanes and camera")
+    parser.add_argument("--blender", default="blender")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds per avatar")
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--results", default="uv_alignment_results.jsonl")
+    parser.add_argument("--output-dir", default=".")
+    args, batch_args = parser.parse_known_args()
+
+    command = blender_command (args.blender, args.blend, args.output_dir, batch_args)
+    results = run_jobs (read_manifest (args.manifest), command, args.results, args.workers,
+                        args.chunk_size, args.timeout, args.retries)
+    failed = sum(record['status'] == 'FAILED' for record in results)
+    flagged = sum(record['status'] == 'FLAGGED' for record in results)
+    print ("{} avatars aligned, {} flagged, {} failed".format(len(results) - failed - flagged, flagged, failed))
+    sys.exit(1 if failed else 0)
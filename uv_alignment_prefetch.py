@@ -0,0 +1,198 @@
+# Downloading assets of avatars ahead of their alignment.
+#
+# Assets are kept in a content-addressed cache on disk:
+#   <cache_dir>/objects/<sha256[:2]>/<sha256>  - content of downloaded files
+#   <cache_dir>/index.json                     - url -> {"sha256", "size", "etag"}
+# Cached file is revalidated with its ETag (If-None-Match) and checked against its size,
+# so unchanged assets are not downloaded again. Every download thread keeps its own
+# HTTP connection per host open between requests.
+# Several processes may share the cache (workers of uv_alignment_orchestrator.py): index is merged with
+# the one on disk and written through its own temporary file. An index entry that is lost anyway
+# (two processes wrote the index at the same time) only means its asset is downloaded once more.
+
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+
+AVATARS_URL = "http://face3d.unteleported.com/avatars/{}/{}"
+
+
+# names of assets of avatar on server (everything uv-alignment-boy.py downloads for Boy)
+def avatar_assets (gender='Boy'):
+    return ('photo.bpt.xml', 'Eyes.obj', 'Head.obj', 'photo.jpg', 'Head1.jpg', '{}.fbx'.format(gender.lower()))
+
+
+class AssetCache:
+
+    def __init__ (self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (IOError, ValueError):
+            self.index = {}
+
+    def object_path (self, sha256):
+        return os.path.join(self.cache_dir, 'objects', sha256[:2], sha256)
+
+    # cached entry of url if its file is still there and has the right size
+    def lookup (self, url):
+        with self.lock:
+            entry = self.index.get(url)
+        if entry is not None:
+            path = self.object_path(entry['sha256'])
+            if os.path.exists(path) and os.path.getsize(path) == entry['size']:
+                return entry
+        return None
+
+    # local path of url's content, downloads it if it's not in cache or changed on server
+    def fetch (self, url):
+        entry = self.lookup(url)
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+
+        response = self.request(url, headers)
+        try:
+            if response.status == 304 and entry is not None:
+                response.read()
+                return self.object_path(entry['sha256'])
+            if response.status != 200:
+                response.read()
+                raise IOError("GET {} failed: {} {}".format(url, response.status, response.reason))
+            entry = self.store(url, response)
+        except Exception:
+            # connection is in unknown state, next request opens a new one
+            self.close_connection(url)
+            raise
+        return self.object_path(entry['sha256'])
+
+    # stream response into cache, returns its index entry
+    def store (self, url, response):
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    block = response.read(1 << 16)
+                    if not block:
+                        break
+                    sha.update(block)
+                    f.write(block)
+                    size += len(block)
+            length = response.getheader('Content-Length')
+            if length is not None and int(length) != size:
+                raise IOError("GET {}: got {} bytes of {}".format(url, size, length))
+
+            entry = {'sha256': sha.hexdigest(), 'size': size, 'etag': response.getheader('ETag')}
+            path = self.object_path(entry['sha256'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self.lock:
+            self.index[url] = entry
+            try:
+                self.save_index({url: entry})
+            except (IOError, OSError) as error:
+                # the asset is in the cache, only the next session may not know it
+                print ("Index of asset cache is not saved:", error)
+        return entry
+
+    # write index with new entries into index on disk (other processes may have added theirs there)
+    def save_index (self, entries):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        index.update(entries)
+        self.index.update(index)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    #######################################################################################
+    ### CONNECTIONS (one per thread and host)
+    def connection (self, url):
+        parts = urlsplit(url)
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        connections = self.local.connections
+        key = (parts.scheme, parts.netloc)
+        if key not in connections:
+            connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            connections[key] = connection_class(parts.netloc, timeout=60)
+        return connections[key]
+
+    def close_connection (self, url):
+        parts = urlsplit(url)
+        connection = getattr(self.local, 'connections', {}).pop((parts.scheme, parts.netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def request (self, url, headers):
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        try:
+            connection = self.connection(url)
+            connection.request('GET', path, headers=headers)
+            return connection.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            # server closed kept-alive connection, try once more with a new one
+            self.close_connection(url)
+            connection = self.connection(url)
+            connection.request('GET', path, headers=headers)
+            return connection.getresponse()
+
+
+# Downloads assets of avatars in background threads:
+#   prefetcher.prefetch(avatar)  - start downloading (returns at once)
+#   prefetcher.get(avatar)       - wait for downloads, {asset name: local path}
+class Prefetcher:
+
+    def __init__ (self, cache, workers=4, url=AVATARS_URL, assets=avatar_assets()):
+        self.cache = cache
+        self.url = url
+        self.assets = assets
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {}
+
+    def prefetch (self, avatar, assets=None):
+        if avatar not in self.pending:
+            self.pending[avatar] = dict(
+                (name, self.executor.submit(self.cache.fetch, self.url.format(avatar, name)))
+                for name in (assets or self.assets))
+
+    def get (self, avatar, assets=None):
+        self.prefetch(avatar, assets)
+        futures = self.pending.pop(avatar)
+        return dict((name, future.result()) for name, future in futures.items())
+
+    def close (self):
+        self.executor.shutdown(wait=True)
+
+
+# copy cached asset to path where something else (e.g. Foto image of the scene) takes it from
+def copy_asset (cached_path, path):
+    if os.path.abspath(cached_path) != os.path.abspath(path):
+        shutil.copyfile(cached_path, path)
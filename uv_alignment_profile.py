@@ -0,0 +1,93 @@
+# Per-stage profiling of alignment of one avatar.
+#
+#   with Profiler (avatar, log_path, count_data=lambda: count_data (bpy.data)) as profiler:
+#       with profiler.stage ('solve'):
+#           ...
+#
+# Every stage records its wall time, memory allocated by Python (with trace_memory, net bytes
+# still allocated when the stage ends) and how the number of data-blocks changed
+# (count_data - function that returns {kind: count}, see count_data in uv_alignment_resources.py).
+# When profiler is closed, its record is appended to log_path as one JSON line:
+#   {"avatar": 103, "time": 1.2, "stages": {"solve": {"time": 0.001, "allocated": 2048, "data": {}}, ...}}
+# and with profile_path the whole avatar is run under cProfile and its stats are dumped there.
+
+import cProfile
+import json
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Profiler:
+
+    def __init__ (self, avatar=None, log_path=None, count_data=None, trace_memory=False, profile_path=None):
+        self.avatar = avatar
+        self.log_path = log_path
+        self.count_data = count_data
+        self.trace_memory = trace_memory
+        self.profile_path = profile_path
+        self.stages = OrderedDict()
+        self.start_time = None
+        self.started_tracing = False
+        self.cprofile = None
+
+    def __enter__ (self):
+        self.start ()
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+        return False
+
+    def start (self):
+        self.start_time = time.time()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        if self.profile_path:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextmanager
+    def stage (self, name):
+        data_before = self.count_data () if self.count_data else {}
+        memory_before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        start = time.time()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {'time': 0.0})
+            record['time'] += time.time() - start
+            if memory_before is not None and tracemalloc.is_tracing():
+                record['allocated'] = record.get('allocated', 0) + tracemalloc.get_traced_memory()[0] - memory_before
+            if self.count_data:
+                data = record.setdefault('data', {})
+                for kind, count in self.count_data ().items():
+                    data[kind] = data.get(kind, 0) + count - data_before.get(kind, 0)
+                    if not data[kind]:
+                        del data[kind]
+
+    # wall time of stages in seconds: {stage name: time}
+    @property
+    def timings (self):
+        return OrderedDict((name, record['time']) for name, record in self.stages.items())
+
+    def record (self):
+        record = OrderedDict((('avatar', self.avatar),))
+        if self.start_time is not None:
+            record['time'] = time.time() - self.start_time
+        record['stages'] = self.stages
+        return record
+
+    def close (self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.profile_path)
+            self.cprofile = None
+        if self.log_path:
+            with open(self.log_path, 'a') as log:
+                log.write(json.dumps(self.record ()) + '\n')
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
@@ -0,0 +1,132 @@
+# Memory of a long running Blender worker that aligns avatar after avatar.
+#
+#   tracker = ResourceTracker (bpy.data, keep=(DEBUG_MARKERS_NAME,))
+#   for avatar in avatars:
+#       tracker.begin ()
+#       ... align avatar, restore the scene ...
+#       record['resources'] = tracker.end ()
+#
+# Tracker remembers names of data-blocks (objects, meshes, images...) the avatar starts with.
+# When it ends, everything created since then is removed: objects first, then new data-blocks
+# that nothing uses anymore (orphans, e.g. meshes of removed Baked objects or meshes left by to_mesh),
+# until there's nothing more to remove. Data-blocks named in 'keep' are reused by the next avatar and stay.
+# Shape keys can't be removed by themselves (they go with their mesh), they and their key blocks are only counted.
+#
+# Every avatar gets a record of resident memory of the process (from /proc/self/statm, None where
+# there's no /proc) and number of data-blocks of every kind, and how they grew since the end of the
+# 'warmup' avatars (caches of the first avatars are filled by then). When memory grows by more than
+# max_rss_growth bytes or any kind of data-blocks by more than max_data_growth, ResourceLeakError is raised,
+# the worker should stop (a new process starts with clean memory).
+
+import os
+from collections import OrderedDict
+
+
+# kinds of data-blocks (collections of bpy.data) that are tracked
+DATA_KINDS = ('objects', 'meshes', 'shape_keys', 'materials', 'textures', 'images', 'actions')
+
+# exit code of worker (uv_alignment_batch.py) that stopped on ResourceLeakError
+# (not 1 or 2 - Python and argparse exit with them on errors)
+LEAK_EXIT_CODE = 75
+
+
+class ResourceLeakError (RuntimeError):
+
+    def __init__ (self, message, record):
+        RuntimeError.__init__(self, message)
+        self.record = record
+
+
+# resident memory of this process in bytes, None if it's unknown (no /proc, e.g. on Windows)
+def resident_memory (statm_path='/proc/self/statm'):
+    try:
+        with open(statm_path) as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+# names of data-blocks: {kind: set of names}
+def data_block_names (data, kinds=DATA_KINDS):
+    return dict((kind, set(block.name for block in getattr(data, kind))) for kind in kinds)
+
+
+# number of data-blocks of every kind and of key blocks of all shape keys
+# (also what Profiler counts in stages, see uv_alignment_profile.py)
+def count_data (data, kinds=DATA_KINDS):
+    counts = OrderedDict((kind, len(getattr(data, kind))) for kind in kinds)
+    if 'shape_keys' in counts:
+        counts['key_blocks'] = sum(len(key.key_blocks) for key in data.shape_keys)
+    return counts
+
+
+# remove data-blocks that are not in 'names' (see data_block_names) and not in 'keep':
+# objects (unlinked from scenes), then orphans of other kinds. Returns {kind: number of removed}
+def remove_new_data (data, names, keep=(), kinds=DATA_KINDS):
+    removed = OrderedDict((kind, 0) for kind in kinds)
+    if 'objects' in kinds:
+        for ob in [ob for ob in data.objects if ob.name not in names['objects'] and ob.name not in keep]:
+            data.objects.remove (ob, do_unlink=True)
+            removed['objects'] += 1
+
+    # removing a mesh may leave its materials without users, so again until nothing is removed
+    collections = [(kind, getattr(data, kind)) for kind in kinds if kind not in ('objects', 'shape_keys')]
+    while True:
+        orphans = [(kind, blocks, block) for kind, blocks in collections for block in blocks
+                   if block.users == 0 and block.name not in names[kind] and block.name not in keep]
+        if not orphans:
+            return removed
+        for kind, blocks, block in orphans:
+            blocks.remove (block)
+            removed[kind] += 1
+
+
+class ResourceTracker:
+
+    def __init__ (self, data, keep=(), kinds=DATA_KINDS, max_rss_growth=1 << 30, max_data_growth=8, warmup=1,
+                  memory=resident_memory):
+        self.data = data
+        self.keep = set(keep)
+        self.kinds = tuple(kinds)
+        self.max_rss_growth = max_rss_growth
+        self.max_data_growth = max_data_growth
+        self.warmup = warmup
+        self.memory = memory
+        self.names = None
+        self.iterations = 0
+        self.baseline = None
+
+    def begin (self):
+        self.names = data_block_names (self.data, self.kinds)
+
+    # remove what the avatar left and measure the process, returns record of the avatar:
+    # {"rss", "data": {kind: count}, "removed": {kind: count}} and after warmup "rss_growth" and "data_growth".
+    # Raises ResourceLeakError (with the record) when growth is over the limits
+    def end (self):
+        if self.names is None:
+            raise ValueError ("ResourceTracker.end() without begin()")
+        removed = remove_new_data (self.data, self.names, self.keep, self.kinds)
+        self.names = None
+        self.iterations += 1
+        record = OrderedDict((('rss', self.memory ()), ('data', count_data (self.data, self.kinds)),
+                              ('removed', OrderedDict((kind, n) for kind, n in removed.items() if n))))
+        if self.baseline is None:
+            if self.iterations >= self.warmup:
+                self.baseline = record
+            return record
+
+        leaks = []
+        if record['rss'] is not None and self.baseline['rss'] is not None:
+            record['rss_growth'] = record['rss'] - self.baseline['rss']
+            if self.max_rss_growth is not None and record['rss_growth'] > self.max_rss_growth:
+                leaks.append("resident memory grew by {:.1f} MB".format(record['rss_growth'] / float(1 << 20)))
+        record['data_growth'] = OrderedDict((kind, count - self.baseline['data'].get(kind, 0))
+                                            for kind, count in record['data'].items())
+        for kind, growth in record['data_growth'].items():
+            if self.max_data_growth is not None and growth > self.max_data_growth:
+                leaks.append("{} {} more".format(growth, kind))
+        if leaks:
+            raise ResourceLeakError ("Resources leak after {} avatars: {}".format(self.iterations, ", ".join(leaks)),
+                                     record)
+        return record
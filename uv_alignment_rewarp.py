@@ -0,0 +1,150 @@
+# Photo rewarped to default UVs of FotoPlane.
+#
+# run with: 'python uv_alignment_rewarp.py <photo> <photo>.uv.json <texture>.npy [--image <texture>.png]'
+# to rewarp photo with UV matrix written by 'MATRIX' output (see uv_alignment_export.py).
+#
+# transform_UV moves UVs of the plane to where they find their landmarks on the photo:
+#   (u, v, 1)_photo = uv_matrix * (u, v, 1)   (see get_uv_matrix in uv_alignment_core.py,
+# aspect ratios and scale_Y are folded in). Rewarp does the same with pixels: every texel of the
+# new texture takes the photo at uv_matrix * (its UV), so the plane with its own UVs shows aligned photo.
+#
+# Texture is resampled bilinearly, tile by tile, tiles go to a pool of threads (NumPy lets
+# other threads run while it works). Texture is written into memory-mapped .npy file
+# (rows from the top, like the photo), so only the photo and tiles in work are in memory.
+# PIL (optional) is needed only to read photos that are not .npy and to save texture as image.
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# UV-coordinates (h, w, 2) of centers of texels [y0:y1, x0:x1] of texture of width x height
+# (row 0 is the top of texture, V = 0 is its bottom)
+def texel_uvs (x0, x1, y0, y1, width, height):
+    u = (np.arange(x0, x1, dtype=np.float64) + 0.5) / width
+    v = 1 - (np.arange(y0, y1, dtype=np.float64) + 0.5) / height
+    return np.stack(np.broadcast_arrays(u[None, :], v[:, None]), axis=-1)
+
+
+# pixel coordinates (x, y) of (..., 2) UV-coordinates on image of width x height (centers of pixels are at .0)
+def uv_to_pixels (uvs, width, height):
+    uvs = np.asarray(uvs, dtype=np.float64)
+    return uvs[..., 0] * width - 0.5, (1 - uvs[..., 1]) * height - 0.5
+
+
+# bilinear samples of photo (H, W) or (H, W, C) at pixel coordinates x, y (any equal shapes).
+# Samples that are further than half of pixel outside of the photo get 'fill'.
+# Returns float32 (..., C) (or (...) for photo without channels)
+def sample_bilinear (photo, x, y, fill=0):
+    height, width = photo.shape[:2]
+    pixels = photo if photo.ndim == 3 else photo[..., None]
+    inside = (x >= -0.5) & (x <= width - 0.5) & (y >= -0.5) & (y <= height - 0.5)
+
+    x = np.clip(x, 0, width - 1)
+    y = np.clip(y, 0, height - 1)
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = (x - x0).astype(np.float32)[..., None]
+    fy = (y - y0).astype(np.float32)[..., None]
+
+    top = pixels[y0, x0].astype(np.float32) * (1 - fx) + pixels[y0, x1].astype(np.float32) * fx
+    bottom = pixels[y1, x0].astype(np.float32) * (1 - fx) + pixels[y1, x1].astype(np.float32) * fx
+    samples = top * (1 - fy) + bottom * fy
+    samples[~inside] = fill
+    return samples if photo.ndim == 3 else samples[..., 0]
+
+
+# (x0, x1, y0, y1) of tiles of texture of width x height
+def get_tiles (width, height, tile=512):
+    return [(x0, min(x0 + tile, width), y0, min(y0 + tile, height))
+            for y0 in range(0, height, tile) for x0 in range(0, width, tile)]
+
+
+def rewarp_tile (photo, uv_mat, texture, bounds, fill=0):
+    x0, x1, y0, y1 = bounds
+    uvs = texel_uvs (x0, x1, y0, y1, texture.shape[1], texture.shape[0])
+    if callable(uv_mat):
+        photo_uvs = uv_mat(uvs.reshape(-1, 2)).reshape(uvs.shape)
+    else:
+        photo_uvs = np.dot(uvs, uv_mat[:2, :2].T) + uv_mat[:2, 2]
+    samples = sample_bilinear (photo, *uv_to_pixels (photo_uvs, photo.shape[1], photo.shape[0]), fill=fill)
+    if np.issubdtype(texture.dtype, np.integer):
+        info = np.iinfo(texture.dtype)
+        samples = np.clip(np.rint(samples), info.min, info.max)
+    texture[y0:y1, x0:x1] = samples
+
+
+# Rewarp photo (H, W) or (H, W, C) with 3x3 uv_mat into texture (any array, e.g. memory-mapped,
+# with the same channels as the photo), tiles of 'tile' texels go to 'workers' threads.
+# uv_mat may also be a function of (M, 2) UVs that gives (M, 2) UVs on the photo (e.g. warp_uvs)
+def rewarp_photo (photo, uv_mat, texture, tile=512, workers=None, fill=0):
+    uv_mat = uv_mat if callable(uv_mat) else np.asarray(uv_mat, dtype=np.float64)
+    if texture.shape[2:] != photo.shape[2:]:
+        raise ValueError ("Texture {} and photo {} have different channels".format(texture.shape, photo.shape))
+    tiles = get_tiles (texture.shape[1], texture.shape[0], tile)
+    if workers == 1:
+        for bounds in tiles:
+            rewarp_tile (photo, uv_mat, texture, bounds, fill)
+    else:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            # list() brings exceptions of tiles here
+            list(executor.map(lambda bounds: rewarp_tile (photo, uv_mat, texture, bounds, fill), tiles))
+    return texture
+
+
+# Rewarp photo into memory-mapped .npy texture at path, size - (width, height) of texture
+# (default: size of the photo). Returns the texture
+def rewarp_photo_to_file (photo, uv_mat, path, size=None, tile=512, workers=None, fill=0):
+    width, height = size or (photo.shape[1], photo.shape[0])
+    texture = np.lib.format.open_memmap(path, mode='w+', dtype=photo.dtype, shape=(height, width) + photo.shape[2:])
+    rewarp_photo (photo, uv_mat, texture, tile, workers, fill)
+    texture.flush()
+    return texture
+
+
+# pixels of photo (H, W[, C]): .npy is memory-mapped, other images are decoded by PIL
+def load_photo_pixels (path):
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if Image is None:
+        raise ImportError ("Reading '{}' needs PIL (pip install pillow)".format(path))
+    return np.asarray(Image.open(path))
+
+
+# save .npy texture as image (PNG, JPEG... by extension), needs PIL
+def save_texture_image (texture, image_path):
+    if Image is None:
+        raise ImportError ("Saving '{}' needs PIL (pip install pillow)".format(image_path))
+    Image.fromarray(np.asarray(texture)).save(image_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewarp photo to default UVs of FotoPlane")
+    parser.add_argument("photo", help="photo (image or .npy)")
+    parser.add_argument("matrix", help=".uv.json written by 'MATRIX' output")
+    parser.add_argument("texture", help="rewarped texture (.npy)")
+    parser.add_argument("--image", help="also save texture as this image")
+    parser.add_argument("--size", type=int, nargs=2, help="width and height of texture (default: size of photo)")
+    parser.add_argument("--tile", type=int, default=512)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--frame", type=int, default=0, help="index of frame of aligned sequence")
+    args = parser.parse_args()
+
+    with open(args.matrix) as f:
+        uv_mat = np.array(json.load(f)['uv_matrix'])
+    if uv_mat.ndim == 3:
+        uv_mat = uv_mat[args.frame]
+    texture = rewarp_photo_to_file (load_photo_pixels (args.photo), uv_mat, args.texture, args.size,
+                                    args.tile, args.workers)
+    if args.image:
+        save_texture_image (texture, args.image)